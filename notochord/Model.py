@@ -1,8 +1,14 @@
 #!/usr/bin/env python
-from . import export, lookup, persist, schema, grouper, insert_ignore, pk, get_utcnow, temporary_table_like, populate, lookup_or_persist, null_log, temptable_scope
+from . import export, lookup, persist, schema, grouper, insert_ignore, pk, get_utcnow, temporary_table_like, populate, lookup_or_persist, null_log, temptable_scope, bulk_load, bulk_load_arrays, fetch_arrays, iterate_batches
 import base64
+import collections
 import cPickle as pickle
 import json
+import os
+import shutil
+import sys
+import threading
+import time
 import uuid
 import datetime
 import numpy as np
@@ -11,7 +17,206 @@ import scipy.sparse
 import sqlalchemy
 import itertools
 
-__all__ = []
+__all__ = ["model_cache"]
+
+def package_object_uuid(digest):
+    "Object store uuid of an artifact, derived from its sha256 so artifacts are shared"
+    return str(uuid.UUID(bytes=digest.decode('hex')[:16]))
+
+def check_package_store(object_store):
+    if getattr(object_store, "marshal_name", None) not in (None, "raw"):
+        raise ValueError("Model packages need an object store with marshal 'raw', not '{}'".format(object_store.marshal_name))
+
+@export
+def save_package(object_store, package, min_array_bytes=1<<16):
+    """Writes a trained package to an object store and returns its hash
+
+    Numpy arrays of at least min_array_bytes are saved as separate .npy
+    artifacts and the rest of the package is pickled around references to
+    them.  Artifacts are named by the sha256 of their contents, and the hash
+    of the pickle, which lists the hashes of its arrays, identifies the whole
+    package.
+    """
+    import hashlib
+    import io
+    check_package_store(object_store)
+
+    arrays = {}
+    def persistent_id(obj):
+        if isinstance(obj, np.ndarray) and obj.dtype != object and obj.nbytes >= min_array_bytes:
+            buf = io.BytesIO()
+            np.save(buf, obj, allow_pickle=False)
+            data = buf.getvalue()
+            digest = hashlib.sha256(data).hexdigest()
+            arrays[digest] = data
+            return digest
+        return None
+
+    buf = io.BytesIO()
+    pickler = pickle.Pickler(buf, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    pickler.dump(package)
+    manifest = buf.getvalue()
+    package_hash = hashlib.sha256(manifest).hexdigest()
+
+    #Arrays go first so that a package is never visible without them
+    for digest, data in arrays.iteritems():
+        object_store.put_if_absent(package_object_uuid(digest), data)
+    object_store.put_if_absent(package_object_uuid(package_hash), manifest)
+    object_store.flush()
+    return package_hash
+
+@export
+def load_package(object_store, package_hash, mmap=True):
+    """Reads a package written by save_package
+
+    Arrays are memory mapped read-only when the store keeps them as plain
+    files and mmap is set; otherwise they are read into memory and checked
+    against their hash.
+    """
+    import hashlib
+    import io
+    check_package_store(object_store)
+
+    manifest = object_store.get(package_object_uuid(package_hash))
+    if hashlib.sha256(manifest).hexdigest() != package_hash:
+        raise ValueError("Model package {} is corrupt".format(package_hash))
+
+    def persistent_load(digest):
+        item_uuid = package_object_uuid(digest)
+        path = object_store.local_path(item_uuid) if mmap else None
+        if path is not None:
+            return np.load(path, mmap_mode='r', allow_pickle=False)
+        data = object_store.get(item_uuid)
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError("Model package array {} is corrupt".format(digest))
+        return np.load(io.BytesIO(data), allow_pickle=False)
+
+    unpickler = pickle.Unpickler(io.BytesIO(manifest))
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
+
+def object_size(obj):
+    "Approximate bytes held by an object graph, leaving out memory mapped arrays"
+    seen = set()
+    stack = [obj]
+    ret = 0
+    while stack:
+        x = stack.pop()
+        if id(x) in seen:
+            continue
+        seen.add(id(x))
+        #Arrays count their data when they own it; mapped ones don't
+        ret += sys.getsizeof(x)
+        if isinstance(x, np.ndarray):
+            if x.base is not None:
+                stack.append(x.base)
+        elif isinstance(x, dict):
+            stack.extend(x.iterkeys())
+            stack.extend(x.itervalues())
+        elif isinstance(x, (list, tuple, set, frozenset)):
+            stack.extend(x)
+        elif hasattr(x, "__dict__") and not isinstance(x, type):
+            stack.append(x.__dict__)
+    return ret
+
+@export
+class ModelCache(object):
+    """Process-wide cache of decoded model packages and hyperparameters
+
+    Entries are keyed by model uuid and trained_time, so retraining a model
+    replaces its package without explicit invalidation.  They are kept in an
+    LRU bounded by their approximate size in bytes, and values are returned
+    by reference so they must not be mutated.
+
+    latest_model() keeps the latest model of each model set and only checks
+    that it is still the latest with a max(trained_time) query, at most once
+    every check_interval seconds.
+    """
+    def __init__(self, max_bytes=1<<30, check_interval=0):
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self._lock = threading.RLock()
+        self._entries = collections.OrderedDict()
+        self._latest = {}
+        self._stats = dict(hits=0, misses=0, evictions=0, bytes=0, loads=0, load_time=0.0, latest_hits=0, latest_misses=0)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries))
+
+    def get(self, model, name, load):
+        key = (model.uuid, model.trained_time, name)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self._stats['hits'] += 1
+                return entry[0]
+            self._stats['misses'] += 1
+
+        #Loaded outside the lock so that a slow load doesn't block hits
+        start_time = time.time()
+        value = load()
+        elapsed = time.time() - start_time
+        size = object_size(value)
+
+        with self._lock:
+            self._stats['loads'] += 1
+            self._stats['load_time'] += elapsed
+            if size > self.max_bytes:
+                return value
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._stats['bytes'] -= old[1]
+            self._entries[key] = (value, size)
+            self._stats['bytes'] += size
+            while self._stats['bytes'] > self.max_bytes:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self._stats['bytes'] -= old_size
+                self._stats['evictions'] += 1
+        return value
+
+    def invalidate(self, model_uuid=None):
+        "Drops the entries of one model, or of every model"
+        with self._lock:
+            for key in list(self._entries):
+                if model_uuid is None or key[0] == model_uuid:
+                    self._stats['bytes'] -= self._entries.pop(key)[1]
+            if model_uuid is None:
+                self._latest.clear()
+
+    def is_stale(self, model):
+        "Whether a model set has a model trained after the given one"
+        t_m = schema.model
+        latest_time = model.session.query(sqlalchemy.func.max(t_m.trained_time)) \
+            .filter(t_m.idmodel_set == model.idmodel_set) \
+            .scalar()
+        return latest_time is not None and (model.trained_time is None or latest_time > model.trained_time)
+
+    def latest_model(self, model_set):
+        key = model_set.idmodel_set
+        now = time.time()
+        with self._lock:
+            current = self._latest.get(key)
+        #Models are bound to a session, so another session starts over
+        if current is not None and current[0].session is model_set.session:
+            model, checked_time = current
+            recent = now - checked_time < self.check_interval
+            if recent or not self.is_stale(model):
+                with self._lock:
+                    self._stats['latest_hits'] += 1
+                    if not recent:
+                        self._latest[key] = (model, now)
+                return model
+
+        with self._lock:
+            self._stats['latest_misses'] += 1
+        model = Model.get_latest(model_set)
+        if model is not None:
+            with self._lock:
+                self._latest[key] = (model, now)
+        return model
 
 @export
 class CrossvalidationQuery(object):
@@ -64,6 +269,103 @@ class CrossvalidationQuery(object):
         schema.TableBase.metadata.remove(self.tmp_wr.__table__)
         self.session = None
 
+def group_rows(batches, num_groups):
+    """Regroups batches of rows sorted by their first column
+
+    Yields arrays holding the rows of num_groups consecutive keys, with only
+    the last one allowed to hold fewer.  At most one group and one batch are
+    held in memory.
+    """
+    pending = None
+    for rows in batches:
+        pending = rows if pending is None else np.concatenate([pending, rows])
+        starts = np.flatnonzero(np.concatenate([[True], pending[1:, 0] != pending[:-1, 0]]))
+        done = 0
+        while len(starts) > num_groups:
+            end = starts[num_groups]
+            yield pending[done:end]
+            done = end
+            starts = starts[num_groups:]
+        pending = pending[done:]
+
+    if pending is not None and len(pending) > 0:
+        yield pending
+
+def group_starts(keys):
+    "Marks where each run of equal keys begins"
+    starts = np.ones(len(keys), dtype=bool)
+    starts[1:] = keys[1:] != keys[:-1]
+    return starts
+
+def build_id_encoder(ids):
+    "Maps ids to their positions with a binary search over the sorted ids"
+    order = np.argsort(ids, kind="mergesort")
+    sorted_ids = ids[order]
+    def encode(x):
+        return order[np.searchsorted(sorted_ids, x)]
+    return encode
+
+@export
+class MatrixCache(object):
+    """Assembled input matrices of models saved as .npy files
+
+    Each chunk of a model is kept as CSR arrays along with the widgets and
+    features ordering its rows and columns, and is loaded memory-mapped.
+    A chunk is only reused when the model still has the same number of
+    widgets and input features and the chunk's widget and feature ids
+    match, so training and prediction over the same widgets share it.
+    Values are not checked; invalidate() a model whose widget features
+    were rewritten.
+    """
+    arrays = ("indptr", "indices", "data", "widgets", "features")
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def model_path(self, idmodel):
+        return os.path.join(self.directory, "model-{}".format(int(idmodel)))
+
+    def chunk_path(self, idmodel, batch_size, chunk):
+        return os.path.join(self.model_path(idmodel), "{}-{}".format(int(batch_size), int(chunk)))
+
+    def load(self, idmodel, batch_size, chunk, num_widgets, widgets, features):
+        path = self.chunk_path(idmodel, batch_size, chunk)
+        try:
+            with open(os.path.join(path, "meta.json"), 'rb') as fin:
+                meta = json.loads(fin.read())
+            if (meta['num_widgets'], meta['num_features']) != (num_widgets, len(features)):
+                return None
+            indptr, indices, data, cached_widgets, cached_features = (
+                np.load(os.path.join(path, "{}.npy".format(x)), mmap_mode='r') for x in self.arrays
+            )
+        except (IOError, ValueError, KeyError):
+            return None
+
+        if not (np.array_equal(cached_widgets, widgets) and np.array_equal(cached_features, features)):
+            return None
+        return sp.sparse.csr_matrix((data, indices, indptr), shape=(len(widgets), len(features)), copy=False)
+
+    def save(self, idmodel, batch_size, chunk, num_widgets, widgets, features, matrix):
+        path = self.chunk_path(idmodel, batch_size, chunk)
+        tmp_path = "{}.tmp.{}".format(path, os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        for name, arr in zip(self.arrays, (matrix.indptr, matrix.indices, matrix.data, widgets, features)):
+            np.save(os.path.join(tmp_path, "{}.npy".format(name)), arr)
+        with open(os.path.join(tmp_path, "meta.json"), 'wb') as fout:
+            fout.write(json.dumps(dict(num_widgets=num_widgets, num_features=len(features))))
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    def invalidate(self, idmodel):
+        path = self.model_path(idmodel)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
 @export
 class ModelSet(object):
     def __init__(self, session, name):
@@ -82,18 +384,19 @@ class ModelSet(object):
         raise TypeError("ModelSet instances are immutable")
 
     def latest_model(self):
-        return Model.get_latest(self)
+        return model_cache.latest_model(self)
 
-    def new_model(self, alg, input_features, output_features=None, params=None, log=None):
-        return Model.new_from_model_set(self, alg, input_features, output_features, params=params, log=log)
+    def new_model(self, alg, input_features, output_features=None, params=None, log=None, matrix_cache=None):
+        return Model.new_from_model_set(self, alg, input_features, output_features, params=params, log=log, matrix_cache=matrix_cache)
 
 @export
 class Model(object):
-    def __init__(self, session, dbinst, log=None):
+    def __init__(self, session, dbinst, log=None, matrix_cache=None):
         self.__dict__.update(dict(
             _dbinst=dbinst,
             session=session,
-            log=log or null_log
+            log=log or null_log,
+            matrix_cache=matrix_cache
         ))
 
     def __getattr__(self, name):
@@ -102,88 +405,126 @@ class Model(object):
     def __setattr__(self, name, value):
         raise TypeError("Model instances are immutable")
 
-    def _get_ordered_data(self, t_mw, sparse_inputs=False, batch_size=None, get_labels=True):
+    def _query_chunk_inputs(self, t_mw, min_pk=None, max_pk=None):
         from sqlalchemy.sql.expression import and_
 
-        t_w = schema.widget
         t_wf = schema.widget_feature
         t_mtif = schema.model_trained_on_input_feature
-        t_mtof = schema.model_trained_on_output_feature
 
-        if not sparse_inputs:
-            def build_matrix(shape, rows, cols, vals):
-                arr = np.zeros(shape=shape, dtype=np.float32)
-                arr[rows, cols] = vals
-                return arr
-        else:
-            def build_matrix(shape, rows, cols, vals):
-                return sp.sparse.csr_matrix((vals, (rows, cols)), dtype=np.float32, shape=shape)
-
-        def build_encoder(iterable):
-            encoder = {}
-            for it, f in enumerate(iterable):
-                encoder[f] = it
-            return encoder
-
-        def triples_to_matrix(iterable, shape):
-            self.log.info("shape: {}".format(shape))
-            rows, cols, vals = [], [], []
-            for r, c, v in iterable:
-                if len(rows) == 0:
-                    self.log.info("rcv: {} {} {}".format(r,c,v))
-                rows.append(r)
-                cols.append(c)
-                vals.append(v)
-
-            return build_matrix(shape, rows, cols, vals)
-
-        if batch_size == 0:
-            return
-
-        def next_or_none(iterable, num):
-            try:
-                return next(iterable)
-            except StopIteration:
-                return [None] * num
-
-        def pull_many(iterable, n):
-            ret = []
-            try:
-                it = 0
-                while n is None or it < n:
-                    ret.append(next(iterable))
-                    it += 1
-            except StopIteration:
-                pass
-            return ret
-                
-        input_col_encoder = build_encoder(x.idfeature for x in self.query_input_features())
-        num_input_features = len(input_col_encoder)
+        q_inputs = self.session.query(t_wf.idwidget, t_wf.idfeature, t_wf.value) \
+            .select_from(t_mw) \
+            .filter(t_mw.idmodel == self.idmodel) \
+            .join(t_wf, t_mw.idwidget == t_wf.idwidget) \
+            .join(t_mtif, and_(t_mtif.idfeature == t_wf.idfeature, t_mtif.idmodel == self.idmodel)) \
+            .filter(t_mtif.idmodel == self.idmodel)
+        if min_pk is not None:
+            q_inputs = q_inputs.filter(pk(t_mw) >= min_pk)
+        if max_pk is not None:
+            q_inputs = q_inputs.filter(pk(t_mw) <= max_pk)
+        return q_inputs
+
+    def _stream_inputs(self, t_mw):
+        "One pass over every widget and its inputs, ordered by widget then feature"
+        t_wf = schema.widget_feature
+        t_mtif = schema.model_trained_on_input_feature
 
+        #Widgets without inputs still get a row, with a NULL idfeature
+        sq = self.session.query(t_wf.idwidget, t_wf.idfeature, t_wf.value) \
+            .join(t_mtif, t_mtif.idfeature == t_wf.idfeature) \
+            .filter(t_mtif.idmodel == self.idmodel) \
+            .subquery()
+        return self.session.query(pk(t_mw), t_mw.idwidget, sq.c.idfeature, sq.c.value) \
+            .select_from(t_mw) \
+            .outerjoin(sq, sq.c.idwidget == t_mw.idwidget) \
+            .filter(t_mw.idmodel == self.idmodel) \
+            .order_by(pk(t_mw).asc(), sq.c.idfeature.asc())
+
+    def _iterate_chunks(self, t_mw, batch_size, input_features, encode_inputs):
+        "Yields widget ids and CSR inputs, one range query per chunk"
         widgets = self.session.query(pk(t_mw), t_mw.idwidget) \
             .filter(t_mw.idmodel==self.idmodel) \
             .order_by(pk(t_mw).asc())
-        it_widget = iter(widgets)
+        widget_pks, widget_ids = fetch_arrays(self.session, widgets, [np.int64, np.int64])
+        if batch_size is None:
+            batch_size = max(1, len(widget_ids))
+
+        for chunk, start in enumerate(xrange(0, len(widget_ids), batch_size)):
+            chunk_pks = widget_pks[start:start + batch_size]
+            widget_chunk = widget_ids[start:start + batch_size]
+            shape = (len(widget_chunk), len(input_features))
+
+            in_chunk = None
+            if self.matrix_cache is not None:
+                in_chunk = self.matrix_cache.load(self.idmodel, batch_size, chunk, len(widget_ids), widget_chunk, input_features)
+                if in_chunk is not None:
+                    self.log.info("Loaded chunk {} from the matrix cache".format(chunk))
+
+            if in_chunk is None:
+                q_inputs = self._query_chunk_inputs(t_mw, int(chunk_pks[0]), int(chunk_pks[-1]))
+                idwidgets, idfeatures, values = fetch_arrays(self.session, q_inputs, [np.int64, np.int64, np.float32])
+                self.log.info("shape: {} nnz: {}".format(shape, len(values)))
+                in_chunk = sp.sparse.csr_matrix(
+                    (values, (build_id_encoder(widget_chunk)(idwidgets), encode_inputs(idfeatures))),
+                    dtype=np.float32, shape=shape
+                )
+                if self.matrix_cache is not None:
+                    self.matrix_cache.save(self.idmodel, batch_size, chunk, len(widget_ids), widget_chunk, input_features, in_chunk)
+
+            yield widget_chunk, in_chunk
+
+    def _stream_chunks(self, t_mw, batch_size, input_features, encode_inputs, fetch_size=65536):
+        """Yields widget ids and CSR inputs from a single streamed query
+
+        Rows arrive in widget order, so a chunk is complete once the rows of
+        the widget after it start.  Only the unfinished chunk and one fetch
+        are held in memory.
+        """
+        num_widgets = self.session.query(sqlalchemy.func.count(pk(t_mw))).filter(t_mw.idmodel == self.idmodel).scalar()
+        if batch_size is None:
+            batch_size = max(1, num_widgets)
+
+        def build_chunk(chunk, rows):
+            #Columns are the model widget pk, idwidget, idfeature and value
+            starts = group_starts(rows[:, 0])
+            widget_chunk = rows[starts, 1].astype(np.int64)
+            row_index = np.cumsum(starts) - 1
+            has_input = ~np.isnan(rows[:, 2])
+            shape = (len(widget_chunk), len(input_features))
+            self.log.info("shape: {} nnz: {}".format(shape, np.count_nonzero(has_input)))
+            in_chunk = sp.sparse.csr_matrix(
+                (rows[has_input, 3].astype(np.float32), (row_index[has_input], encode_inputs(rows[has_input, 2].astype(np.int64)))),
+                dtype=np.float32, shape=shape
+            )
+            if self.matrix_cache is not None:
+                self.matrix_cache.save(self.idmodel, batch_size, chunk, num_widgets, widget_chunk, input_features, in_chunk)
+            return widget_chunk, in_chunk
 
-        while 1:
-            widget_chunk = pull_many((x for x in it_widget), batch_size)
-            if len(widget_chunk) == 0:
-                break
-            widget_encoder = dict(((x.idwidget,i) for i, x in enumerate(widget_chunk)))
+        batches = iterate_batches(self.session, self._stream_inputs(t_mw), 4, batch_size=fetch_size, stream=True)
+        for chunk, rows in enumerate(group_rows(batches, batch_size)):
+            yield build_chunk(chunk, rows)
 
-            q_inputs = self.session.query(t_wf.idwidget, t_wf.idfeature, t_wf.value) \
-                .select_from(t_mw) \
-                .filter(t_mw.idmodel == self.idmodel) \
-                .filter(pk(t_mw) >= widget_chunk[0][0]) \
-                .filter(pk(t_mw) <= widget_chunk[-1][0]) \
-                .join(t_wf, t_mw.idwidget == t_wf.idwidget) \
-                .join(t_mtif, and_(t_mtif.idfeature == t_wf.idfeature, t_mtif.idmodel == self.idmodel)) \
-                .filter(t_mtif.idmodel == self.idmodel)
+    def _get_ordered_data(self, t_mw, sparse_inputs=False, batch_size=None, get_labels=True, stream=False):
+        t_mtif = schema.model_trained_on_input_feature
+
+        if batch_size == 0:
+            return
+
+        input_features, = fetch_arrays(self.session, self.session.query(t_mtif.idfeature).filter(t_mtif.idmodel == self.idmodel).order_by(pk(t_mtif).asc()), [np.int64])
+        encode_inputs = build_id_encoder(input_features)
 
-            in_chunk = triples_to_matrix(((widget_encoder[i[0]], input_col_encoder[i[1]], i[2]) for i in q_inputs), (len(widget_chunk), num_input_features))
+        if stream:
+            #With a server-side cursor (MySQL's SSCursor) the connection can't
+            #run other queries until every chunk has been consumed
+            chunks = self._stream_chunks(t_mw, batch_size, input_features, encode_inputs)
+        else:
+            chunks = self._iterate_chunks(t_mw, batch_size, input_features, encode_inputs)
+
+        for widget_chunk, in_chunk in chunks:
+            if not sparse_inputs:
+                in_chunk = in_chunk.toarray()
 
             if not get_labels:
-                yield [x.idwidget for x in widget_chunk], in_chunk
+                yield widget_chunk.tolist(), in_chunk
             else:
                 raise NotImplementedError("Supervised data not yet implemented")
                 #arr_out = build_matrix((count, num_output_features), out_rows, out_cols, out_vals)
@@ -200,30 +541,30 @@ class Model(object):
 #            num_output_features = len(output_col_encoder)
 
 
-    def get_training_data(self, widgets, sparse_inputs=False, supervised=True, batch_size=None):
+    def get_training_data(self, widgets, sparse_inputs=False, supervised=True, batch_size=None, stream=False):
         self.select_training_widgets(widgets)
         t_mw = schema.model_trained_on_widget
         num_widgets = self.count_training_widgets()
 
         if num_widgets > 0:
-            for ret in self._get_ordered_data(t_mw, sparse_inputs=sparse_inputs, get_labels=supervised, batch_size=batch_size):
+            for ret in self._get_ordered_data(t_mw, sparse_inputs=sparse_inputs, get_labels=supervised, batch_size=batch_size, stream=stream):
                 yield ret
 
-    def get_predict_data(self, widgets, sparse_inputs=False, supervised=True, batch_size=None):
+    def get_predict_data(self, widgets, sparse_inputs=False, supervised=True, batch_size=None, stream=False):
         self.select_predicts_widgets(widgets)
         t_mw = schema.model_predicts_widget
         num_widgets = self.count_predicts_widgets()
         if num_widgets > 0:
-            for ret in self._get_ordered_data(t_mw, sparse_inputs=sparse_inputs, get_labels=supervised, batch_size=batch_size):
+            for ret in self._get_ordered_data(t_mw, sparse_inputs=sparse_inputs, get_labels=supervised, batch_size=batch_size, stream=stream):
                 yield ret
 
-    def get_validation_data(self, widgets, sparse_inputs=False, supervised=True, batch_size=None):
+    def get_validation_data(self, widgets, sparse_inputs=False, supervised=True, batch_size=None, stream=False):
         self.select_validation_widgets(widgets)
         t_mw = schema.model_validated_on_widget
         num_widgets = self.count_validation_widgets()
 
         if num_widgets > 0:
-            for ret in self._get_ordered_data(t_mw, sparse_inputs=sparse_inputs, get_labels=supervised, batch_size=batch_size):
+            for ret in self._get_ordered_data(t_mw, sparse_inputs=sparse_inputs, get_labels=supervised, batch_size=batch_size, stream=stream):
                 yield ret
 
 #    def get_predict_data(self, widgets, sparse_inputs=False):
@@ -244,7 +585,7 @@ class Model(object):
         return klass(model_set.session, dbinst)
     
     @classmethod
-    def new_from_model_set(klass, model_set, algorithm, input_features, output_features=None, params=None, log=None):
+    def new_from_model_set(klass, model_set, algorithm, input_features, output_features=None, params=None, log=None, matrix_cache=None):
         t_m = schema.model
         t_ms = schema.model_status
         t_alg = schema.algorithm
@@ -258,7 +599,11 @@ class Model(object):
                 hyperparameters=base64.b64encode(pickle.dumps(params or algorithm.get_params()))
             ))
 
-        ret = klass(model_set.session, dbinst, log=log)
+        if matrix_cache is not None:
+            #Left over from a database the id was used in before
+            matrix_cache.invalidate(dbinst.idmodel)
+
+        ret = klass(model_set.session, dbinst, log=log, matrix_cache=matrix_cache)
         ret.select_input_features(input_features)
         if output_features is not None:
             ret.select_output_features(output_features)
@@ -266,11 +611,16 @@ class Model(object):
 
         return ret
 
-    def set_trained(self, package):
+    def set_trained(self, package, object_store=None):
         t_ms = schema.model_status
         ms_trained = lookup(self.session, t_ms, name="trained")
         self._dbinst.trained_time = get_utcnow()
-        self._dbinst.trained_package = base64.b64encode(pickle.dumps(package))
+        if object_store is None:
+            self._dbinst.trained_package = base64.b64encode(pickle.dumps(package))
+        else:
+            self._dbinst.package_hash = save_package(object_store, package)
+            self._dbinst.idobject_store = object_store.idobject_store
+            self._dbinst.trained_package = None
         self._dbinst.idmodel_status = ms_trained.idmodel_status
         persist(self.session, self._dbinst)
 
@@ -581,76 +931,31 @@ class Model(object):
         )
 
     def update_predictions(self, widgets, values):
-        tuple_ = sqlalchemy.sql.expression.tuple_
-
         t_wf = schema.widget_feature
-        tt_wf = t_wf.__table__
-
-        def rowdicts_generator(widgets, features, values):
-            if isinstance(values, np.ndarray):
-                if values.ndim == 1:
-                    values = values.reshape((values.size, 1))
-                self.log.info("rowdicts_generator {} {}".format(values.shape, (len(widgets), len(features))))
-                assert tuple(values.shape) == (len(widgets), len(features))
-                if values.ndim == 1:
-                    #1 dimensional numpy array
-                    for it_widget in xrange(len(widgets)):
-                        yield dict(
-                            idwidget=widgets[it_widget], idfeature=features[0], 
-                            value=float(values[it_widget]),
-                            idmodel=self.idmodel
-                        )
-                elif values.ndim == 2:
-                    #2 dimensional numpy array
-                    for it_widget, it_feature in itertools.product(xrange(len(widgets)), xrange(len(features))):
-                        yield dict(
-                            idwidget=widgets[it_widget], idfeature=features[it_feature], 
-                            value=float(values[it_widget, it_feature]),
-                            idmodel=self.idmodel
-                        )
-            elif isinstance(values, sp.sparse.spmatrix):
-                #2 dimensional scipy matrix
-                values = values.tocoo()
-                if (widgets is None) and (features is None):
-                    for it_nnz in xrange(values.nnz):
-                        yield dict(
-                            idwidget=values.row[it_nnz], 
-                            idfeature=values.col[it_nnz],
-                            value=float(values.data[it_nnz]),
-                            idmodel=self.idmodel
-                        )
-                else:
-                    for it_nnz in xrange(values.nnz):
-                        yield dict(
-                            idwidget=widgets[values.row[it_nnz]], 
-                            idfeature=features[values.col[it_nnz]],
-                            value=float(values.data[it_nnz]),
-                            idmodel=self.idmodel
-                        )
+
+        features = np.array([x.idfeature for x in self.query_predicts_features()], dtype=np.int64)
+        if isinstance(values, sp.sparse.spmatrix):
+            #2 dimensional scipy matrix, written as its nonzeros
+            values = values.tocoo()
+            if widgets is None:
+                idwidgets, idfeatures = values.row, values.col
             else:
-                #List of lists
-                for it_widget, widget_values in enumerate(values):
-                    for it_feature, value in enumerate(widget_values):
-                        yield dict(
-                            idwidget=widgets[it_widget], idfeature=features[it_feature], 
-                            value=float(value), 
-                            idmodel=self.idmodel
-                        )
-
-        tmp_wf = temporary_table_like("tmp_widget_feature", t_wf)
-        with temptable_scope(self.session, tmp_wf):
-            predicts_features = [x.idfeature for x in self.query_predicts_features()]
-            populate(self.session, tmp_wf, rowdicts_generator(widgets, predicts_features, values), batch_size=200)
-
-            t_wf_keys = tuple_(*tt_wf.primary_key)
-            tmp_wf_keys = [getattr(tmp_wf.c, k.name) for k in tt_wf.primary_key]
-
-            from sqlalchemy.sql.expression import select
-            self.session.execute(tt_wf.delete().where(t_wf_keys == select(tmp_wf_keys)))
-            self.session.execute(tt_wf.insert().from_select(tt_wf.columns, select(tmp_wf.columns)))
-
-        #tmp_wf.drop(bind=self.session.bind)
-        t_wf.metadata.remove(tmp_wf)
+                idwidgets, idfeatures = np.asarray(widgets, dtype=np.int64)[values.row], features[values.col]
+            values = values.data
+        else:
+            #Numpy array or list of lists, written as every cell
+            values = np.asarray(values, dtype=np.float64)
+            if values.ndim == 1:
+                values = values.reshape((values.size, 1))
+            self.log.info("update_predictions {} {}".format(values.shape, (len(widgets), len(features))))
+            assert tuple(values.shape) == (len(widgets), len(features))
+            idwidgets = np.repeat(np.asarray(widgets, dtype=np.int64), len(features))
+            idfeatures = np.tile(features, len(widgets))
+            values = values.ravel()
+
+        #Rows are written straight into widget_feature, replacing any
+        #previous predictions for the same keys
+        bulk_load_arrays(self.session, t_wf, ["idwidget", "idfeature", "value"], [idwidgets, idfeatures, values], on_conflict="replace")
 
     def query_predictions(self):
         t_wf = schema.widget_feature
@@ -659,33 +964,74 @@ class Model(object):
             .filter_by(idmodel=self.idmodel) \
             .order_by(t_wf.idwidget.asc(), t_wf.idfeature.asc())
 
-    def get_predictions(self, features):
+    def _query_predictions(self, features, widgets=None):
         t_wf = schema.widget_feature
         t_fs = schema.feature_set
         t_f = schema.feature
 
-        q = self.session.query(t_wf) \
+        q = self.session.query(t_wf.idwidget, t_wf.idfeature, t_wf.value) \
             .select_from(t_fs) \
             .join(t_f, t_f.idfeature_set == t_fs.idfeature_set) \
             .join(t_wf, t_wf.idfeature == t_f.idfeature) \
             .filter(t_fs.idmodel==self.idmodel) \
-            .filter(t_wf.idfeature.in_(features)) \
-            .order_by(t_wf.idwidget.asc(), t_wf.idfeature.asc())
-        
-        feature_index = dict(zip(features, range(len(features))))
-        prev_widget = None
-        widget_vector = [None for x in xrange(len(features))]
-        for p in q:
-            if (prev_widget is None):
-                prev_widget = p.idwidget
-            elif(prev_widget != p.idwidget):
-                yield prev_widget, widget_vector
-                prev_widget = p.idwidget
+            .filter(t_wf.idfeature.in_(features))
+        if widgets is not None:
+            sq = widgets.subquery('t')
+            q = q.join(sq, sq.c.idwidget == t_wf.idwidget)
+        return q
+
+    def iterate_predictions_matrix(self, features, widgets=None, batch_size=65536, stream=False, dtype=np.float32):
+        """Yields (idwidget array, matrix) for batch_size widgets at a time
+
+        Columns follow the order of features, and missing predictions are nan.
+        widgets is an optional query of idwidgets to restrict the rows to.
+        """
+        features = np.asarray(features, dtype=np.int64)
+        encode_features = build_id_encoder(features)
+
+        q = self._query_predictions(features.tolist(), widgets=widgets) \
+            .order_by(schema.widget_feature.idwidget.asc(), schema.widget_feature.idfeature.asc())
+        batches = iterate_batches(self.session, q, 3, batch_size=max(batch_size, 65536), stream=stream)
+        for rows in group_rows(batches, batch_size):
+            starts = group_starts(rows[:, 0])
+            matrix = np.full((np.count_nonzero(starts), len(features)), np.nan, dtype=dtype)
+            matrix[np.cumsum(starts) - 1, encode_features(rows[:, 1].astype(np.int64))] = rows[:, 2]
+            yield rows[starts, 0].astype(np.int64), matrix
+
+    def get_predictions_matrix(self, features, widgets=None, path=None, batch_size=65536, stream=False):
+        """Returns the predictions of features as (idwidget array, float32 matrix)
+
+        With path set, the matrix is written to a .npy file there and returned
+        memory mapped, so it can be larger than memory.
+        """
+        from sqlalchemy.sql.expression import func, distinct
 
-            widget_vector[feature_index[p.idfeature]] = p.value
+        chunks = self.iterate_predictions_matrix(features, widgets=widgets, batch_size=batch_size, stream=stream)
+        if path is None:
+            chunks = list(chunks)
+            if len(chunks) == 0:
+                return np.zeros(0, dtype=np.int64), np.zeros((0, len(features)), dtype=np.float32)
+            return np.concatenate([w for w, X in chunks]), np.vstack([X for w, X in chunks])
 
-        if prev_widget is not None:
-            yield prev_widget, widget_vector
+        t_wf = schema.widget_feature
+        num_widgets = self._query_predictions(features, widgets=widgets) \
+            .with_entities(func.count(distinct(t_wf.idwidget))).scalar()
+        idwidgets = np.zeros(num_widgets, dtype=np.int64)
+        matrix = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(num_widgets, len(features)))
+        pos = 0
+        for widget_chunk, chunk in chunks:
+            if pos + len(widget_chunk) > num_widgets:
+                raise RuntimeError("Predictions changed while they were being read")
+            idwidgets[pos:pos + len(widget_chunk)] = widget_chunk
+            matrix[pos:pos + len(widget_chunk)] = chunk
+            pos += len(widget_chunk)
+        matrix.flush()
+        return idwidgets[:pos], matrix[:pos]
+
+    def get_predictions(self, features):
+        for widget_chunk, chunk in self.iterate_predictions_matrix(features, dtype=np.float64):
+            for idwidget, row in itertools.izip(widget_chunk.tolist(), chunk.tolist()):
+                yield idwidget, [None if np.isnan(x) else x for x in row]
 
     @property
     def status(self):
@@ -697,11 +1043,20 @@ class Model(object):
         t_alg = schema.algorithm
         return self.session.query(t_alg.name).filter_by(idalgorithm=self.idalgorithm).one()[0]
 
+    def _load_package(self):
+        if self._dbinst.package_hash is not None:
+            from .ObjectStore import ABCObjectStore
+            t_os = schema.object_store
+            name = self.session.query(t_os.name).filter_by(idobject_store=self._dbinst.idobject_store).one()[0]
+            return load_package(ABCObjectStore.open(self.session, name), self._dbinst.package_hash)
+        return pickle.loads(base64.b64decode(self._dbinst.trained_package))
+
     @property
     def package(self):
-        return pickle.loads(base64.b64decode(self._dbinst.trained_package))
+        return model_cache.get(self, "package", self._load_package)
 
     @property
     def hyperparameters(self):
-        return pickle.loads(base64.b64decode(self._dbinst.hyperparameters))
+        return model_cache.get(self, "hyperparameters", lambda: pickle.loads(base64.b64decode(self._dbinst.hyperparameters)))
 
+model_cache = ModelCache()
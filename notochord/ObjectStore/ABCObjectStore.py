@@ -1,11 +1,65 @@
 from .. import export, schema, lookup, persist, lookup_or_persist
 from ..schema import object_store as t_ds
+import hashlib
 import json
 from abc import abstractmethod, ABCMeta
 import urlparse
 
 __all__ = []
 
+@export
+class WriteBatchError(Exception):
+    "Raised by WriteBatch.flush() with the uuids whose puts failed"
+    def __init__(self, failures):
+        super(WriteBatchError, self).__init__("{} object(s) failed to write: {}".format(
+            len(failures),
+            ", ".join("{}: {}".format(k, v) for k, v in sorted(failures.iteritems())[:5])
+        ))
+        self.failures = failures
+
+@export
+class WriteBatch(object):
+    """Groups puts so that backends can overlap and commit them together
+
+    flush() waits until every put so far has been written (and synced when
+    the batch was opened with fsync=True).  Puts may run asynchronously, so
+    a put never raises; flush() raises a WriteBatchError mapping the uuid of
+    each failed put to its exception once every other put is written.  The
+    batch stays usable after a flush, and leaving the context flushes it.
+    """
+    def __init__(self, store, fsync=False):
+        self.store = store
+        self.fsync = fsync
+        self.failures = {}
+
+    def put(self, uuid, content):
+        try:
+            self.store.put(uuid, content)
+        except Exception as e:
+            self.failures[uuid] = e
+
+    def flush(self):
+        self.store.flush()
+        self.raise_failures()
+
+    def raise_failures(self):
+        failures, self.failures = self.failures, {}
+        if len(failures) > 0:
+            raise WriteBatchError(failures)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.close()
+
 @export
 class ABCObjectStore(object):
     __metaclass__ = ABCMeta
@@ -30,9 +84,24 @@ class ABCObjectStore(object):
         raise NotImplementedError("Not Implemented: ABCObjectStore is an Abstract Base Class")
 
     @abstractmethod
-    def get(self, uuid):
+    def get(self, uuid, feature=None):
         raise NotImplementedError("Not Implemented: ABCObjectStore is an Abstract Base Class")
 
+    def get_many(self, uuids, feature=None):
+        #Backends that can overlap reads should override this
+        for uuid in uuids:
+            yield uuid, self.get(uuid, feature=feature)
+
+    def iterate(self, feature=None, order="physical"):
+        #Yields (uuid hex, value) for every stored object.  "physical" follows
+        #the on-disk layout for sequential reads; "uuid" sorts by uuid.
+        raise NotImplementedError("Not Implemented: {} does not support iteration".format(type(self).__name__))
+
+    def local_path(self, uuid):
+        #Path of a local file holding exactly the stored bytes of an object,
+        #so that it can be memory mapped, or None
+        return None
+
     @abstractmethod
     def post(self, uuid, content):
         raise NotImplementedError("Not Implemented: ABCObjectStore is an Abstract Base Class")
@@ -41,16 +110,62 @@ class ABCObjectStore(object):
     def put(self, uuid, content):
         raise NotImplementedError("Not Implemented: ABCObjectStore is an Abstract Base Class")
 
+    def write_batch(self, fsync=False):
+        return WriteBatch(self, fsync=fsync)
+
+    def put_many(self, items, fsync=False):
+        "Writes an iterable of (uuid, content) pairs as one batch"
+        with self.write_batch(fsync=fsync) as batch:
+            for uuid, content in items:
+                batch.put(uuid, content)
+
+    def put_if_absent(self, uuid, content):
+        #Returns whether the content was written
+        if self.exists(uuid):
+            return False
+        self.put(uuid, content)
+        return True
+
+    @staticmethod
+    def content_digest(content):
+        "Digest of an object's content, independent of the store's encoding"
+        if not isinstance(content, str):
+            content = json.dumps(content, sort_keys=True)
+        return hashlib.sha1(content).hexdigest()
+
+    def stored_digest(self, uuid):
+        #Backends that keep digests beside their objects should override this
+        if not self.exists(uuid):
+            return None
+        return self.content_digest(self.get(uuid))
+
+    def put_if_changed(self, uuid, content):
+        #Returns whether the content was written.  Unlike put_if_absent, an
+        #object whose content differs from what's stored is rewritten.
+        if self.stored_digest(uuid) == self.content_digest(content):
+            return False
+        self.put(uuid, content)
+        return True
+
     @abstractmethod
     def delete(self, uuid):
         raise NotImplementedError("Not Implemented: ABCObjectStore is an Abstract Base Class")
 
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def compact(self):
+        raise NotImplementedError("Not Implemented: {} does not support compaction".format(type(self).__name__))
+
     @staticmethod
     def create(session, name, uri, **kwargs):
         scheme = urlparse.urlparse(uri).scheme
         klass = ABCObjectStore.uri_schemes[scheme]
         ds = lookup_or_persist(session, t_ds, name=name, uri=uri, kwargs=json.dumps(kwargs))
-        ret = klass(ds, **kwargs)
+        ret = ABCObjectStore.build(klass, ds, kwargs)
         ret.initialize()
         return ret
 
@@ -59,7 +174,18 @@ class ABCObjectStore(object):
         ds = lookup(session, t_ds, name=name)
         u = urlparse.urlparse(ds.uri)
         klass = ABCObjectStore.uri_schemes[u.scheme]
-        return klass(ds, **json.loads(ds.kwargs))
+        return ABCObjectStore.build(klass, ds, json.loads(ds.kwargs))
+
+    @staticmethod
+    def build(klass, ds, kwargs):
+        #A "cache" entry in the kwargs wraps the store in a read-through cache
+        kwargs = dict(kwargs)
+        cache = kwargs.pop("cache", None)
+        ret = klass(ds, **kwargs)
+        if cache is not None:
+            from .CachedObjectStore import CachedObjectStore
+            ret = CachedObjectStore(ret, **cache)
+        return ret
 
     @staticmethod
     def register(uri_scheme):
@@ -0,0 +1,109 @@
+from .. import App, ABCArgumentGroup
+from .ABCObjectStore import ABCObjectStore
+from .compression import codecs, build_codec
+import sys
+import time
+
+def sample_objects(session, object_store, sample_size):
+    "Marshaled contents of up to `sample_size` objects referenced by the store's feature sets"
+    from ..schema import widget as t_w
+    from ..schema import widget_feature as t_wf
+    from ..schema import feature as t_f
+    from ..schema import feature_set as t_fs
+
+    q_w = session.query(t_w.uuid) \
+        .join(t_wf, t_wf.idwidget == t_w.idwidget) \
+        .join(t_f, t_f.idfeature == t_wf.idfeature) \
+        .join(t_fs, t_fs.idfeature_set == t_f.idfeature_set) \
+        .filter(t_fs.idobject_store == object_store.idobject_store) \
+        .distinct() \
+        .order_by(t_w.uuid) \
+        .limit(sample_size)
+
+    uuids = [uuid for uuid, in q_w]
+    return [object_store.marshal(content) for _, content in object_store.get_many(uuids)]
+
+def benchmark_codec(codec, samples):
+    start_time = time.time()
+    compressed = [codec.compress(x) for x in samples]
+    compress_time = time.time() - start_time
+
+    start_time = time.time()
+    for x in compressed:
+        codec.decompress(x)
+    decompress_time = time.time() - start_time
+
+    return sum(len(x) for x in compressed), compress_time, decompress_time
+
+class BenchmarkCompressionArgs(ABCArgumentGroup):
+    def __call__(self, group):
+        group.add_argument("object_store", type=unicode, action="store", metavar="NAME", default=None, nargs='?', help="Name of the object store")
+        group.add_argument("--codecs", type=str, action="store", metavar="NAME", default=None, nargs='+', help="Codecs to benchmark (default: all available)")
+        group.add_argument("--level", type=int, action="store", metavar="INT", default=None, help="Compression level")
+        group.add_argument("--sample-size", type=int, action="store", metavar="INT", default=None, help="Number of objects to sample")
+        group.add_argument("--dictionary-size", type=int, action="store", metavar="BYTES", default=None, help="Size of the zstd dictionary trained on half of the sample")
+
+class BenchmarkCompression(App):
+    @staticmethod
+    def build_parser_groups():
+        return [BenchmarkCompressionArgs()] + App.build_parser_groups()
+
+    def __init__(self, datadir, object_store=None, codecs=None, level=None, sample_size=None, dictionary_size=None, **kwargs):
+        super(BenchmarkCompression, self).__init__(datadir, **kwargs)
+        self.config['object_store'] = object_store or self.config.get('object_store')
+        self.config['codecs'] = codecs
+        self.config['level'] = level
+        self.config['sample_size'] = sample_size or 1000
+        self.config['dictionary_size'] = dictionary_size or 112640
+
+    def available_codecs(self):
+        names = self.config['codecs']
+        if names is None:
+            names = sorted(x for x in codecs if x is not None)
+
+        ret = []
+        for name in names:
+            try:
+                ret.append((name, build_codec(name, level=self.config['level'])))
+            except ImportError:
+                self.log.warning("Skipping codec '{}': module not installed".format(name))
+        return ret
+
+    def main(self):
+        with self.session_scope() as session:
+            object_store = ABCObjectStore.open(session, self.config['object_store'])
+            samples = sample_objects(session, object_store, self.config['sample_size'])
+
+        if len(samples) == 0:
+            raise ValueError("Object store '{}' has no objects to sample".format(self.config['object_store']))
+
+        results = []
+        available = self.available_codecs()
+        for name, codec in available:
+            results.append((name, samples) + benchmark_codec(codec, samples))
+
+        if 'zstd' in [name for name, _ in available] and len(samples) >= 2:
+            import zstandard
+            train, test = samples[::2], samples[1::2]
+            try:
+                dictionary = zstandard.train_dictionary(self.config['dictionary_size'], train).as_bytes()
+                codec = build_codec('zstd', level=self.config['level'], dictionary=dictionary)
+                results.append(('zstd+dict', test) + benchmark_codec(codec, test))
+                codec = build_codec('zstd', level=self.config['level'])
+                results.append(('zstd (dict holdout)', test) + benchmark_codec(codec, test))
+            except zstandard.ZstdError as e:
+                self.log.warning("Unable to train dictionary: {}".format(e))
+
+        for name, sample, compressed_bytes, compress_time, decompress_time in results:
+            raw_bytes = float(sum(len(x) for x in sample))
+            self.log.info("{:<20} ratio={:6.3f} compress={:9.2f}MB/s decompress={:9.2f}MB/s".format(
+                name,
+                raw_bytes / max(compressed_bytes, 1),
+                raw_bytes / 1e6 / max(compress_time, 1e-9),
+                raw_bytes / 1e6 / max(decompress_time, 1e-9)
+            ))
+
+        object_store.close()
+
+if __name__ == "__main__":
+    BenchmarkCompression.from_args(sys.argv[1:]).run()
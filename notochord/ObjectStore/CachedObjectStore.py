@@ -0,0 +1,302 @@
+from .. import export
+from .ABCObjectStore import ABCObjectStore, WriteBatch
+import collections
+import mmap
+import os
+import sys
+import tempfile
+import threading
+import uuid
+
+__all__ = []
+
+def value_size(value):
+    "Approximate number of bytes held by a decoded value"
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(value_size(k) + value_size(v) for k, v in value.iteritems())
+    elif isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(value_size(x) for x in value)
+    else:
+        return sys.getsizeof(value)
+
+class MmapTier(object):
+    "Ring buffer of marshaled values in an unlinked local file"
+    def __init__(self, num_bytes, directory=None, on_evict=None):
+        fd, path = tempfile.mkstemp(prefix="notochord-cache-", dir=directory)
+        try:
+            os.unlink(path)
+            os.ftruncate(fd, num_bytes)
+            self.data = mmap.mmap(fd, num_bytes)
+        finally:
+            os.close(fd)
+        self.num_bytes = num_bytes
+        self.pos = 0
+        #Insertion order is also offset order within each lap of the ring
+        self.entries = collections.OrderedDict()
+        self.evictions = 0
+        self.on_evict = on_evict
+
+    def get(self, key):
+        loc = self.entries.get(key)
+        if loc is None:
+            return None
+        offset, length = loc
+        return self.data[offset:offset + length]
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def put(self, key, payload):
+        length = len(payload)
+        if length > self.num_bytes:
+            return
+        self.entries.pop(key, None)
+
+        if self.pos + length > self.num_bytes:
+            #Anything left past the write position belongs to the previous lap
+            while self.entries and next(iter(self.entries.values()))[0] >= self.pos:
+                self._evict()
+            self.pos = 0
+
+        end = self.pos + length
+        while self.entries:
+            offset, _ = next(iter(self.entries.values()))
+            if offset < self.pos or offset >= end:
+                break
+            self._evict()
+
+        self.data[self.pos:end] = payload
+        self.entries[key] = (self.pos, length)
+        self.pos = end
+
+    def _evict(self):
+        key, _ = self.entries.popitem(last=False)
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(key)
+
+    def close(self):
+        self.entries.clear()
+        self.data.close()
+
+class CachedWriteBatch(WriteBatch):
+    def __init__(self, store, fsync=False):
+        super(CachedWriteBatch, self).__init__(store, fsync=fsync)
+        self.batch = store.backend.write_batch(fsync=fsync)
+
+    def put(self, item_uuid, content):
+        self.store.invalidate(item_uuid)
+        self.batch.put(item_uuid, content)
+
+    def flush(self):
+        self.batch.flush()
+
+    def close(self):
+        self.batch.close()
+
+@export
+class CachedObjectStore(ABCObjectStore):
+    """Read-through cache in front of another object store
+
+    Decoded values are kept in an LRU bounded by their approximate size in
+    bytes.  With mmap_bytes set, values evicted from memory are kept marshaled
+    in a local mmap ring buffer so they can be decoded again without touching
+    the backend.  Values are returned by reference and must not be mutated.
+    """
+    def __init__(self, backend, max_bytes=256*1024*1024, mmap_bytes=None, mmap_dir=None):
+        self.__dict__.update(dict(
+            uri = backend.uri,
+            name = backend.name,
+            idobject_store = backend.idobject_store,
+            backend = backend,
+            max_bytes = max_bytes,
+            _lock = threading.RLock(),
+            _entries = collections.OrderedDict(),
+            _features = {},
+            _tier = None,
+            _stats = dict(hits=0, misses=0, evictions=0, mmap_hits=0, bytes=0)
+        ))
+        if mmap_bytes:
+            self.__dict__['_tier'] = MmapTier(mmap_bytes, mmap_dir, on_evict=self._forget)
+
+    def __getattr__(self, name):
+        #Backend specific attributes such as prefix_path pass through
+        return getattr(self.__dict__['backend'], name)
+
+    def stats(self):
+        with self._lock:
+            ret = dict(self._stats, entries=len(self._entries))
+            if self._tier is not None:
+                ret.update(mmap_entries=len(self._tier.entries), mmap_evictions=self._tier.evictions)
+            return ret
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self._stats['hits'] += 1
+                return True, entry[0]
+
+            if self._tier is not None:
+                payload = self._tier.get(key)
+                if payload is not None:
+                    self._stats['mmap_hits'] += 1
+                    value = self.backend.unmarshal(payload)
+                    self._insert(key, value)
+                    return True, value
+
+            return False, None
+
+    def _insert(self, key, value):
+        size = value_size(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._stats['bytes'] -= old[1]
+            self._entries[key] = (value, size)
+            self._features.setdefault(key[0], set()).add(key[1])
+            self._stats['bytes'] += size
+
+            while self._stats['bytes'] > self.max_bytes:
+                old_key, (old_value, old_size) = self._entries.popitem(last=False)
+                self._stats['bytes'] -= old_size
+                self._stats['evictions'] += 1
+                if self._tier is not None:
+                    self._tier.put(old_key, self.backend.marshal(old_value))
+                self._forget(old_key)
+
+    def _forget(self, key):
+        if key in self._entries or (self._tier is not None and key in self._tier.entries):
+            return
+        features = self._features.get(key[0])
+        if features is not None:
+            features.discard(key[1])
+            if len(features) == 0:
+                del self._features[key[0]]
+
+    def _cached(self, key):
+        with self._lock:
+            for k in (key, (key[0], None)):
+                if k in self._entries or (self._tier is not None and k in self._tier.entries):
+                    return True
+            return False
+
+    def _find(self, key):
+        found, value = self._lookup(key)
+        if not found and key[1] is not None:
+            #A cached whole object can answer a single feature
+            found, value = self._lookup((key[0], None))
+            if found:
+                value = value[key[1]]
+        return found, value
+
+    def invalidate(self, item_uuid):
+        item_key = uuid.UUID(item_uuid).hex
+        with self._lock:
+            for feature in self._features.pop(item_key, ()):
+                entry = self._entries.pop((item_key, feature), None)
+                if entry is not None:
+                    self._stats['bytes'] -= entry[1]
+                if self._tier is not None:
+                    self._tier.discard((item_key, feature))
+
+    def initialize(self):
+        self.backend.initialize()
+
+    def exists(self, item_uuid):
+        item_key = uuid.UUID(item_uuid).hex
+        with self._lock:
+            if item_key in self._features:
+                return True
+        return self.backend.exists(item_uuid)
+
+    def get(self, item_uuid, feature=None):
+        key = (uuid.UUID(item_uuid).hex, feature)
+        found, value = self._find(key)
+        if found:
+            return value
+
+        with self._lock:
+            self._stats['misses'] += 1
+        value = self.backend.get(item_uuid, feature=feature)
+        self._insert(key, value)
+        return value
+
+    def get_many(self, item_uuids, feature=None):
+        item_uuids = list(item_uuids)
+        keys = [(uuid.UUID(u).hex, feature) for u in item_uuids]
+
+        cached = [self._cached(key) for key in keys]
+        misses = self.backend.get_many((u for u, hit in zip(item_uuids, cached) if not hit), feature=feature)
+
+        for item_uuid, key, hit in zip(item_uuids, keys, cached):
+            if hit:
+                found, value = self._find(key)
+                if found:
+                    yield item_uuid, value
+                    continue
+                #Evicted since the batch was planned
+                value = self.backend.get(item_uuid, feature=feature)
+            else:
+                _, value = next(misses)
+            with self._lock:
+                self._stats['misses'] += 1
+            self._insert(key, value)
+            yield item_uuid, value
+
+    def local_path(self, item_uuid):
+        return self.backend.local_path(item_uuid)
+
+    def iterate(self, feature=None, order="physical"):
+        #Full scans bypass the cache so they don't flush the hot set
+        return self.backend.iterate(feature=feature, order=order)
+
+    def put(self, item_uuid, content):
+        self.invalidate(item_uuid)
+        self.backend.put(item_uuid, content)
+
+    def write_batch(self, fsync=False):
+        return CachedWriteBatch(self, fsync=fsync)
+
+    def put_if_absent(self, item_uuid, content):
+        if self.backend.put_if_absent(item_uuid, content):
+            self.invalidate(item_uuid)
+            return True
+        return False
+
+    def stored_digest(self, item_uuid):
+        return self.backend.stored_digest(item_uuid)
+
+    def put_if_changed(self, item_uuid, content):
+        if self.backend.put_if_changed(item_uuid, content):
+            self.invalidate(item_uuid)
+            return True
+        return False
+
+    def post(self, item_uuid, value, feature=None):
+        self.invalidate(item_uuid)
+        self.backend.post(item_uuid, value, feature=feature)
+
+    def delete(self, item_uuid):
+        self.invalidate(item_uuid)
+        self.backend.delete(item_uuid)
+
+    def flush(self):
+        self.backend.flush()
+
+    def close(self):
+        self.backend.close()
+        with self._lock:
+            self._entries.clear()
+            self._features.clear()
+            self._stats['bytes'] = 0
+            if self._tier is not None:
+                self._tier.close()
+                self.__dict__['_tier'] = None
+
+    def compact(self):
+        return self.backend.compact()
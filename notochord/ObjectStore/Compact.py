@@ -0,0 +1,28 @@
+from .. import App, ABCArgumentGroup
+from .ABCObjectStore import ABCObjectStore
+import sys
+
+class CompactObjectStoreArgs(ABCArgumentGroup):
+    def __call__(self, group):
+        group.add_argument("object_store", type=unicode, action="store", metavar="NAME", default=None, nargs='?', help="Name of the object store")
+
+class CompactObjectStore(App):
+    @staticmethod
+    def build_parser_groups():
+        return [CompactObjectStoreArgs()] + App.build_parser_groups()
+
+    def __init__(self, datadir, object_store=None, **kwargs):
+        super(CompactObjectStore, self).__init__(datadir, **kwargs)
+        self.config['object_store'] = object_store or self.config['object_store']
+
+    def main(self):
+        with self.session_scope() as session:
+            object_store = ABCObjectStore.open(session, self.config['object_store'])
+
+        self.log.info("Compacting object store '{}'".format(self.config['object_store']))
+        reclaimed = object_store.compact()
+        object_store.close()
+        self.log.info("Reclaimed {} bytes".format(reclaimed))
+
+if __name__ == "__main__":
+    CompactObjectStore.from_args(sys.argv[1:]).run()
@@ -1,53 +1,204 @@
-from .. import export
-from .ABCObjectStore import ABCObjectStore
+from .. import export, pipelined_map
+from .ABCObjectStore import ABCObjectStore, WriteBatch
+from .compression import MultiCodec, DictionaryDirectory
+from .bloom import PersistentBloomFilter
+import collections
+import errno
+import itertools
 import json
 import os
 import posixpath
+import re
+import shutil
 import urllib, urlparse
 import uuid
 
 __all__ = []
 
+re_hex = re.compile(r'^[0-9a-f]+$')
+
+def build_compression(prefix_path, compression, level=None, dictionary=None):
+    dictionaries = DictionaryDirectory(posixpath.join(prefix_path, ".dictionaries"))
+    data = None if dictionary is None else dictionaries.load(dictionary)
+    return MultiCodec(compression, level=level, dictionary=data, dictionaries=dictionaries)
+
+def build_marshal(marshal):
+    if marshal == "json":
+        return json.dumps, json.loads
+    elif marshal is None or marshal == "raw":
+        return (lambda x: x), (lambda x: x)
+    else:
+        raise NotImplementedError("Marshaling scheme '{}' not implemented".format(marshal))
+
+def feature2filename(feature):
+    ret = urllib.quote(feature.encode('utf-8'), safe='')
+    if ret.startswith('.'):
+        ret = '%2E' + ret[1:]
+    return ret
+
+def filename2feature(filename):
+    return urllib.unquote(filename).decode('utf-8')
+
+def remove_if_exists(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def read_file(codec, unmarshal, path):
+    with open(path, 'rb') as fin:
+        return unmarshal(codec.decompress(fin.read()))
+
+def write_file(codec, marshal, path, content):
+    #Content that fails to encode doesn't truncate the existing file
+    data = codec.compress(marshal(content))
+    with open(path, 'wb') as fout:
+        fout.write(data)
+
+def read_split(codec, unmarshal, path, feature):
+    #Each top-level feature lives in its own file under the object's directory
+    if feature is None:
+        if not os.path.isdir(path):
+            raise IOError(errno.ENOENT, "No such object", path)
+        return dict(
+            (filename2feature(x), read_file(codec, unmarshal, posixpath.join(path, x)))
+            for x in os.listdir(path)
+        )
+
+    try:
+        return read_file(codec, unmarshal, posixpath.join(path, feature2filename(feature)))
+    except IOError as e:
+        if e.errno == errno.ENOENT and os.path.isdir(path):
+            raise KeyError(feature)
+        raise
+
+worker_codecs = {}
+
+def read_object(args):
+    #Module level so that it can be shipped to a process pool
+    codec_args, marshal, path, feature, split_features = args
+    codec = worker_codecs.get(codec_args)
+    if codec is None:
+        codec = worker_codecs[codec_args] = build_compression(*codec_args)
+    unmarshal = build_marshal(marshal)[1]
+
+    if split_features:
+        return read_split(codec, unmarshal, path, feature)
+
+    ret = read_file(codec, unmarshal, path)
+
+    if feature is None:
+        return ret
+    else:
+        return ret[feature]
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class FileWriteBatch(WriteBatch):
+    """Writes through the store's writer pool
+
+    With fsync, each object's files are synced by the writer that wrote them
+    and their directories once per flush.
+    """
+    def __init__(self, store, fsync=False):
+        super(FileWriteBatch, self).__init__(store, fsync=fsync)
+        self.pool = store.get_pool("writer")
+        self.pending = collections.deque()
+        self.depth = 4 * store.num_writers
+        self.dirs = set()
+
+    def write(self, item_uuid, content):
+        self.store.put(item_uuid, content)
+        if self.fsync:
+            self.store.sync_object(item_uuid)
+
+    def put(self, item_uuid, content):
+        self.pending.append((item_uuid, self.pool.apply_async(self.write, (item_uuid, content))))
+        if len(self.pending) >= self.depth:
+            self.wait(*self.pending.popleft())
+
+    def wait(self, item_uuid, result):
+        try:
+            result.get()
+        except Exception as e:
+            self.failures[item_uuid] = e
+            return
+        if self.fsync:
+            #Every directory that may have gained an entry
+            path_parts = self.store.uuid2pathparts(item_uuid)
+            for it in xrange(len(path_parts)):
+                self.dirs.add(posixpath.join(self.store.prefix_path, *path_parts[:it]))
+
+    def flush(self):
+        while self.pending:
+            self.wait(*self.pending.popleft())
+        for dirpath in sorted(self.dirs, reverse=True):
+            fsync_path(dirpath)
+        self.dirs.clear()
+        self.store.flush()
+        self.raise_failures()
+
+    def close(self):
+        #Let writes from an abandoned batch land before returning
+        for item_uuid, result in self.pending:
+            result.wait()
+        self.pending.clear()
+
 @export
 @ABCObjectStore.register("file")
 class FileStore(ABCObjectStore):
-    def __init__(self, ds, directory_layout=[2,2], compression=None, marshal="json"):
+    def __init__(self, ds, directory_layout=[2,2], compression=None, compression_level=None, compression_dictionary=None, marshal="json", num_readers=4, reader_pool="thread", num_writers=4, split_features=False, bloom_capacity=None, bloom_error_rate=0.01, content_digests=False):
         super(FileStore, self).__init__(ds)
 
         assert(all([isinstance(x, int) for x in directory_layout]))
 
-        if compression is None:
-            openfunc = open
-        elif compression == "gzip":
-            import gzip
-            openfunc = gzip.open
-        elif compression == "bz2":
-            from contextlib import closing
-            import bz2
-            openfunc = lambda path, mode: closing(bz2.BZ2File(path, mode))
-        else:
-            raise NotImplementedError("Compression scheme '{}' not implemented".format(compression))
-
-        if marshal == "json":
-            marshal = json.dumps
-            unmarshal = json.loads
-        elif marshal is None or marshal == "raw":
-            marshal = lambda x: x
-            unmarshal = lambda x: x
-        else:
-            raise NotImplementedError("Marshaling scheme '{}' not implemented".format(compression))
+        if reader_pool not in ("thread", "process"):
+            raise NotImplementedError("Reader pool '{}' not implemented".format(reader_pool))
 
         url_parts = urlparse.urlparse(ds.uri)
         assert url_parts.scheme in (u"file", None, "")
 
+        codec_args = (url_parts.path, compression, compression_level, compression_dictionary)
+        codec = build_compression(*codec_args)
+        marshal_name = marshal
+        marshal, unmarshal = build_marshal(marshal)
+
         self.__dict__.update(dict(
             prefix_path = url_parts.path,
             directory_layout = directory_layout,
-            openfunc = openfunc,
+            compression = compression,
+            compression_level = compression_level,
+            compression_dictionary = compression_dictionary,
+            codec_args = codec_args,
+            codec = codec,
+            marshal_name = marshal_name,
             marshal = marshal,
-            unmarshal = unmarshal
+            unmarshal = unmarshal,
+            num_readers = num_readers,
+            reader_pool = reader_pool,
+            num_writers = num_writers,
+            split_features = split_features,
+            bloom = None,
+            content_digests = content_digests,
+            _pools = {},
+            _dirs = set()
         ))
 
+        if bloom_capacity is not None:
+            #Answers negative exists() calls without touching the filesystem
+            self.__dict__['bloom'] = PersistentBloomFilter(
+                posixpath.join(self.prefix_path, ".bloom"),
+                bloom_capacity,
+                error_rate = bloom_error_rate,
+                rebuild = lambda: (uuid.UUID(x).bytes for x in self.walk())
+            )
+
     def initialize(self):
         if not os.path.exists(self.prefix_path):
             os.mkdir(self.prefix_path)
@@ -68,45 +219,255 @@ class FileStore(ABCObjectStore):
         return posixpath.join(self.prefix_path, *self.uuid2pathparts(item_uuid))
 
     def exists(self, item_uuid):
+        if self.bloom is not None and uuid.UUID(item_uuid).bytes not in self.bloom:
+            return False
         return os.path.exists(self.uuid2path(item_uuid))
 
+    def digest_path(self, item_uuid):
+        return self.uuid2path(item_uuid) + ".digest"
+
+    def stored_digest(self, item_uuid):
+        if self.content_digests:
+            try:
+                with open(self.digest_path(item_uuid), 'rb') as fin:
+                    return fin.read()
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        #Objects written before digests were enabled are read back instead
+        return super(FileStore, self).stored_digest(item_uuid)
+
     def get(self, item_uuid, feature=None):
-        with self.openfunc(self.uuid2path(item_uuid), 'rb') as fin:
-            ret = self.unmarshal(fin.read())
+        if self.split_features:
+            return read_split(self.codec, self.unmarshal, self.uuid2path(item_uuid), feature)
+
+        ret = read_file(self.codec, self.unmarshal, self.uuid2path(item_uuid))
 
         if feature is None:
             return ret
         else:
             return ret[feature]
 
+    def local_path(self, item_uuid):
+        if self.compression is not None or self.marshal_name not in (None, "raw") or self.split_features:
+            return None
+        path = self.uuid2path(item_uuid)
+        return path if os.path.isfile(path) else None
+
+    def sync_object(self, item_uuid):
+        "Syncs the files of an object, but not the directories holding them"
+        path = self.uuid2path(item_uuid)
+        if self.split_features:
+            for filename in os.listdir(path):
+                fsync_path(posixpath.join(path, filename))
+        fsync_path(path)
+        if self.content_digests:
+            fsync_path(path + ".digest")
+
+    def get_pool(self, kind="reader"):
+        #Pools don't survive a fork, so they are keyed by pid
+        pid = os.getpid()
+        pools = self._pools.get(pid)
+        if pools is None:
+            for stale_pid, stale in self._pools.items():
+                self.close_pools(stale, owned=False)
+            self._pools.clear()
+            pools = self._pools[pid] = {}
+
+        pool = pools.get(kind)
+        if pool is None:
+            if kind == "reader" and self.reader_pool == "process":
+                from multiprocessing import Pool
+                pool = Pool(self.num_readers)
+            else:
+                from multiprocessing.pool import ThreadPool
+                pool = ThreadPool(self.num_readers if kind == "reader" else self.num_writers)
+            pools[kind] = pool
+        return pool
+
+    @staticmethod
+    def close_pools(pools, owned=True):
+        """Shuts down a pid's pools
+
+        Readers are terminated since their results are disposable, while
+        writers are closed and joined so that queued writes land.  Pools
+        inherited through a fork are only torn down when they're thread
+        pools: their threads never ran in this process, but terminating an
+        inherited process pool would kill the parent's workers.
+        """
+        from multiprocessing.pool import ThreadPool
+        for kind, pool in pools.items():
+            if not owned and not isinstance(pool, ThreadPool):
+                continue
+            if kind == "writer" and owned:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+        pools.clear()
+
+    def close(self):
+        super(FileStore, self).close()
+        pools = self._pools.pop(os.getpid(), None)
+        if pools is not None:
+            self.close_pools(pools)
+
+    def get_many(self, item_uuids, feature=None):
+        if self.num_readers is None or self.num_readers <= 1:
+            for ret in super(FileStore, self).get_many(item_uuids, feature=feature):
+                yield ret
+            return
+
+        #The tee only buffers as far ahead as the pipeline depth
+        item_uuids, task_uuids = itertools.tee(item_uuids)
+        if self.reader_pool == "process":
+            func = read_object
+            tasks = ((self.codec_args, self.marshal_name, self.uuid2path(u), feature, self.split_features) for u in task_uuids)
+        else:
+            func = lambda u: self.get(u, feature=feature)
+            tasks = task_uuids
+
+        values = pipelined_map(self.get_pool(), func, tasks, 4 * self.num_readers)
+        for item_uuid, value in itertools.izip(item_uuids, values):
+            yield item_uuid, value
+
+    def walk(self, order="physical"):
+        "Yields the uuid of every stored object by walking the directory tree"
+        if order not in ("physical", "uuid"):
+            raise NotImplementedError("Iteration order '{}' not implemented".format(order))
+
+        lengths = list(self.directory_layout) + [32 - sum(self.directory_layout)]
+
+        def listdir(path, length):
+            #Skips anything that isn't part of the layout, such as .dictionaries
+            names = [x for x in os.listdir(path) if len(x) == length and re_hex.match(x)]
+            if order == "physical":
+                #Inode order approximates on-disk order on most filesystems
+                names.sort(key=lambda x: os.lstat(posixpath.join(path, x)).st_ino)
+            else:
+                names.sort()
+            return names
+
+        def recurse(path, prefix, depth):
+            for name in listdir(path, lengths[depth]):
+                if depth == len(lengths) - 1:
+                    yield prefix + name
+                else:
+                    for ret in recurse(posixpath.join(path, name), prefix + name, depth + 1):
+                        yield ret
+
+        if not os.path.isdir(self.prefix_path):
+            return iter([])
+        return recurse(self.prefix_path, "", 0)
+
+    def iterate(self, feature=None, order="physical"):
+        return self.get_many(self.walk(order), feature=feature)
+
+    def makedirs(self, dirpath):
+        #Directories known to exist are remembered to skip the stat
+        if dirpath in self._dirs:
+            return
+        try:
+            os.makedirs(dirpath)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._dirs.add(dirpath)
+
     def put(self, item_uuid, content):
         path_parts = [self.prefix_path] + self.uuid2pathparts(item_uuid)
 
         dirpath = posixpath.join(*path_parts[:-1])
-        if not os.path.exists(dirpath):
-            os.makedirs(dirpath)
+        self.makedirs(dirpath)
 
         path = posixpath.join(*path_parts)
-        with self.openfunc(path, 'wb') as fout:
-            fout.write(self.marshal(content))
+        if self.split_features:
+            write_object = lambda: self.put_split(path, content)
+        else:
+            write_object = lambda: write_file(self.codec, self.marshal, path, content)
+
+        if self.content_digests:
+            #A digest is never left beside content it doesn't describe: it's
+            #removed first and only rewritten once the object is
+            def write():
+                remove_if_exists(path + ".digest")
+                write_object()
+                with open(path + ".digest", 'wb') as fout:
+                    fout.write(self.content_digest(content))
+        else:
+            write = write_object
+
+        try:
+            write()
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            #The directory was pruned by a delete in another process
+            self._dirs.discard(dirpath)
+            self.makedirs(dirpath)
+            write()
+
+        if self.bloom is not None:
+            self.bloom.add(uuid.UUID(item_uuid).bytes)
+
+    def put_split(self, path, content):
+        if not isinstance(content, dict):
+            raise ValueError("FileStore with split_features requires dict content")
+
+        if not os.path.exists(path):
+            os.mkdir(path)
+
+        filenames = set()
+        for feature, value in content.iteritems():
+            filename = feature2filename(feature)
+            filenames.add(filename)
+            write_file(self.codec, self.marshal, posixpath.join(path, filename), value)
+
+        for filename in os.listdir(path):
+            if filename not in filenames:
+                os.remove(posixpath.join(path, filename))
 
     def post(self, item_uuid, value, feature=None):
         path = self.uuid2path(item_uuid)
-        with self.openfunc(path, 'rb') as fin:
-            ret = self.unmarshal(fin.read())
+        if self.content_digests:
+            #The object no longer matches its digest, so it's read back instead
+            remove_if_exists(path + ".digest")
+        if self.split_features:
+            #Only the posted feature is rewritten
+            if not os.path.isdir(path):
+                raise IOError(errno.ENOENT, "No such object", path)
+            write_file(self.codec, self.marshal, posixpath.join(path, feature2filename(feature)), value)
+            return
+
+        ret = read_file(self.codec, self.unmarshal, path)
         ret[feature] = value
-        with self.openfunc(path, 'wb') as fout:
-            fout.write(self.marshal(ret))
+        write_file(self.codec, self.marshal, path, ret)
+
+    def write_batch(self, fsync=False):
+        if self.num_writers is None or self.num_writers <= 1:
+            return super(FileStore, self).write_batch(fsync=fsync)
+        return FileWriteBatch(self, fsync=fsync)
+
+    def flush(self):
+        if self.bloom is not None:
+            self.bloom.save()
 
     def delete(self, item_uuid):
         path_parts = [self.prefix_path] + self.uuid2pathparts(item_uuid)
 
         path = posixpath.join(*path_parts)
-        os.remove(path)
+        if self.content_digests:
+            remove_if_exists(path + ".digest")
+        if self.split_features:
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
 
         for itparts in reversed(xrange(2, len(path_parts))):
+            dirpath = posixpath.join(*path_parts[:itparts])
             try:
-                os.rmdir(posixpath.join(*path_parts[:itparts]))
+                os.rmdir(dirpath)
             except OSError:
                 break
+            self._dirs.discard(dirpath)
 
@@ -0,0 +1,352 @@
+from .. import export
+from .ABCObjectStore import ABCObjectStore, WriteBatch
+from .FileStore import build_marshal, build_compression
+import errno
+import mmap
+import os
+import posixpath
+import re
+import struct
+import threading
+import urlparse
+import uuid
+import zlib
+
+__all__ = []
+
+#Every record is a header followed by its payload.  Deletes are recorded as
+#tombstones so that a segment scan can rebuild the index on its own.
+record_header = struct.Struct("<16sBII")
+FLAG_PUT = 0
+FLAG_DELETE = 1
+
+index_magic = "NCSEGIX1"
+index_header = struct.Struct("<8sII")
+index_segment = struct.Struct("<IQ")
+index_entry = struct.Struct("<16sQ")
+
+re_segment = re.compile(r'^segment-(\d{8})\.dat$')
+
+#Index values pack the segment number and record offset into a single int
+OFFSET_BITS = 40
+OFFSET_MASK = (1 << OFFSET_BITS) - 1
+
+class SegmentWriteBatch(WriteBatch):
+    "Appends without flushing so that a batch is committed with one write"
+    def put(self, item_uuid, content):
+        try:
+            self.store.put(item_uuid, content, commit=False)
+        except Exception as e:
+            self.failures[item_uuid] = e
+
+    def flush(self):
+        if self.fsync:
+            self.store.flush()
+        else:
+            self.store.commit()
+        self.raise_failures()
+
+@export
+@ABCObjectStore.register("segment")
+class SegmentStore(ABCObjectStore):
+    def __init__(self, ds, compression=None, compression_level=None, compression_dictionary=None, marshal="json", max_segment_bytes=1<<30):
+        super(SegmentStore, self).__init__(ds)
+
+        url_parts = urlparse.urlparse(ds.uri)
+        assert url_parts.scheme == "segment"
+
+        codec = build_compression(url_parts.path, compression, compression_level, compression_dictionary)
+        marshal_name = marshal
+        marshal, unmarshal = build_marshal(marshal)
+
+        self.__dict__.update(dict(
+            prefix_path = url_parts.path,
+            compression = compression,
+            codec = codec,
+            marshal_name = marshal_name,
+            marshal = marshal,
+            unmarshal = unmarshal,
+            max_segment_bytes = max_segment_bytes,
+            _lock = threading.RLock(),
+            _state = dict(index=None, base=0, segments=[], writer=None, maps={})
+        ))
+
+    def initialize(self):
+        if not os.path.exists(self.prefix_path):
+            os.mkdir(self.prefix_path)
+
+    def segment_path(self, segment):
+        return posixpath.join(self.prefix_path, "segment-{:08d}.dat".format(segment))
+
+    @property
+    def index_path(self):
+        return posixpath.join(self.prefix_path, "index")
+
+    def _index(self):
+        index = self._state['index']
+        if index is None:
+            with self._lock:
+                if self._state['index'] is None:
+                    self._load()
+                index = self._state['index']
+        return index
+
+    def _load(self):
+        self.initialize()
+        segments = sorted(
+            int(m.group(1)) for m in (re_segment.match(x) for x in os.listdir(self.prefix_path)) if m is not None
+        )
+
+        index, base, scanned = self._read_snapshot(segments)
+
+        #Segments below base were superseded by a compaction that was
+        #interrupted before it could remove them
+        for segment in segments:
+            if segment < base:
+                os.remove(self.segment_path(segment))
+        segments = [x for x in segments if x >= base]
+
+        for segment in segments:
+            self._scan(index, segment, scanned.get(segment, 0), last=(segment == segments[-1]))
+
+        self._state.update(dict(index=index, base=base, segments=segments))
+
+    def _read_snapshot(self, segments):
+        if not os.path.exists(self.index_path):
+            return {}, 0, {}
+
+        with open(self.index_path, 'rb') as fin:
+            data = fin.read()
+
+        magic, base, num_segments = index_header.unpack_from(data, 0)
+        if magic != index_magic:
+            return {}, 0, {}
+
+        pos = index_header.size
+        scanned = {}
+        for _ in xrange(num_segments):
+            segment, size = index_segment.unpack_from(data, pos)
+            pos += index_segment.size
+            path = self.segment_path(segment)
+            if not os.path.exists(path) or os.path.getsize(path) < size:
+                #The snapshot doesn't describe the segments on disk
+                return {}, 0, {}
+            scanned[segment] = size
+
+        index = {}
+        for pos in xrange(pos, len(data), index_entry.size):
+            key, loc = index_entry.unpack_from(data, pos)
+            index[key] = loc
+
+        return index, base, scanned
+
+    def _write_snapshot(self):
+        index = self._state['index']
+        segments = self._state['segments']
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'wb') as fout:
+            fout.write(index_header.pack(index_magic, self._state['base'], len(segments)))
+            for segment in segments:
+                fout.write(index_segment.pack(segment, os.path.getsize(self.segment_path(segment))))
+            for key, loc in index.iteritems():
+                fout.write(index_entry.pack(key, loc))
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.rename(tmp_path, self.index_path)
+
+    def _scan(self, index, segment, start, last):
+        path = self.segment_path(segment)
+        size = os.path.getsize(path)
+        if size <= start:
+            return
+
+        with open(path, 'rb') as fin:
+            data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+        pos = start
+        try:
+            while pos < size:
+                end = pos + record_header.size
+                valid = end <= size
+                if valid:
+                    key, flag, length, crc = record_header.unpack_from(data, pos)
+                    valid = end + length <= size and zlib.crc32(data[end:end + length]) & 0xffffffff == crc
+
+                if not valid:
+                    if not last:
+                        raise IOError(errno.EIO, "Corrupt record in segment", path)
+                    break
+
+                if flag == FLAG_PUT:
+                    index[key] = (segment << OFFSET_BITS) | pos
+                else:
+                    index.pop(key, None)
+                pos = end + length
+        finally:
+            data.close()
+
+        if pos < size:
+            #A torn write at the tail of the active segment
+            with open(path, 'r+b') as fout:
+                fout.truncate(pos)
+
+    def _view(self, segment, end):
+        maps = self._state['maps']
+        m = maps.get(segment)
+        if m is None or len(m) < end:
+            writer = self._state['writer']
+            if writer is not None and writer[0] == segment:
+                with self._lock:
+                    writer[1].flush()
+            with open(self.segment_path(segment), 'rb') as fin:
+                m = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+            maps[segment] = m
+        return m
+
+    def _read(self, loc):
+        segment, pos = loc >> OFFSET_BITS, loc & OFFSET_MASK
+        end = pos + record_header.size
+        m = self._view(segment, end)
+        length = record_header.unpack_from(m, pos)[2]
+        if len(m) < end + length:
+            m = self._view(segment, end + length)
+        return m[end:end + length]
+
+    def _append(self, key, flag, payload, commit=True):
+        with self._lock:
+            writer = self._state['writer']
+            if writer is None or writer[1].tell() >= self.max_segment_bytes:
+                writer = self._roll()
+
+            segment, fout = writer
+            pos = fout.tell()
+            fout.write(record_header.pack(key, flag, len(payload), zlib.crc32(payload) & 0xffffffff))
+            fout.write(payload)
+            if commit:
+                fout.flush()
+            return (segment << OFFSET_BITS) | pos
+
+    def _roll(self):
+        segments = self._state['segments']
+        writer = self._state['writer']
+        if writer is not None:
+            writer[1].close()
+
+        if writer is None and len(segments) > 0 and os.path.getsize(self.segment_path(segments[-1])) < self.max_segment_bytes:
+            segment = segments[-1]
+        else:
+            segment = max(segments + [self._state['base'] - 1]) + 1
+            segments.append(segment)
+
+        fout = open(self.segment_path(segment), 'ab')
+        fout.seek(0, os.SEEK_END)
+        writer = (segment, fout)
+        self._state['writer'] = writer
+        return writer
+
+    def exists(self, item_uuid):
+        return uuid.UUID(item_uuid).bytes in self._index()
+
+    def get(self, item_uuid, feature=None):
+        loc = self._index().get(uuid.UUID(item_uuid).bytes)
+        if loc is None:
+            raise IOError(errno.ENOENT, "No such object", item_uuid)
+
+        ret = self.unmarshal(self.codec.decompress(self._read(loc)))
+
+        if feature is None:
+            return ret
+        else:
+            return ret[feature]
+
+    def iterate(self, feature=None, order="physical"):
+        if order == "physical":
+            sort_key = lambda x: x[1]
+        elif order == "uuid":
+            sort_key = lambda x: x[0]
+        else:
+            raise NotImplementedError("Iteration order '{}' not implemented".format(order))
+
+        with self._lock:
+            entries = sorted(self._index().iteritems(), key=sort_key)
+
+        for key, loc in entries:
+            ret = self.unmarshal(self.codec.decompress(self._read(loc)))
+            yield uuid.UUID(bytes=key).hex, (ret if feature is None else ret[feature])
+
+    def put(self, item_uuid, content, commit=True):
+        key = uuid.UUID(item_uuid).bytes
+        index = self._index()
+        payload = self.codec.compress(self.marshal(content))
+        with self._lock:
+            index[key] = self._append(key, FLAG_PUT, payload, commit=commit)
+
+    def write_batch(self, fsync=False):
+        return SegmentWriteBatch(self, fsync=fsync)
+
+    def commit(self):
+        with self._lock:
+            writer = self._state['writer']
+            if writer is not None:
+                writer[1].flush()
+
+    def post(self, item_uuid, value, feature=None):
+        with self._lock:
+            ret = self.get(item_uuid)
+            ret[feature] = value
+            self.put(item_uuid, ret)
+
+    def delete(self, item_uuid):
+        key = uuid.UUID(item_uuid).bytes
+        index = self._index()
+        with self._lock:
+            if key not in index:
+                raise OSError(errno.ENOENT, "No such object", item_uuid)
+            self._append(key, FLAG_DELETE, "")
+            del index[key]
+
+    def flush(self):
+        with self._lock:
+            self._index()
+            self.commit()
+            writer = self._state['writer']
+            if writer is not None:
+                os.fsync(writer[1].fileno())
+            self._write_snapshot()
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            writer = self._state['writer']
+            if writer is not None:
+                writer[1].close()
+            self._state.update(dict(index=None, writer=None, maps={}))
+
+    def compact(self):
+        with self._lock:
+            index = self._index()
+            old_segments = list(self._state['segments'])
+            size_before = sum(os.path.getsize(self.segment_path(x)) for x in old_segments)
+
+            writer = self._state['writer']
+            if writer is not None:
+                writer[1].close()
+
+            base = max(old_segments + [self._state['base'] - 1]) + 1
+            self._state.update(dict(base=base, segments=[], writer=None))
+
+            #Copy live records in physical order so that reads stay sequential
+            for key, loc in sorted(index.iteritems(), key=lambda x: x[1]):
+                index[key] = self._append(key, FLAG_PUT, self._read(loc))
+
+            if self._state['writer'] is None:
+                self._roll()
+            self.flush()
+
+            self._state['maps'] = {}
+            for segment in old_segments:
+                os.remove(self.segment_path(segment))
+
+            size_after = sum(os.path.getsize(self.segment_path(x)) for x in self._state['segments'])
+            return size_before - size_after
+
@@ -0,0 +1,55 @@
+from .. import App, ABCArgumentGroup
+from .ABCObjectStore import ABCObjectStore
+from .Benchmark import sample_objects
+from .compression import DictionaryDirectory, import_codec_module
+import json
+import posixpath
+import sys
+
+class TrainCompressionDictionaryArgs(ABCArgumentGroup):
+    def __call__(self, group):
+        group.add_argument("object_store", type=unicode, action="store", metavar="NAME", default=None, nargs='?', help="Name of the object store")
+        group.add_argument("--sample-size", type=int, action="store", metavar="INT", default=None, help="Number of objects to train on")
+        group.add_argument("--dictionary-size", type=int, action="store", metavar="BYTES", default=None, help="Size of the trained dictionary")
+        group.add_argument("--level", type=int, action="store", metavar="INT", default=None, help="Compression level for new objects")
+
+class TrainCompressionDictionary(App):
+    @staticmethod
+    def build_parser_groups():
+        return [TrainCompressionDictionaryArgs()] + App.build_parser_groups()
+
+    def __init__(self, datadir, object_store=None, sample_size=None, dictionary_size=None, level=None, **kwargs):
+        super(TrainCompressionDictionary, self).__init__(datadir, **kwargs)
+        self.config['object_store'] = object_store or self.config.get('object_store')
+        self.config['sample_size'] = sample_size or 1000
+        self.config['dictionary_size'] = dictionary_size or 112640
+        self.config['level'] = level
+
+    def main(self):
+        zstandard = import_codec_module("zstandard", "zstandard", "zstd")
+        from ..schema import object_store as t_os
+
+        with self.session_scope() as session:
+            object_store = ABCObjectStore.open(session, self.config['object_store'])
+            samples = sample_objects(session, object_store, self.config['sample_size'])
+            self.log.info("Training {} byte dictionary on {} objects".format(self.config['dictionary_size'], len(samples)))
+            dictionary = zstandard.train_dictionary(self.config['dictionary_size'], samples)
+
+            #The dictionary is too large for the kwargs column, so it is saved
+            #beside the objects and referenced by id.  Objects already written
+            #remain readable because every frame records its codec and dictionary.
+            dictionaries = DictionaryDirectory(posixpath.join(object_store.prefix_path, ".dictionaries"))
+            path = dictionaries.save(dictionary.dict_id(), dictionary.as_bytes())
+            self.log.info("Saved dictionary {} to '{}'".format(dictionary.dict_id(), path))
+
+            row = session.query(t_os).filter_by(idobject_store=object_store.idobject_store).one()
+            kwargs = json.loads(row.kwargs)
+            kwargs.update(compression="zstd", compression_dictionary=dictionary.dict_id())
+            if self.config['level'] is not None:
+                kwargs['compression_level'] = self.config['level']
+            row.kwargs = json.dumps(kwargs)
+
+        object_store.close()
+
+if __name__ == "__main__":
+    TrainCompressionDictionary.from_args(sys.argv[1:]).run()
@@ -1,2 +1,6 @@
+from .compression import *
+from .bloom import *
 from .ABCObjectStore import *
 from .FileStore import *
+from .SegmentStore import *
+from .CachedObjectStore import *
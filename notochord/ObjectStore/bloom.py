@@ -0,0 +1,173 @@
+from .. import export
+import fcntl
+import hashlib
+import math
+import os
+import struct
+import threading
+
+__all__ = []
+
+bloom_magic = "NCBLOOM1"
+bloom_header = struct.Struct("<8sQIQQ")
+
+@export
+class BloomFilter(object):
+    "Fixed size Bloom filter over uuid bytes using double hashing"
+    def __init__(self, num_bits, num_hashes, capacity, bits=None, count=0):
+        num_bits = max(8, (num_bits + 7) // 8 * 8)
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.capacity = capacity
+        self.bits = bytearray(num_bits // 8) if bits is None else bytearray(bits)
+        self.count = count
+        assert len(self.bits) * 8 == num_bits
+
+    @classmethod
+    def for_capacity(klass, capacity, error_rate=0.01):
+        capacity = max(1, capacity)
+        num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        num_hashes = max(1, int(round(float(num_bits) / capacity * math.log(2))))
+        return klass(num_bits, num_hashes, capacity)
+
+    def positions(self, key):
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(key).digest())
+        h2 |= 1
+        return [(h1 + it * h2) % self.num_bits for it in xrange(self.num_hashes)]
+
+    def add(self, key):
+        bits = self.bits
+        added = False
+        for pos in self.positions(key):
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                bits[pos >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(key))
+
+    def update(self, other):
+        if (other.num_bits, other.num_hashes) != (self.num_bits, self.num_hashes):
+            raise ValueError("Bloom filters have different shapes")
+        for it, byte in enumerate(other.bits):
+            self.bits[it] |= byte
+        #Estimate the number of distinct keys from the fraction of set bits
+        ones = sum(bin(x).count("1") for x in self.bits)
+        if ones >= self.num_bits:
+            self.count = self.capacity * 2 + 1
+        else:
+            self.count = int(round(-float(self.num_bits) / self.num_hashes * math.log(1.0 - float(ones) / self.num_bits)))
+
+    def dumps(self):
+        return bloom_header.pack(bloom_magic, self.num_bits, self.num_hashes, self.capacity, self.count) + str(self.bits)
+
+    @classmethod
+    def loads(klass, data):
+        magic, num_bits, num_hashes, capacity, count = bloom_header.unpack_from(data, 0)
+        if magic != bloom_magic or len(data) != bloom_header.size + num_bits // 8:
+            raise ValueError("Not a bloom filter")
+        return klass(num_bits, num_hashes, capacity, bits=data[bloom_header.size:], count=count)
+
+@export
+class PersistentBloomFilter(object):
+    """Bloom filter saved beside an object store
+
+    Saving merges with whatever other processes saved since this one loaded,
+    under an exclusive lock, so concurrent writers never lose each other's
+    keys.  Until a writer saves, other processes may see false negatives for
+    the keys it added.
+    """
+    def __init__(self, path, capacity, error_rate=0.01, rebuild=None):
+        self.path = path
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rebuild = rebuild
+        self.bloom = None
+        self.dirty = False
+        self.mutex = threading.RLock()
+
+    def _lock(self):
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def _unlock(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def _read(self):
+        try:
+            with open(self.path, 'rb') as fin:
+                return BloomFilter.loads(fin.read())
+        except (IOError, ValueError, struct.error):
+            return None
+
+    def _write(self, bloom):
+        with open(self.path + ".tmp", 'wb') as fout:
+            fout.write(bloom.dumps())
+        os.rename(self.path + ".tmp", self.path)
+
+    def _build(self, keys):
+        keys = list(keys)
+        bloom = BloomFilter.for_capacity(max(self.capacity, 2 * len(keys)), self.error_rate)
+        for key in keys:
+            bloom.add(key)
+        return bloom
+
+    def load(self):
+        with self.mutex:
+            if self.bloom is None:
+                self.bloom = self._load()
+            return self.bloom
+
+    def _load(self):
+        fd = self._lock()
+        try:
+            bloom = self._read()
+            if bloom is None:
+                #Built once from a scan of the store
+                bloom = self._build(self.rebuild() if self.rebuild is not None else [])
+                self._write(bloom)
+        finally:
+            self._unlock(fd)
+        return bloom
+
+    def add(self, key):
+        with self.mutex:
+            if self.load().add(key):
+                self.dirty = True
+
+    def __contains__(self, key):
+        return key in self.load()
+
+    def save(self):
+        with self.mutex:
+            if self.bloom is None or not self.dirty:
+                return
+            self._save()
+
+    def _save(self):
+        fd = self._lock()
+        try:
+            bloom = self.bloom
+            on_disk = self._read()
+            resize = False
+            if on_disk is not None:
+                try:
+                    bloom.update(on_disk)
+                except ValueError:
+                    #Another process resized the filter since it was loaded
+                    resize = True
+            if (resize or bloom.count > bloom.capacity) and self.rebuild is not None:
+                #Overfull filters lose their negatives, so resize from a scan
+                bloom = self._build(self.rebuild())
+            self._write(bloom)
+            self.bloom = bloom
+            self.dirty = False
+        finally:
+            self._unlock(fd)
@@ -0,0 +1,196 @@
+from .. import export
+import os
+import posixpath
+import threading
+import zlib
+
+__all__ = []
+
+codecs = {}
+
+@export
+def register_codec(name):
+    def decorator_register(klass):
+        codecs[name] = klass
+        klass.name = name
+        return klass
+
+    return decorator_register
+
+@export
+def build_codec(compression, level=None, dictionary=None, dictionaries=None):
+    klass = codecs.get(compression)
+    if klass is None:
+        raise NotImplementedError("Compression scheme '{}' not implemented".format(compression))
+    return klass(level=level, dictionary=dictionary, dictionaries=dictionaries)
+
+@export
+def detect_codec(data):
+    for name, klass in codecs.iteritems():
+        if klass.magic is not None and data.startswith(klass.magic):
+            return name
+    return None
+
+@export
+class Codec(object):
+    magic = None
+    default_level = None
+
+    def __init__(self, level=None, dictionary=None, dictionaries=None):
+        if dictionary is not None:
+            raise ValueError("Compression scheme '{}' does not support dictionaries".format(self.name))
+        self.level = self.default_level if level is None else level
+
+    def compress(self, data):
+        raise NotImplementedError("Codec is abstract")
+
+    def decompress(self, data):
+        raise NotImplementedError("Codec is abstract")
+
+@register_codec(None)
+class IdentityCodec(Codec):
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+@register_codec("gzip")
+class GzipCodec(Codec):
+    #Writes the same framing as gzip.open so existing stores stay readable
+    magic = "\x1f\x8b"
+    default_level = 9
+
+    def compress(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+@register_codec("bz2")
+class Bz2Codec(Codec):
+    magic = "BZh"
+    default_level = 9
+
+    def __init__(self, **kwargs):
+        super(Bz2Codec, self).__init__(**kwargs)
+        import bz2
+        self.bz2 = bz2
+
+    def compress(self, data):
+        return self.bz2.compress(data, self.level)
+
+    def decompress(self, data):
+        return self.bz2.decompress(data)
+
+def import_codec_module(name, package, compression):
+    "Imports a compression module, naming the package to install if it's missing"
+    import importlib
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        raise ImportError("Install {} to use compression={}".format(package, compression))
+
+@register_codec("zstd")
+class ZstdCodec(Codec):
+    magic = "\x28\xb5\x2f\xfd"
+    default_level = 3
+
+    def __init__(self, level=None, dictionary=None, dictionaries=None):
+        super(ZstdCodec, self).__init__(level=level)
+        zstandard = self.zstd = import_codec_module("zstandard", "zstandard", "zstd")
+        self.dictionary = None if dictionary is None else zstandard.ZstdCompressionDict(dictionary)
+        self.dictionaries = dictionaries
+        #zstandard (de)compressors must not be shared between threads
+        self.local = threading.local()
+
+    def compress(self, data):
+        compressor = getattr(self.local, "compressor", None)
+        if compressor is None:
+            if self.dictionary is None:
+                compressor = self.zstd.ZstdCompressor(level=self.level)
+            else:
+                compressor = self.zstd.ZstdCompressor(level=self.level, dict_data=self.dictionary)
+            self.local.compressor = compressor
+        return compressor.compress(data)
+
+    def decompress(self, data):
+        #Frames name the dictionary they were written with, so objects
+        #compressed under an older dictionary remain readable
+        dict_id = self.zstd.get_frame_parameters(data).dict_id
+        decompressors = getattr(self.local, "decompressors", None)
+        if decompressors is None:
+            decompressors = self.local.decompressors = {}
+
+        decompressor = decompressors.get(dict_id)
+        if decompressor is None:
+            if dict_id == 0:
+                decompressor = self.zstd.ZstdDecompressor()
+            elif self.dictionary is not None and self.dictionary.dict_id() == dict_id:
+                decompressor = self.zstd.ZstdDecompressor(dict_data=self.dictionary)
+            elif self.dictionaries is not None:
+                dictionary = self.zstd.ZstdCompressionDict(self.dictionaries.load(dict_id))
+                decompressor = self.zstd.ZstdDecompressor(dict_data=dictionary)
+            else:
+                raise ValueError("Missing compression dictionary {}".format(dict_id))
+            decompressors[dict_id] = decompressor
+        return decompressor.decompress(data)
+
+@register_codec("lz4")
+class Lz4Codec(Codec):
+    magic = "\x04\x22\x4d\x18"
+    default_level = 0
+
+    def __init__(self, **kwargs):
+        super(Lz4Codec, self).__init__(**kwargs)
+        self.lz4 = import_codec_module("lz4.frame", "lz4", "lz4")
+
+    def compress(self, data):
+        return self.lz4.compress(data, compression_level=self.level)
+
+    def decompress(self, data):
+        return self.lz4.decompress(data)
+
+@export
+class MultiCodec(object):
+    def __init__(self, compression, level=None, dictionary=None, dictionaries=None):
+        self.compression = compression
+        self.kwargs = dict(dictionaries=dictionaries)
+        self.codecs = {compression: build_codec(compression, level=level, dictionary=dictionary, dictionaries=dictionaries)}
+        self.compress = self.codecs[compression].compress
+
+    def decompress(self, data):
+        #Objects written before a change of compression scheme are still
+        #decoded with the codec that wrote them
+        codec = self.codecs[self.compression]
+        if self.compression is not None and (codec.magic is None or not data.startswith(codec.magic)):
+            name = detect_codec(data)
+            if name is None:
+                raise ValueError("Unrecognized compression format")
+            codec = self.codecs.get(name)
+            if codec is None:
+                codec = self.codecs[name] = build_codec(name, **self.kwargs)
+        return codec.decompress(data)
+
+@export
+class DictionaryDirectory(object):
+    def __init__(self, path):
+        self.path = path
+
+    def dictionary_path(self, dict_id):
+        return posixpath.join(self.path, "{}.zdict".format(int(dict_id)))
+
+    def load(self, dict_id):
+        with open(self.dictionary_path(dict_id), 'rb') as fin:
+            return fin.read()
+
+    def save(self, dict_id, data):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        path = self.dictionary_path(dict_id)
+        with open(path + ".tmp", 'wb') as fout:
+            fout.write(data)
+        os.rename(path + ".tmp", path)
+        return path
+
@@ -1,4 +1,4 @@
-from .. import App, schema, ABCArgumentGroup, ModelSet, Model, lookup, persist, CrossvalidationQuery
+from .. import App, schema, ABCArgumentGroup, ModelSet, Model, lookup, persist, CrossvalidationQuery, ABCObjectStore
 import sqlalchemy
 import sys
 import uuid
@@ -21,6 +21,7 @@ class RandomForestTrain(App):
 
         self.model_name = model_name or self.config['model_name']
         self.hyperparameters = self.config.get('hyperparameters', {})
+        self.package_store = self.config.get('package_store')
 
     def main(self):
         from sqlalchemy.sql.expression import select, func
@@ -29,6 +30,9 @@ class RandomForestTrain(App):
         s = self.get_session()
 
         model_set = ModelSet(s, name=self.model_name)
+        package_store = None
+        if self.package_store is not None:
+            package_store = ABCObjectStore.open(s, self.package_store)
         input_features = s.query(feature.idfeature).join(feature_set, feature_set.idfeature_set == feature.idfeature_set).filter_by(name="LSI(words)")
         output_features = s.query(feature.idfeature).join(feature_set, feature_set.idfeature_set == feature.idfeature_set).filter(feature_set.name=="datasource")
         train_widgets = s.query(widget_feature.idwidget) \
@@ -46,7 +50,7 @@ class RandomForestTrain(App):
                 for w_t, X_t, Y_t in m.get_training_data(train_set):
                     clf.fit(X_t, Y_t.ravel())
 
-                m.set_trained(clf)
+                m.set_trained(clf, object_store=package_store)
 
                 correct, total = 0, 0
                 for w_p, X_p, Y_p in m.get_validation_data(predict_set):
@@ -1,4 +1,5 @@
-from .. import App, schema, ABCArgumentGroup, ModelSet, Model, lookup, persist, lookup_or_persist, WorkOrderArgs, filter_widgets
+from .. import App, schema, ABCArgumentGroup, ModelSet, Model, MatrixCache, ABCObjectStore, lookup, persist, lookup_or_persist, WorkOrderArgs, filter_widgets, prune_features, document_frequency
+import os
 import sqlalchemy
 import sys
 import uuid
@@ -11,6 +12,9 @@ class LSITrainArgs(ABCArgumentGroup):
         group.add_argument("--n-components", type=int, action="store", metavar="INT", default=None, help="Number of n_components remaining")
         group.add_argument("--output-feature-set", type=unicode, action="store", metavar="NAME", default=None, help="Name of output feature set (required)")
         group.add_argument("--input-feature-set", type=unicode, action="store", metavar="NAME", default=None, help="Name of input feature set (required)")
+        group.add_argument("--min-df", type=document_frequency, action="store", metavar="NUM", default=None, help="Drop input features in fewer widgets than this count (5) or fraction (0.001, 1e-3)")
+        group.add_argument("--max-df", type=document_frequency, action="store", metavar="NUM", default=None, help="Drop input features in more widgets than this count (1000) or fraction (0.5, 1.0)")
+        group.add_argument("--max-features", type=int, action="store", metavar="INT", default=None, help="Keep only this many of the most frequent input features")
         group.add_argument("model_name", type=unicode, action="store", metavar="NAME", default=None, nargs='?', help="Name of the model_set")
 
 class LSITrain(App):
@@ -18,7 +22,7 @@ class LSITrain(App):
     def build_parser_groups():
         return [LSITrainArgs(), WorkOrderArgs()] + App.build_parser_groups()
 
-    def __init__(self, datadir, input_feature_set=None, output_feature_set=None, min_idwidget=None, max_idwidget=None, datasources=None, chunk_size=None, model_name=None, n_components=None, **kwargs):
+    def __init__(self, datadir, input_feature_set=None, output_feature_set=None, min_idwidget=None, max_idwidget=None, datasources=None, chunk_size=None, model_name=None, n_components=None, min_df=None, max_df=None, max_features=None, **kwargs):
         super(LSITrain, self).__init__(datadir, **kwargs)
         self.config['output_feature_set'] = output_feature_set or self.config['output_feature_set']
         self.config['input_feature_set'] = input_feature_set or self.config['input_feature_set']
@@ -26,6 +30,11 @@ class LSITrain(App):
         self.config['datasources'] = datasources or self.config.get('datasources')
         self.config['min_idwidget'] = (min_idwidget, None)[min_idwidget is None]
         self.config['max_idwidget'] = (max_idwidget, None)[max_idwidget is None]
+        self.config['min_df'] = min_df or self.config.get('min_df')
+        self.config['max_df'] = max_df or self.config.get('max_df')
+        self.config['max_features'] = max_features or self.config.get('max_features')
+        self.config['matrix_cache'] = self.config.get('matrix_cache')
+        self.config['package_store'] = self.config.get('package_store')
 
         self.hyperparameters = {}
         self.hyperparameters['n_components'] = n_components or self.config['hyperparameters']['n_components']
@@ -69,7 +78,30 @@ class LSITrain(App):
                     datasources = self.config['datasources']
                 )
 
-            model = model_set.new_model(svd, q_words, log=self.log)
+            self.log.info("Gathering selection of widgets")
+            all_widgets = session.query(t_w.idwidget)
+            all_widgets = filter_widgets(
+                    all_widgets,
+                    min_idwidget = self.config['min_idwidget'],
+                    max_idwidget = self.config['max_idwidget'],
+                    datasources = self.config['datasources']
+                )
+
+            q_words = prune_features(
+                    session, q_words, all_widgets,
+                    min_df = self.config['min_df'],
+                    max_df = self.config['max_df'],
+                    max_features = self.config['max_features'],
+                    log = self.log
+                )
+
+            matrix_cache = None
+            if self.config['matrix_cache'] is not None:
+                matrix_cache = MatrixCache(os.path.join(self.datadir, self.config['matrix_cache']))
+            package_store = None
+            if self.config['package_store'] is not None:
+                package_store = ABCObjectStore.open(session, self.config['package_store'])
+            model = model_set.new_model(svd, q_words, log=self.log, matrix_cache=matrix_cache)
 
             self.log.info("Creating output feature set associated with model")
             fs_lsi = lookup_or_persist(session, t_fs, name=self.config['output_feature_set'], idmodel=model.idmodel)
@@ -86,15 +118,6 @@ class LSITrain(App):
 
             model.select_predicts_features(q_lsi)
 
-            self.log.info("Gathering selection of widgets")
-            all_widgets = session.query(t_w.idwidget)
-            all_widgets = filter_widgets(
-                    all_widgets,
-                    min_idwidget = self.config['min_idwidget'],
-                    max_idwidget = self.config['max_idwidget'],
-                    datasources = self.config['datasources']
-                )
-
             self.log.info("Widget count: {}".format(all_widgets.count()))
             self.log.info("Input feature count: {}".format(q_words.count()))
             self.log.info("Output feature count: {}".format(q_lsi.count()))
@@ -102,7 +125,7 @@ class LSITrain(App):
             for w_t, X in model.get_training_data(all_widgets, sparse_inputs=True, supervised=False):
                 self.log.info("Training on feature matrix X with shape=({},{}) and nnz={}".format(X.shape[0], X.shape[1], X.nnz))
                 Y_hat = svd.fit_transform(X)
-                model.set_trained(svd)
+                model.set_trained(svd, object_store=package_store)
                 model.update_predictions(w_t, Y_hat)
         
 if __name__ == "__main__":
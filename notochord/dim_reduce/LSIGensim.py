@@ -1,4 +1,5 @@
-from .. import App, schema, ABCArgumentGroup, ModelSet, Model, lookup, persist, lookup_or_persist, WorkOrderArgs, filter_widgets
+from .. import App, schema, ABCArgumentGroup, ModelSet, Model, MatrixCache, ABCObjectStore, lookup, persist, lookup_or_persist, WorkOrderArgs, filter_widgets, prune_features, document_frequency
+import os
 import sqlalchemy
 import sys
 import uuid
@@ -12,6 +13,9 @@ class LSIGensimTrainArgs(ABCArgumentGroup):
         group.add_argument("--chunk-size", type=int, action="store", metavar="INT", default=None, help="Size of chunks to process")
         group.add_argument("--output-feature-set", type=unicode, action="store", metavar="NAME", default=None, help="Name of output feature set (required)")
         group.add_argument("--input-feature-set", type=unicode, action="store", metavar="NAME", default=None, help="Name of input feature set (required)")
+        group.add_argument("--min-df", type=document_frequency, action="store", metavar="NUM", default=None, help="Drop input features in fewer widgets than this count (5) or fraction (0.001, 1e-3)")
+        group.add_argument("--max-df", type=document_frequency, action="store", metavar="NUM", default=None, help="Drop input features in more widgets than this count (1000) or fraction (0.5, 1.0)")
+        group.add_argument("--max-features", type=int, action="store", metavar="INT", default=None, help="Keep only this many of the most frequent input features")
         group.add_argument("model_name", type=unicode, action="store", metavar="NAME", default=None, nargs='?', help="Name of the model_set")
 
 class LSIGensimTrain(App):
@@ -19,7 +23,7 @@ class LSIGensimTrain(App):
     def build_parser_groups():
         return [LSIGensimTrainArgs(), WorkOrderArgs()] + App.build_parser_groups()
 
-    def __init__(self, datadir, input_feature_set=None, output_feature_set=None, min_idwidget=None, max_idwidget=None, datasources=None, chunk_size=None, model_name=None, n_components=None, **kwargs):
+    def __init__(self, datadir, input_feature_set=None, output_feature_set=None, min_idwidget=None, max_idwidget=None, datasources=None, chunk_size=None, model_name=None, n_components=None, min_df=None, max_df=None, max_features=None, **kwargs):
         super(LSIGensimTrain, self).__init__(datadir, **kwargs)
         self.config['output_feature_set'] = output_feature_set or self.config['output_feature_set']
         self.config['input_feature_set'] = input_feature_set or self.config['input_feature_set']
@@ -28,6 +32,12 @@ class LSIGensimTrain(App):
         self.config['chunk_size'] = chunk_size or self.config.get('chunk_size')
         self.config['min_idwidget'] = (min_idwidget, None)[min_idwidget is None]
         self.config['max_idwidget'] = (max_idwidget, None)[max_idwidget is None]
+        self.config['min_df'] = min_df or self.config.get('min_df')
+        self.config['max_df'] = max_df or self.config.get('max_df')
+        self.config['max_features'] = max_features or self.config.get('max_features')
+        self.config['matrix_cache'] = self.config.get('matrix_cache')
+        self.config['package_store'] = self.config.get('package_store')
+        self.config['stream'] = self.config.get('stream', False)
 
         self.hyperparameters = {}
         self.hyperparameters['n_components'] = n_components or self.config['hyperparameters']['n_components']
@@ -48,6 +58,22 @@ class LSIGensimTrain(App):
                 .join(t_fs, t_fs.idfeature_set == t_f.idfeature_set) \
                 .filter(t_fs.name == self.config['input_feature_set'])
 
+            all_widgets = session.query(t_w.idwidget)
+            all_widgets = filter_widgets(
+                    all_widgets,
+                    min_idwidget = self.config['min_idwidget'],
+                    max_idwidget = self.config['max_idwidget'],
+                    datasources = self.config['datasources']
+                )
+
+            q_words = prune_features(
+                    session, q_words, all_widgets,
+                    min_df = self.config['min_df'],
+                    max_df = self.config['max_df'],
+                    max_features = self.config['max_features'],
+                    log = self.log
+                )
+
             self.log.info("Getting word decoder ring from database")
             words = dict(enumerate(q_words))
             self.log.info("number of words: {}".format(len(words)))
@@ -57,7 +83,13 @@ class LSIGensimTrain(App):
             n_components = self.hyperparameters['n_components']
             lsi = LsiModel(num_topics=self.hyperparameters['n_components'], id2word=words, onepass=True, extra_samples = n_components + 1, dtype=np.float32)
             self.log.info("Num Topics {}".format(lsi.num_topics))
-            model = model_set.new_model(lsi, q_words, params=self.hyperparameters, log=self.log)
+            matrix_cache = None
+            if self.config['matrix_cache'] is not None:
+                matrix_cache = MatrixCache(os.path.join(self.datadir, self.config['matrix_cache']))
+            package_store = None
+            if self.config['package_store'] is not None:
+                package_store = ABCObjectStore.open(session, self.config['package_store'])
+            model = model_set.new_model(lsi, q_words, params=self.hyperparameters, log=self.log, matrix_cache=matrix_cache)
 
             self.log.info("Creating output features")
             fs_lsi = lookup_or_persist(session, t_fs, name=self.config['output_feature_set'], idmodel=model.idmodel)
@@ -74,14 +106,6 @@ class LSIGensimTrain(App):
 
             model.select_predicts_features(q_lsi)
 
-            all_widgets = session.query(t_w.idwidget)
-            all_widgets = filter_widgets(
-                    all_widgets,
-                    min_idwidget = self.config['min_idwidget'],
-                    max_idwidget = self.config['max_idwidget'],
-                    datasources = self.config['datasources']
-                )
-
             self.log.info("Counting stuff")
             num_widgets = all_widgets.count()
             self.log.info("Widget count: {}".format(num_widgets))
@@ -90,11 +114,12 @@ class LSIGensimTrain(App):
             self.log.info("Output feature count: {}".format(q_lsi.count()))
 
             chunk_size = self.config['chunk_size']
-            for w_t, X in model.get_training_data(all_widgets, sparse_inputs=True, supervised=False, batch_size=chunk_size):
+            #Training issues no other queries, so its rows can be streamed
+            for w_t, X in model.get_training_data(all_widgets, sparse_inputs=True, supervised=False, batch_size=chunk_size, stream=self.config['stream']):
                 self.log.info("Training on feature matrix X with shape=({},{}) and nnz={}".format(X.shape[0], X.shape[1], X.nnz))
                 lsi.add_documents(X.T)
 
-            model.set_trained(lsi)
+            model.set_trained(lsi, object_store=package_store)
 
             for w_t, X in model.get_predict_data(all_widgets, sparse_inputs=True, supervised=False, batch_size=chunk_size):
                 Y_hat = []
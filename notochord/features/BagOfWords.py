@@ -1,8 +1,12 @@
-from .. import schema, App, QueryCache, batcher, grouper, insert_ignore, export, lookup, persist, lookup_or_persist, ABCArgumentGroup, WorkOrderArgs, filter_widgets, temptable_scope, FeatureCache
+from .. import schema, App, QueryCache, batcher, grouper, insert_ignore, export, lookup, persist, lookup_or_persist, ABCArgumentGroup, WorkOrderArgs, filter_widgets, FeatureCache, PersistentFeatureCache, pipelined_map, bulk_load
 from ..ObjectStore import ABCObjectStore
+from ..tokenize.BatchTokenizer import BatchTokenizer, re_word
 from sqlalchemy import Column, Integer, String, Float, ForeignKey, UnicodeText, Unicode, LargeBinary, Boolean, Index
 import collections
 import csv
+import itertools
+import json
+import numpy as np
 import os
 import re
 import sqlalchemy
@@ -10,18 +14,36 @@ import sys
 import tempfile
 import time
 import stat
-from sklearn.feature_extraction.text import CountVectorizer
-
-re_word = re.compile(r'[a-zA-Z]+')
 
 __all__ = []
 
+#Per-process state for tokenizer workers, set by init_tokenizer
+tokenizer_state = {}
+
+def init_tokenizer(object_store, feature, hash_buckets=None, analyzer=None):
+    tokenizer_state.update(object_store=object_store, feature=feature, tokenizer=BatchTokenizer.from_config(analyzer, hash_buckets=hash_buckets))
+
+def tokenize_chunk(rows):
+    "Reads and counts the words of a chunk of (idwidget, uuid) rows"
+    object_store = tokenizer_state['object_store']
+    contents = object_store.get_many((uuid for idwidget, uuid in rows), feature=tokenizer_state['feature'])
+    chunk = tokenizer_state['tokenizer'](content for _, content in contents)
+
+    #Word ids index the chunk's vocab, which is shipped once per chunk, or
+    #are bucket numbers when hashing
+    widgets = np.repeat(np.array([idwidget for idwidget, uuid in rows], dtype=np.int64), np.diff(chunk.indptr))
+    return len(rows), widgets, chunk.vocab, chunk.word_ids, chunk.counts.astype(np.float64)
+
 class BagOfWordsArgs(ABCArgumentGroup):
     def __call__(self, group):
         group.add_argument("--output-feature-set", type=unicode, action="store", metavar="NAME", default=None, help="Name of output feature set (required)")
         group.add_argument("--input-feature-set", type=unicode, action="store", metavar="NAME", default=None, help="Name of input feature set (required)")
         group.add_argument("--input-feature", type=unicode, action="store", metavar="NAME", default=None, help="Name of input feature")
         group.add_argument("--chunk-size", type=int, action="store", metavar="INT", default=None, help="Number or widgets per chunk")
+        group.add_argument("--workers", type=int, action="store", metavar="INT", default=None, help="Number of tokenizer processes")
+        group.add_argument("--incremental", action="store_true", default=None, help="Only process widgets without features in the output feature set")
+        group.add_argument("--hash-buckets", type=int, action="store", metavar="INT", default=None, help="Hash words into this many features instead of one feature per word")
+        group.add_argument("--feature-cache", type=str, action="store", metavar="PATH", default=None, help="Directory of persistent feature id caches, relative to the datadir")
 
 @export
 class BagOfWords(App):
@@ -29,13 +51,20 @@ class BagOfWords(App):
     def build_parser_groups():
         return [BagOfWordsArgs(), WorkOrderArgs()] + App.build_parser_groups()
 
-    def __init__(self, datadir, input_feature_set=None, output_feature_set=None, input_feature=None, min_idwidget=None, max_idwidget=None, datasources=None, chunk_size=None, **kwargs):
+    def __init__(self, datadir, input_feature_set=None, output_feature_set=None, input_feature=None, min_idwidget=None, max_idwidget=None, datasources=None, chunk_size=None, workers=None, hash_buckets=None, incremental=None, feature_cache=None, **kwargs):
         super(BagOfWords, self).__init__(datadir, **kwargs)
         self.config['output_feature_set'] = output_feature_set or self.config['output_feature_set']
         self.config['input_feature_set'] = input_feature_set or self.config['input_feature_set']
         self.config['input_feature'] = input_feature or self.config.get('input_feature')
         self.config['datasources'] = datasources or self.config.get('datasources')
         self.config["chunk_size"] = chunk_size or self.config.get('chunk_size', 1024)
+        self.config["workers"] = workers or self.config.get('workers', 1)
+        self.config["hash_buckets"] = hash_buckets or self.config.get('hash_buckets')
+        self.config["incremental"] = incremental or self.config.get('incremental', False)
+        self.config["feature_cache"] = feature_cache or self.config.get('feature_cache')
+        self.config["analyzer"] = self.config.get('analyzer')
+        #Bad analyzer settings would otherwise only fail inside the workers
+        BatchTokenizer.from_config(self.config['analyzer'])
         self.config['min_idwidget'] = (min_idwidget, None)[min_idwidget is None]
         self.config['max_idwidget'] = (max_idwidget, None)[max_idwidget is None]
 
@@ -52,202 +81,220 @@ class BagOfWords(App):
         from ..schema import feature_set as t_fs
         from ..schema import datasource as t_ds
         from ..schema import object_store as t_os
+        from ..schema import feature_set_watermark as t_fsw
 
-        with self.session_scope() as session:
-            self.log.info("Preparing")
-            fs_in = lookup(session, t_fs, name=self.config['input_feature_set'])
-            if fs_in is None: raise KeyError("Invalid feature set: '{}'".format(self.config['input_feature_set']))
-
-            fs_out = lookup_or_persist(session, t_fs, name=self.config['output_feature_set'])
-            if fs_out is None: raise KeyError("Invalid feature set: '{}'".format(self.config['output_feature_set']))
-
-            os_in = lookup(session, t_os, idobject_store=fs_in.idobject_store)
-            if fs_in.idobject_store is None or os_in is None:
-                raise ValueError("Feature set '{}' has no associated object store".format(self.config['input_feature_set']))
-            else:
-                object_store = ABCObjectStore.open(session, os_in.name)
+        if self.config['feature_cache'] is not None:
+            FC = PersistentFeatureCache(os.path.join(self.datadir, self.config['feature_cache']), 1024*1024, log=self.log)
+        else:
+            FC = FeatureCache(1024*1024, log=self.log)
 
-            f_in = lookup(session, t_f, name=self.config['input_feature'], idfeature_set=fs_in.idfeature_set)
-            if f_in is None:
-                if self.config['input_feature'] is not None:
-                    raise KeyError("Invalid feature: '{}' for feature_set '{}'".format(self.config['input_feature'], self.config['input_feature_set']))
+        object_store = None
+        try:
+            with self.session_scope() as session:
+                self.log.info("Preparing")
+                fs_in = lookup(session, t_fs, name=self.config['input_feature_set'])
+                if fs_in is None: raise KeyError("Invalid feature set: '{}'".format(self.config['input_feature_set']))
+
+                fs_out = lookup_or_persist(session, t_fs, name=self.config['output_feature_set'])
+                if fs_out is None: raise KeyError("Invalid feature set: '{}'".format(self.config['output_feature_set']))
+
+                #Recorded so that documents can be tokenized the same way when
+                #they're scored, and so that one set isn't built two ways
+                tokenizer_kwargs = json.loads(json.dumps(dict(analyzer=self.config['analyzer'], hash_buckets=self.config['hash_buckets'])))
+                if fs_out.kwargs is None:
+                    fs_out.kwargs = unicode(json.dumps(tokenizer_kwargs, sort_keys=True))
+                elif json.loads(fs_out.kwargs) != tokenizer_kwargs:
+                    raise ValueError("Feature set '{}' was built with different settings: {}".format(self.config['output_feature_set'], fs_out.kwargs))
+
+                os_in = lookup(session, t_os, idobject_store=fs_in.idobject_store)
+                if fs_in.idobject_store is None or os_in is None:
+                    raise ValueError("Feature set '{}' has no associated object store".format(self.config['input_feature_set']))
                 else:
-                    raise KeyError("Invalid feature_set '{}' has no default feature".format(self.config['input_feature_set']))
-
-            q_w = session.query(t_w.idwidget)
-            q_w = filter_widgets(
-                q_w,
-                min_idwidget = self.config['min_idwidget'],
-                max_idwidget = self.config['max_idwidget'],
-                datasources = self.config['datasources']
-            )
-
-            q_wf = session.query(t_wf.idwidget, t_wf.idfeature) \
-                .join(t_w, t_w.idwidget == t_wf.idwidget) \
-                .join(t_f, t_f.idfeature == t_wf.idfeature) \
-                .filter(t_f.idfeature_set == fs_out.idfeature_set)
-
-            if self.config['min_idwidget'] is not None:
-                q_wf = q_wf.filter(t_w.idwidget >= self.config['min_idwidget'])
-            if self.config['max_idwidget'] is not None:
-                q_wf = q_wf.filter(t_w.idwidget < self.config['max_idwidget'])
-            if self.config['datasources'] is not None and len(self.config['datasources']) > 0:
-                q_wf = q_wf.join(t_ds, t_ds.iddatasource == t_w.iddatasource)
-                q_wf = q_wf.filter(t_ds.name.in_(self.config['datasources']))
-
-            self.log.info("Deleting old features")
-            #q_del = q_wf.delete()
-            #q_del = t_wf.__table__.delete() \
-            #    .where(tuple_(t_wf.idwidget, t_wf.idfeature).in_(q_wf))
-            #self.log.debug("Delete widget query: {}".format(q_del.compile(bind=session.bind)))
-            #session.execute(q_del)
+                    object_store = ABCObjectStore.open(session, os_in.name)
+
+                f_in = lookup(session, t_f, name=self.config['input_feature'], idfeature_set=fs_in.idfeature_set)
+                if f_in is None:
+                    if self.config['input_feature'] is not None:
+                        raise KeyError("Invalid feature: '{}' for feature_set '{}'".format(self.config['input_feature'], self.config['input_feature_set']))
+                    else:
+                        raise KeyError("Invalid feature_set '{}' has no default feature".format(self.config['input_feature_set']))
+
+                q_w = session.query(t_w.idwidget)
+                q_w = filter_widgets(
+                    q_w,
+                    min_idwidget = self.config['min_idwidget'],
+                    max_idwidget = self.config['max_idwidget'],
+                    datasources = self.config['datasources']
+                )
+
+                q_wf = session.query(t_wf.idwidget, t_wf.idfeature) \
+                    .join(t_w, t_w.idwidget == t_wf.idwidget) \
+                    .join(t_f, t_f.idfeature == t_wf.idfeature) \
+                    .filter(t_f.idfeature_set == fs_out.idfeature_set)
+
+                if self.config['min_idwidget'] is not None:
+                    q_wf = q_wf.filter(t_w.idwidget >= self.config['min_idwidget'])
+                if self.config['max_idwidget'] is not None:
+                    q_wf = q_wf.filter(t_w.idwidget < self.config['max_idwidget'])
+                if self.config['datasources'] is not None and len(self.config['datasources']) > 0:
+                    q_wf = q_wf.join(t_ds, t_ds.iddatasource == t_w.iddatasource)
+                    q_wf = q_wf.filter(t_ds.name.in_(self.config['datasources']))
+
+                self.log.info("Deleting old features")
+                #q_del = q_wf.delete()
+                #q_del = t_wf.__table__.delete() \
+                #    .where(tuple_(t_wf.idwidget, t_wf.idfeature).in_(q_wf))
+                #self.log.debug("Delete widget query: {}".format(q_del.compile(bind=session.bind)))
+                #session.execute(q_del)
             
-            q_w = session.query(t_w.idwidget, t_w.uuid)
-            q_w = filter_widgets(
-                q_w,
-                min_idwidget = self.config['min_idwidget'],
-                max_idwidget = self.config['max_idwidget'],
-                datasources = self.config['datasources']
-            )
+                q_w = session.query(t_w.idwidget, t_w.uuid, t_w.iddatasource)
+                q_w = filter_widgets(
+                    q_w,
+                    min_idwidget = self.config['min_idwidget'],
+                    max_idwidget = self.config['max_idwidget'],
+                    datasources = self.config['datasources']
+                )
             
-            q_w = q_w.join(t_wf, t_wf.idwidget == t_w.idwidget) \
-                .filter(t_wf.idfeature == f_in.idfeature)
-
-            class tmp_upload(schema.TableBase):
-                idtmp_upload = Column(t_f.idfeature.type, nullable=False, primary_key=True)
-                idwidget = Column(t_wf.idwidget.type, nullable=False)
-                idfeature = Column(t_wf.idfeature.type, nullable=False)
-                value = Column(t_wf.value.type, nullable=False)
-                __table_args__ = ({'prefixes':["TEMPORARY"]},)
-                __tablename__ = "tmp_upload"
-
-            class tmp_wf(schema.TableBase):
-                idwidget = Column(Integer, ForeignKey('widget.idwidget', onupdate='RESTRICT', ondelete='CASCADE'), primary_key=True, nullable=False)
-                idfeature = Column(Integer, ForeignKey('feature.idfeature', onupdate='RESTRICT', ondelete='CASCADE'), primary_key=True, nullable=False)
-                value = Column(Float, nullable=True)
-                __table_args__ = ({'prefixes':["TEMPORARY"]},)
-                __tablename__ = "tmp_widget_feature"
-
-            self.log.info("Beginning Execution")
-            self.log.debug("Widget query: {}".format(q_w.statement.compile(bind=session.bind)))
-            FC = FeatureCache(1024*1024, log=self.log)
+                q_w = q_w.join(t_wf, t_wf.idwidget == t_w.idwidget) \
+                    .filter(t_wf.idfeature == f_in.idfeature)
+
+                if self.config['incremental']:
+                    #Widgets at or below their datasource's watermark are complete,
+                    #so the anti-join only has to look at the range above it
+                    t_wf_out = sqlalchemy.orm.aliased(t_wf)
+                    t_f_out = sqlalchemy.orm.aliased(t_f)
+                    has_output = session.query(t_wf_out.idwidget) \
+                        .join(t_f_out, t_f_out.idfeature == t_wf_out.idfeature) \
+                        .filter(t_wf_out.idwidget == t_w.idwidget) \
+                        .filter(t_f_out.idfeature_set == fs_out.idfeature_set)
+                    q_w = q_w.outerjoin(t_fsw, (t_fsw.iddatasource == t_w.iddatasource) & (t_fsw.idfeature_set == fs_out.idfeature_set)) \
+                        .filter(t_w.idwidget > sqlalchemy.func.coalesce(t_fsw.idwidget, 0)) \
+                        .filter(~has_output.exists())
+
+                self.log.info("Beginning Execution")
+                self.log.debug("Widget query: {}".format(q_w.statement.compile(bind=session.bind)))
+
+                count_time = 0.0
+                feature_time = 0.0
+                upload_time = 0.0
+                num_widgets = 0
+                num_widget_features = 0
 
-            count_time = 0.0
-            feature_time = 0.0
-            widget_time = 0.0
-            upload_time = 0.0
-            primary_key_time = 0.0
-            num_widgets = 0
-            num_widget_features = 0
-
-            start_time = time.time()
-            if session.bind.dialect.name.lower() == 'mysql':
-                session.execute("SET @@foreign_key_checks=0;")
-                session.execute("ALTER TABLE widget_feature DISABLE KEYS;")
-                insert_fout, insert_file = tempfile.mkstemp()
-                os.close(insert_fout)
-                os.chmod(insert_file, stat.S_IREAD | stat.S_IWRITE | stat.S_IROTH)
-
-            begin_time = time.time()
-            for it, result_chunk in enumerate(grouper(q_w, self.config['chunk_size'])):
                 start_time = time.time()
-                self.log.info("Executing chunk {}".format(it))
-                upload_chunk = []
-                N = 0
-                words = []
-                widgets = []
-                values = []
-                for row in result_chunk:
-                    if row is not None:
-                        idwidget, uuid = row
-                        content = object_store.get(uuid, feature=f_in.name)
-                        if content is None:
-                            continue
-                        cnt = collections.Counter(x.group(0).lower() for x in re_word.finditer(content))
-                        words.extend(cnt.iterkeys())
-                        values.extend(cnt.itervalues())
-                        widgets.extend(idwidget for _ in xrange(len(cnt)))
-                        N += len(cnt)
-
-                end_time = time.time()
-                count_time += (end_time - start_time)
-                start_time = time.time()
-
-                self.log.info("Getting feature id's")
-                word_idents = FC(session, fs_out.idfeature_set, (w for w in words))
-                self.log.info("Copying into upload_chunk")
-                upload_chunk = [dict(idwidget=widgets[it], idfeature=word_idents[it], value=values[it]) for it in xrange(N)]
-                num_widget_features += len(upload_chunk)
+                if session.bind.dialect.name.lower() == 'mysql':
+                    session.execute("SET @@foreign_key_checks=0;")
+                    session.execute("ALTER TABLE widget_feature DISABLE KEYS;")
+
+                hash_buckets = self.config['hash_buckets']
+                if hash_buckets is not None:
+                    #Features for every bucket exist up front, named by bucket number
+                    self.log.info("Creating {} hashed features".format(hash_buckets))
+                    bucket_features = np.array(
+                        FeatureCache(hash_buckets, log=self.log)(session, fs_out.idfeature_set, (unicode(x) for x in xrange(hash_buckets))),
+                        dtype=np.int64
+                    )
+
+                #Highest widget tokenized per datasource, which bounds the watermark
+                tokenized_idwidget = {}
+                def iterate_chunks():
+                    for chunk in grouper(q_w, self.config['chunk_size']):
+                        rows = []
+                        for row in chunk:
+                            if row is None:
+                                continue
+                            idwidget, uuid, iddatasource = row
+                            rows.append((idwidget, uuid))
+                            tokenized_idwidget[iddatasource] = max(idwidget, tokenized_idwidget.get(iddatasource, idwidget))
+                        yield rows
+                chunks = iterate_chunks()
+                workers = self.config['workers']
+                if workers > 1:
+                    if getattr(object_store, 'reader_pool', None) == "process":
+                        raise ValueError("Tokenizer workers can't start process reader pools; use reader_pool 'thread'")
+                    from multiprocessing import Pool
+                    pool = Pool(workers, initializer=init_tokenizer, initargs=(object_store, f_in.name, hash_buckets, self.config['analyzer']))
+                    #Chunks are tokenized ahead while this process uploads
+                    tokenized = pipelined_map(pool, tokenize_chunk, chunks, 2 * workers)
+                else:
+                    pool = None
+                    init_tokenizer(object_store, f_in.name, hash_buckets, self.config['analyzer'])
+                    tokenized = itertools.imap(tokenize_chunk, chunks)
 
-                end_time = time.time()
-                feature_time += (end_time - start_time)
+                begin_time = time.time()
                 start_time = time.time()
-                dialect = session.bind.dialect.name
-
-                with temptable_scope(session, tmp_upload), temptable_scope(session, tmp_wf):
-                    self.log.info("Uploading widget_feature chunk of size: {}".format(len(upload_chunk)))
-                    session.bulk_insert_mappings(tmp_upload, upload_chunk)
-                    end_time = time.time()
-                    upload_time += (end_time - start_time)
-                    start_time = time.time()
-
-                    self.log.info("Constructing primary key")
-                    insert_stmt = insert_ignore(tmp_wf, dialect).from_select(
-                            [tmp_wf.idwidget, tmp_wf.idfeature, tmp_wf.value],
-                            session.query(tmp_upload.idwidget, tmp_upload.idfeature, tmp_upload.value) \
-                                .select_from(tmp_upload) \
-                        )
-                    session.execute(insert_stmt)
-
-                    end_time = time.time()
-                    primary_key_time += (end_time - start_time)
-                    start_time = time.time()
-
-                    if session.bind.dialect.name.lower() == 'mysql':
-                        with open(insert_file, 'w') as fout:
-                            csvout = csv.writer(fout, delimiter=',', escapechar='\\')
-                            for row in session.query(tmp_wf.idwidget, tmp_wf.idfeature, tmp_wf.value):
-                                csvout.writerow(tuple(row))
-                            del csvout
-
-                        self.log.info("Temp file size: {}".format(os.path.getsize(insert_file)))
-
-                        insert_stmt = sqlalchemy.text(r"""
-                            LOAD DATA CONCURRENT LOCAL INFILE '{insert_file}'
-                            IGNORE
-                            INTO TABLE widget_feature
-                            FIELDS TERMINATED BY ','
-                                OPTIONALLY ENCLOSED BY '"'
-                                ESCAPED BY '\\'
-                            LINES TERMINATED BY '\n'
-                            (idwidget, idfeature, value)
-                        """.format(insert_file=insert_file))
-                    else:
-                        insert_stmt = insert_ignore(t_wf, dialect).from_select(
-                                [t_wf.idwidget, t_wf.idfeature, t_wf.value],
-                                session.query(tmp_wf.idwidget, tmp_wf.idfeature, tmp_wf.value)
-                            )
-                    start_time = time.time()
-                    self.log.info("Transferring into place")
-                    session.execute(insert_stmt)
-
-                    end_time = time.time()
-                    widget_time += (end_time - start_time)
-
-                    num_widgets += len(result_chunk)
-
-                    self.log.info("Average Times: {} {} {} {} {} {}".format(count_time / num_widgets, feature_time / num_widgets, upload_time / num_widgets, primary_key_time / num_widgets, widget_time / num_widgets, num_widget_features / num_widgets))
-                    self.log.info("Average Rate: {}".format(num_widgets / (time.time() - begin_time)))
-                    self.log.info("Max Rate: {}".format(num_widgets / widget_time))
-
-
-            if session.bind.dialect.name.lower() == 'mysql':
-                session.execute("ALTER TABLE widget_feature ENABLE KEYS;")
-                session.execute("SET @@foreign_key_checks=1;")
-                os.remove(insert_file)
-
-            tmp_upload.metadata.remove(tmp_upload.__table__)
-            tmp_upload.metadata.remove(tmp_wf.__table__)
+                try:
+                    for it, (chunk_widgets, widgets, words, word_ids, values) in enumerate(tokenized):
+                        self.log.info("Executing chunk {}".format(it))
+
+                        end_time = time.time()
+                        count_time += (end_time - start_time)
+                        start_time = time.time()
+
+                        self.log.info("Getting feature id's")
+                        if hash_buckets is not None:
+                            word_idents = bucket_features
+                        else:
+                            word_idents = np.array(FC(session, fs_out.idfeature_set, words), dtype=np.int64)
+                        upload_chunk = itertools.izip(widgets.tolist(), word_idents[word_ids].tolist(), values.tolist())
+                        num_widget_features += len(widgets)
+
+                        end_time = time.time()
+                        feature_time += (end_time - start_time)
+                        start_time = time.time()
+
+                        #Word counts are unique per widget, so only rows from an
+                        #earlier run can conflict
+                        self.log.info("Uploading widget_feature chunk of size: {}".format(len(widgets)))
+                        bulk_load(session, t_wf, ["idwidget", "idfeature", "value"], upload_chunk, on_conflict="ignore")
+
+                        end_time = time.time()
+                        upload_time += (end_time - start_time)
+
+                        num_widgets += chunk_widgets
+
+                        self.log.info("Average Times: {} {} {} {}".format(count_time / num_widgets, feature_time / num_widgets, upload_time / num_widgets, num_widget_features / num_widgets))
+                        self.log.info("Average Rate: {}".format(num_widgets / (time.time() - begin_time)))
+                        self.log.info("Max Rate: {}".format(num_widgets / upload_time))
+
+                        start_time = time.time()
+                except:
+                    if pool is not None:
+                        #Workers may still be tokenizing ahead of the failed chunk
+                        pool.terminate()
+                        pool.join()
+                    raise
+
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+
+                if self.config['min_idwidget'] is None:
+                    #Every matching widget up to the last one tokenized now has its
+                    #features, unless the run skipped a range at the bottom.  Both
+                    #incremental runs and TermWeighting rely on this.  Widgets
+                    #past that one may still be uncommitted ingests, so max(idwidget)
+                    #at the start of the run isn't safe.
+                    for iddatasource, watermark in sorted(tokenized_idwidget.iteritems()):
+                        wm = lookup(session, t_fsw, idfeature_set=fs_out.idfeature_set, iddatasource=iddatasource)
+                        if wm is None:
+                            persist(session, t_fsw(idfeature_set=fs_out.idfeature_set, iddatasource=iddatasource, idwidget=watermark))
+                        elif wm.idwidget < watermark:
+                            wm.idwidget = watermark
+                        self.log.info("Advanced watermark of '{}' for datasource {} to {}".format(self.config['output_feature_set'], iddatasource, watermark))
+
+                if session.bind.dialect.name.lower() == 'mysql':
+                    session.execute("ALTER TABLE widget_feature ENABLE KEYS;")
+                    session.execute("SET @@foreign_key_checks=1;")
+
+            #Features resolved by a rolled back run may be renumbered, so the
+            #cache files only learn them once the transaction has committed
+            if isinstance(FC, PersistentFeatureCache):
+                FC.save()
+        finally:
+            if isinstance(FC, PersistentFeatureCache):
+                FC.close()
+            if object_store is not None:
+                object_store.close()
 
 if __name__ == "__main__":
     A = BagOfWords.from_args(sys.argv[1:])
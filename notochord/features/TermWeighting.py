@@ -0,0 +1,288 @@
+from .. import schema, App, export, lookup, persist, lookup_or_persist, ABCArgumentGroup, FeatureCache, bulk_load, batcher
+import itertools
+import json
+import numpy as np
+import sqlalchemy
+import sys
+import time
+
+__all__ = []
+
+def aggregate(idfeatures, values):
+    "Document count, total count and sum of x*log(x) of each feature"
+    ids, inverse = np.unique(idfeatures, return_inverse=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xlogx = np.where(values > 0, values * np.log(values), 0.0)
+    return (
+        ids,
+        np.bincount(inverse, minlength=len(ids)).astype(np.int64),
+        np.bincount(inverse, weights=values, minlength=len(ids)),
+        np.bincount(inverse, weights=xlogx, minlength=len(ids))
+    )
+
+def merge_statistics(a, b):
+    "Adds two sets of statistics from aggregate"
+    ids = np.concatenate([a[0], b[0]])
+    if len(ids) == 0:
+        return a
+    ids, inverse = np.unique(ids, return_inverse=True)
+    return (ids,) + tuple(
+        np.bincount(inverse, weights=np.concatenate([x, y]), minlength=len(ids)).astype(x.dtype)
+        for x, y in zip(a[1:], b[1:])
+    )
+
+@export
+def tfidf_weights(num_documents, document_count, total_count, entropy_sum):
+    "Smoothed inverse document frequency"
+    return np.log((1.0 + num_documents) / (1.0 + document_count)) + 1.0
+
+@export
+def log_entropy_weights(num_documents, document_count, total_count, entropy_sum):
+    "One minus the normalized entropy of each feature's distribution over documents"
+    if num_documents <= 1:
+        return np.ones(len(document_count))
+    #sum(p*log(p)) for p = x/total reduces to sum(x*log(x))/total - log(total)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        plogp = np.where(total_count > 0, entropy_sum / total_count - np.log(total_count), 0.0)
+    return 1.0 + plogp / np.log(num_documents)
+
+#Global weight of each feature and the local transform of its count
+weightings = {
+    "tfidf": (tfidf_weights, lambda x: x),
+    "logentropy": (log_entropy_weights, np.log1p)
+}
+
+class TermWeightingArgs(ABCArgumentGroup):
+    def __call__(self, group):
+        group.add_argument("--output-feature-set", type=unicode, action="store", metavar="NAME", default=None, help="Name of output feature set (required)")
+        group.add_argument("--input-feature-set", type=unicode, action="store", metavar="NAME", default=None, help="Name of input feature set (required)")
+        group.add_argument("--weighting", type=str, action="store", metavar="NAME", default=None, choices=sorted(weightings), help="Weighting scheme")
+        group.add_argument("--chunk-size", type=int, action="store", metavar="INT", default=None, help="Number of widget features per chunk")
+        group.add_argument("--rematerialize", action="store_true", default=None, help="Rewrite the weights of every widget with the current statistics")
+        group.add_argument("--datasource", dest='datasources', metavar="NAME", type=unicode, default=[], nargs="*", help="Datasources")
+
+@export
+class TermWeighting(App):
+    """Weights the counts of a feature set by document statistics
+
+    Document counts are kept in feature_statistics and only widgets above
+    the output feature set's watermark are read, so statistics are updated
+    incrementally as widgets are added.  New widgets are weighted with the
+    updated statistics; earlier widgets keep the weights they were given
+    until a run with --rematerialize.
+
+    Widgets are only read up to the input feature set's own watermark, so
+    widgets that BagOfWords hasn't finished are left for a later run.  Input
+    feature sets without any watermark are read up to their last widget.
+
+    The input feature set, the weighting and the input's tokenizer settings
+    are recorded on the output feature set for ScoringService.
+    """
+    @staticmethod
+    def build_parser_groups():
+        return [TermWeightingArgs()] + App.build_parser_groups()
+
+    def __init__(self, datadir, input_feature_set=None, output_feature_set=None, weighting=None, chunk_size=None, rematerialize=None, datasources=None, **kwargs):
+        super(TermWeighting, self).__init__(datadir, **kwargs)
+        self.config['input_feature_set'] = input_feature_set or self.config['input_feature_set']
+        self.config['weighting'] = weighting or self.config.get('weighting', "tfidf")
+        self.config['output_feature_set'] = output_feature_set or self.config.get('output_feature_set') \
+            or u"{}({})".format(self.config['weighting'], self.config['input_feature_set'])
+        self.config['chunk_size'] = chunk_size or self.config.get('chunk_size', 65536)
+        self.config['rematerialize'] = rematerialize or self.config.get('rematerialize', False)
+        self.config['datasources'] = datasources or self.config.get('datasources')
+
+        if self.config['weighting'] not in weightings:
+            raise KeyError("Invalid weighting: '{}'".format(self.config['weighting']))
+
+    def query_counts(self, session, fs_in, fs_out, upper_idwidget, incremental):
+        "Input widget features to count, bounded by upper_idwidget or else the input's watermarks"
+        from ..schema import widget as t_w
+        from ..schema import widget_feature as t_wf
+        from ..schema import feature as t_f
+        from ..schema import datasource as t_ds
+        from ..schema import feature_set_watermark as t_fsw
+
+        q = session.query(t_w.iddatasource, t_wf.idwidget, t_wf.idfeature, t_wf.value) \
+            .select_from(t_wf) \
+            .join(t_w, t_w.idwidget == t_wf.idwidget) \
+            .join(t_f, t_f.idfeature == t_wf.idfeature) \
+            .filter(t_f.idfeature_set == fs_in.idfeature_set) \
+            .filter(t_wf.value != None)
+
+        if upper_idwidget is not None:
+            q = q.filter(t_w.idwidget <= upper_idwidget)
+        else:
+            t_fsw_in = sqlalchemy.orm.aliased(t_fsw)
+            q = q.join(t_fsw_in, (t_fsw_in.iddatasource == t_w.iddatasource) & (t_fsw_in.idfeature_set == fs_in.idfeature_set)) \
+                .filter(t_w.idwidget <= t_fsw_in.idwidget)
+
+        if incremental:
+            q = q.outerjoin(t_fsw, (t_fsw.iddatasource == t_w.iddatasource) & (t_fsw.idfeature_set == fs_out.idfeature_set)) \
+                .filter(t_w.idwidget > sqlalchemy.func.coalesce(t_fsw.idwidget, 0))
+        if self.config['datasources'] is not None and len(self.config['datasources']) > 0:
+            q = q.join(t_ds, t_ds.iddatasource == t_w.iddatasource) \
+                .filter(t_ds.name.in_(self.config['datasources']))
+
+        #The primary key of widget_feature makes this order cheap, and lets
+        #widgets be counted without remembering them
+        return q.order_by(t_wf.idwidget)
+
+    def iterate_chunks(self, session, q):
+        result = session.execute(q.statement)
+        while True:
+            rows = result.fetchmany(self.config['chunk_size'])
+            if len(rows) == 0:
+                break
+            iddatasources, idwidgets, idfeatures, values = (np.array(x) for x in zip(*rows))
+            yield iddatasources.astype(np.int64), idwidgets.astype(np.int64), idfeatures.astype(np.int64), values.astype(np.float64)
+
+    def map_features(self, session, fs_out, FC, mapped, idfeatures):
+        """Output feature ids of input feature ids
+
+        mapped is a pair of sorted input ids and their output ids, extended
+        with the names of new input ids so that each chunk only looks up
+        the features it hasn't seen.
+        """
+        from ..schema import feature as t_f
+
+        ids = np.unique(idfeatures)
+        new_ids = ids[~np.in1d(ids, mapped[0])]
+        if len(new_ids) > 0:
+            names = {}
+            for batch in batcher(new_ids.tolist(), 500):
+                names.update(session.query(t_f.idfeature, t_f.name).filter(t_f.idfeature.in_(batch)))
+            new_outputs = np.array(FC(session, fs_out.idfeature_set, [names[x] for x in new_ids.tolist()]), dtype=np.int64)
+            ids = np.concatenate([mapped[0], new_ids])
+            order = np.argsort(ids)
+            mapped = (ids[order], np.concatenate([mapped[1], new_outputs])[order])
+        return mapped, mapped[1][np.searchsorted(mapped[0], idfeatures)]
+
+    def main(self):
+        from ..schema import widget_feature as t_wf
+        from ..schema import feature as t_f
+        from ..schema import feature_set as t_fs
+        from ..schema import datasource as t_ds
+        from ..schema import feature_set_watermark as t_fsw
+        from ..schema import feature_statistics as t_fst
+
+        global_weights, local_weights = weightings[self.config['weighting']]
+
+        with self.session_scope() as session:
+            self.log.info("Preparing")
+            fs_in = lookup(session, t_fs, name=self.config['input_feature_set'])
+            if fs_in is None: raise KeyError("Invalid feature set: '{}'".format(self.config['input_feature_set']))
+
+            fs_out = lookup_or_persist(session, t_fs, name=self.config['output_feature_set'])
+            if fs_out is None: raise KeyError("Invalid feature set: '{}'".format(self.config['output_feature_set']))
+
+            #Recorded so that documents can be weighted the same way when scored
+            recorded = dict(input_feature_set=self.config['input_feature_set'], weighting=self.config['weighting'])
+            if fs_out.kwargs is not None:
+                stored = json.loads(fs_out.kwargs)
+                if any(stored.get(x) != recorded[x] for x in recorded):
+                    raise ValueError("Feature set '{}' was built with different settings: {}".format(self.config['output_feature_set'], fs_out.kwargs))
+            if fs_in.kwargs is not None:
+                recorded.update((k, v) for k, v in json.loads(fs_in.kwargs).iteritems() if k in ("analyzer", "hash_buckets"))
+            fs_out.kwargs = unicode(json.dumps(recorded, sort_keys=True))
+
+            #Widgets past the input's watermark may still be missing input
+            #features, so they wait for the next run
+            input_watermarks = dict(
+                session.query(t_fsw.iddatasource, t_fsw.idwidget).filter(t_fsw.idfeature_set == fs_in.idfeature_set)
+            )
+            if len(input_watermarks) > 0:
+                upper_idwidget = None
+            else:
+                self.log.info("Input feature set '{}' has no watermark, so it's read up to its last widget".format(self.config['input_feature_set']))
+                upper_idwidget = session.query(sqlalchemy.func.max(t_wf.idwidget)) \
+                    .join(t_f, t_f.idfeature == t_wf.idfeature) \
+                    .filter(t_f.idfeature_set == fs_in.idfeature_set) \
+                    .scalar() or 0
+
+            self.log.info("Counting documents")
+            start_time = time.time()
+            empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0))
+            counted = empty
+            widget_counts = {}
+            last_idwidget = None
+            for iddatasources, idwidgets, idfeatures, values in self.iterate_chunks(session, self.query_counts(session, fs_in, fs_out, upper_idwidget, True)):
+                counted = merge_statistics(counted, aggregate(idfeatures, values))
+
+                #Rows arrive in widget order, so a widget is new where its id changes
+                first = np.ones(len(idwidgets), dtype=bool)
+                first[1:] = idwidgets[1:] != idwidgets[:-1]
+                first[0] = idwidgets[0] != last_idwidget
+                last_idwidget = idwidgets[-1]
+                ds_ids, ds_counts = np.unique(iddatasources[first], return_counts=True)
+                for iddatasource, count in zip(ds_ids.tolist(), ds_counts.tolist()):
+                    widget_counts[iddatasource] = widget_counts.get(iddatasource, 0) + count
+
+            q_fst = session.query(t_fst.idfeature, t_fst.document_count, t_fst.total_count, t_fst.entropy_sum) \
+                .filter(t_fst.idfeature_set == fs_out.idfeature_set) \
+                .order_by(t_fst.idfeature)
+            rows = session.execute(q_fst.statement).fetchall()
+            if len(rows) > 0:
+                ids, document_count, total_count, entropy_sum = (np.array(x) for x in zip(*rows))
+                stored = (ids.astype(np.int64), document_count.astype(np.int64), total_count.astype(np.float64), entropy_sum.astype(np.float64))
+            else:
+                stored = empty
+            statistics = merge_statistics(stored, counted)
+
+            watermarks = dict(
+                (wm.iddatasource, wm) for wm in session.query(t_fsw).filter(t_fsw.idfeature_set == fs_out.idfeature_set)
+            )
+            num_documents = sum(wm.widget_count or 0 for wm in watermarks.itervalues()) + sum(widget_counts.itervalues())
+            self.log.info("Counted {} new widgets and {} features in {}s".format(sum(widget_counts.itervalues()), len(counted[0]), time.time() - start_time))
+
+            ids = statistics[0]
+            weights = global_weights(num_documents, *statistics[1:])
+
+            self.log.info("Materializing weights")
+            start_time = time.time()
+            num_rows = 0
+            #Only the features of the widgets being weighted are mapped
+            FC = FeatureCache(65536, log=self.log)
+            mapped = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+            q = self.query_counts(session, fs_in, fs_out, upper_idwidget, not self.config['rematerialize'])
+            for _, idwidgets, idfeatures, values in self.iterate_chunks(session, q):
+                locs = np.searchsorted(ids, idfeatures)
+                weighted = local_weights(values) * weights[locs]
+                mapped, output_ids = self.map_features(session, fs_out, FC, mapped, idfeatures)
+                #Output features are outside the query's feature set, so
+                #writing them doesn't disturb the rows still being read
+                num_rows += bulk_load(session, schema.widget_feature, ["idwidget", "idfeature", "value"], itertools.izip(
+                    idwidgets.tolist(), output_ids.tolist(), weighted.tolist()
+                ), on_conflict="replace")
+            self.log.info("Materialized {} widget features in {}s".format(num_rows, time.time() - start_time))
+
+            if len(counted[0]) > 0:
+                #Only features seen in this run have changed
+                changed = np.searchsorted(ids, counted[0])
+                bulk_load(session, t_fst, ["idfeature_set", "idfeature", "document_count", "total_count", "entropy_sum"], itertools.izip(
+                    itertools.repeat(fs_out.idfeature_set),
+                    ids[changed].tolist(),
+                    statistics[1][changed].tolist(),
+                    statistics[2][changed].tolist(),
+                    statistics[3][changed].tolist()
+                ), on_conflict="replace")
+
+            q_ds = session.query(t_ds)
+            if self.config['datasources'] is not None and len(self.config['datasources']) > 0:
+                q_ds = q_ds.filter(t_ds.name.in_(self.config['datasources']))
+            for ds in q_ds.all():
+                watermark = upper_idwidget if upper_idwidget is not None else input_watermarks.get(ds.iddatasource)
+                if watermark is None:
+                    continue
+                wm = watermarks.get(ds.iddatasource)
+                count = widget_counts.get(ds.iddatasource, 0)
+                if wm is None:
+                    persist(session, t_fsw(idfeature_set=fs_out.idfeature_set, iddatasource=ds.iddatasource, idwidget=watermark, widget_count=count))
+                else:
+                    wm.idwidget = max(wm.idwidget, watermark)
+                    wm.widget_count = (wm.widget_count or 0) + count
+                self.log.info("Advanced watermark of '{}' for datasource {} to {}".format(self.config['output_feature_set'], ds.iddatasource, watermark))
+
+if __name__ == "__main__":
+    A = TermWeighting.from_args(sys.argv[1:])
+    A.run()
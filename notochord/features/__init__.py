@@ -0,0 +1 @@
+from .TermWeighting import *
@@ -92,7 +92,8 @@ class IngestRSS(App):
                     for entry in feed.entries:
                         try:
                             w_uuid=uuid.uuid5(uuid.NAMESPACE_URL, entry.id.encode('utf-8'))
-                            self.object_store.put(w_uuid.hex, {
+                            #Entries stored unchanged on an earlier refresh aren't rewritten
+                            self.object_store.put_if_changed(w_uuid.hex, {
                                 u"uuid":str(w_uuid),
                                 u"author":hasattr(entry, "author") and entry.author or None,
                                 u"title":entry.title,
@@ -114,10 +115,13 @@ class IngestRSS(App):
                 self.log.info("Uploading chunk of widget features")
                 with self.session_scope() as session:
                     upload_widget_features(session, widget_features)
+                self.object_store.flush()
 
                 count += 1
         except KeyboardInterrupt:
             pass
+        finally:
+            self.object_store.close()
 
     @property
     def continue_on_error(self):
@@ -8,7 +8,7 @@ import logging
 import sys
 import sqlalchemy
 from .. import schema, App, ABCArgumentGroup, lookup_or_persist, temptable_scope, insert_ignore, upload_widget_features
-from ..ObjectStore import ABCObjectStore
+from ..ObjectStore import ABCObjectStore, WriteBatchError
 import uuid
 import sys
 import urllib
@@ -120,51 +120,72 @@ class IngestWikipedia(App):
             load_count = 0
             widget_features = []
             #gc_items = collections.Counter(type(x) for x in gc.get_objects())
-            for it, article in enumerate(parse_wikipedia(wikifile)):
-                article_title, article_id, article_text = article
-                #print(article_title)
-                try:
-                    w_uuid=uuid.uuid5(uuid.NAMESPACE_URL, str(article_id))
-                    self.object_store.put(w_uuid.hex, {
-                        'uuid':w_uuid.hex,
-                        'title':article_title,
-                        'id':article_id,
-                        'text':article_text
-                    })
-
-                    for k in (u"title",u"text",u"id","uuid"):
-                        widget_features.append({
-                            "widget": w_uuid.hex,
-                            "idfeature": self.idfeature[k],
-                            'idfeature_set': self.idfeature_set,
-                            'iddatasource': iddatasource
+            with self.object_store.write_batch(fsync=self.config.get('fsync', False)) as batch:
+                for it, article in enumerate(parse_wikipedia(wikifile)):
+                    article_title, article_id, article_text = article
+                    #print(article_title)
+                    try:
+                        w_uuid=uuid.uuid5(uuid.NAMESPACE_URL, str(article_id))
+                        batch.put(w_uuid.hex, {
+                            'uuid':w_uuid.hex,
+                            'title':article_title,
+                            'id':article_id,
+                            'text':article_text
                         })
 
-                except Exception, e:
-                    self.log.info("Exception occurred from: {}".format(article))
-                    self.log.exception(e)
-                    if self.continue_on_error:
-                        continue
-                    else:
-                        raise
-
-                if (it+1) % 5000 == 0:
-                    load_start_time = time.time()
+                        for k in (u"title",u"text",u"id","uuid"):
+                            widget_features.append({
+                                "widget": w_uuid.hex,
+                                "idfeature": self.idfeature[k],
+                                'idfeature_set': self.idfeature_set,
+                                'iddatasource': iddatasource
+                            })
+
+                    except Exception, e:
+                        self.log.info("Exception occurred from: {}".format(article))
+                        self.log.exception(e)
+                        if self.continue_on_error:
+                            continue
+                        else:
+                            raise
+
+                    if (it+1) % 5000 == 0:
+                        load_start_time = time.time()
+                        #Widgets are only recorded once their objects are written
+                        widget_features = self.flush_batch(batch, widget_features)
+                        with self.session_scope() as session:
+                            upload_widget_features(session, widget_features)
+                        widget_features = []
+                        sum_load_time += time.time() - load_start_time
+                        avg_total_duration = (time.time() - time_init) / (it + 1)
+                        avg_load_duration = sum_load_time / (it+1)
+                        self.log.info("Load time: {} Total time: {} Count: {}".format(avg_load_duration, avg_total_duration, it+1))
+                        
+                        gc.collect()
+                        if self.config.get('max_count') is not None:
+                            if it >= self.config.get('max_count'):
+                                break
+
+                widget_features = self.flush_batch(batch, widget_features)
+                if len(widget_features) > 0:
                     with self.session_scope() as session:
                         upload_widget_features(session, widget_features)
-                    widget_features = []
-                    sum_load_time += time.time() - load_start_time
-                    avg_total_duration = (time.time() - time_init) / (it + 1)
-                    avg_load_duration = sum_load_time / (it+1)
-                    self.log.info("Load time: {} Total time: {} Count: {}".format(avg_load_duration, avg_total_duration, it+1))
-                    
-                    gc.collect()
-                    if self.config.get('max_count') is not None:
-                        if it >= self.config.get('max_count'):
-                            break
         except KeyboardInterrupt:
             pass
+        finally:
+            self.object_store.close()
 
+    def flush_batch(self, batch, widget_features):
+        "Flushes the batch and returns the widget features of the objects it wrote"
+        try:
+            batch.flush()
+        except WriteBatchError as e:
+            for item_uuid, error in sorted(e.failures.iteritems()):
+                self.log.error("Failed to write object {}: {!r}".format(item_uuid, error))
+            if not self.continue_on_error:
+                raise
+            widget_features = [x for x in widget_features if x['widget'] not in e.failures]
+        return widget_features
 
     @property
     def continue_on_error(self):
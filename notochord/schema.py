@@ -45,6 +45,8 @@ class feature_set(TableBase):
     idmodel = Column(Integer, ForeignKey('model.idmodel', onupdate='RESTRICT', ondelete='CASCADE'), nullable=True)
     idobject_store = Column(Integer, ForeignKey('object_store.idobject_store', onupdate='RESTRICT', ondelete='CASCADE'), nullable=True)
     name = Column(String(STRING_LENGTH), nullable=False)
+    #JSON settings the features were built with, such as BagOfWords' analyzer
+    kwargs = Column(UnicodeText, nullable=True)
     __table_args__ = (UniqueConstraint('idmodel', 'name'),)
 
 @export
@@ -67,6 +69,24 @@ class widget_feature(TableBase):
 #        Index('idxwidget_feature_idfeature','idfeature'), \
     )
 
+@export
+class feature_set_watermark(TableBase):
+    #Highest idwidget of a datasource whose features are complete in a feature set
+    idfeature_set = Column(Integer, ForeignKey('feature_set.idfeature_set', onupdate='RESTRICT', ondelete='CASCADE'), primary_key=True, nullable=False)
+    iddatasource = Column(Integer, ForeignKey('datasource.iddatasource', onupdate='RESTRICT', ondelete='CASCADE'), primary_key=True, nullable=False)
+    idwidget = Column(Integer, nullable=False)
+    #Widgets of the datasource counted so far, for feature sets that keep statistics
+    widget_count = Column(Integer, nullable=True)
+
+@export
+class feature_statistics(TableBase):
+    #Running document statistics of input features, kept per derived feature set
+    idfeature_set = Column(Integer, ForeignKey('feature_set.idfeature_set', onupdate='RESTRICT', ondelete='CASCADE'), primary_key=True, nullable=False)
+    idfeature = Column(Integer, ForeignKey('feature.idfeature', onupdate='RESTRICT', ondelete='CASCADE'), primary_key=True, nullable=False)
+    document_count = Column(Integer, nullable=False)
+    total_count = Column(Float, nullable=False)
+    entropy_sum = Column(Float, nullable=False)
+
 @export
 class algorithm(TableBase):
     idalgorithm = Column(Integer, primary_key=True, autoincrement=True, nullable=False)
@@ -96,6 +116,9 @@ class model(TableBase):
     hyperparameters = Column(String(STRING_LENGTH), nullable=False)
     trained_time = Column(UtcDateTime(timezone=True), nullable=True)
     trained_package = Column(LargeBinary(STRING_LENGTH), nullable=True)
+    #Packages saved to an object store are found by the sha256 of their pickle
+    idobject_store = Column(Integer, ForeignKey('object_store.idobject_store', onupdate='RESTRICT', ondelete='RESTRICT'), nullable=True)
+    package_hash = Column(String(64), nullable=True)
     __table_args__ = (UniqueConstraint('uuid'),Index('idxmodel_uuid', 'uuid'))
 
 @export
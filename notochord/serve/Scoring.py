@@ -0,0 +1,417 @@
+from .. import App, schema, export, pk, ABCArgumentGroup, ModelSet
+from ..tokenize.BatchTokenizer import BatchTokenizer
+import BaseHTTPServer
+import Queue
+import SocketServer
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import scipy as sp
+import scipy.sparse
+import sqlalchemy
+
+__all__ = []
+
+def input_feature_names(session, model):
+    "Names of a model's input features, in the order of its input columns"
+    from ..schema import feature as t_f
+    from ..schema import model_trained_on_input_feature as t_mtif
+    q = session.query(t_f.name) \
+        .join(t_mtif, t_mtif.idfeature == t_f.idfeature) \
+        .filter(t_mtif.idmodel == model.idmodel) \
+        .order_by(pk(t_mtif).asc())
+    return [x for x, in q]
+
+def input_feature_sets(session, model):
+    "Feature sets of a model's input features"
+    from ..schema import feature as t_f
+    from ..schema import feature_set as t_fs
+    from ..schema import model_trained_on_input_feature as t_mtif
+    q = session.query(t_fs).distinct() \
+        .join(t_f, t_f.idfeature_set == t_fs.idfeature_set) \
+        .join(t_mtif, t_mtif.idfeature == t_f.idfeature) \
+        .filter(t_mtif.idmodel == model.idmodel)
+    return q.all()
+
+def project(package, X, num_outputs):
+    "Applies a dimension reduction package to the rows of a CSR matrix"
+    if hasattr(package, "transform"):
+        return np.asarray(package.transform(X), dtype=np.float32)
+
+    #gensim models map sparse documents one at a time
+    ret = np.zeros((X.shape[0], num_outputs), dtype=np.float32)
+    for it, doc in enumerate(X):
+        for t, v in package[zip(doc.indices, doc.data)]:
+            ret[it, t] = v
+    return ret
+
+class MicroBatcher(object):
+    """Scores concurrent requests together on one worker thread
+
+    A batch starts with the oldest waiting request and takes whatever else
+    arrives within max_delay seconds, up to max_batch_size documents.  The
+    latencies of the last window requests are kept for percentiles.
+    """
+    def __init__(self, score, max_batch_size=256, max_delay=0.005, window=10000):
+        self.score = score
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.counters = dict(requests=0, documents=0, batches=0, errors=0)
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self.run, name="MicroBatcher")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, documents):
+        "Blocks until the documents are scored and returns their (vectors, classes)"
+        start_time = time.time()
+        request = dict(documents=documents, done=threading.Event(), result=None, error=None)
+        self.queue.put(request)
+        request['done'].wait()
+
+        with self.lock:
+            self.latencies.append(time.time() - start_time)
+            self.counters['requests'] += 1
+            self.counters['documents'] += len(documents)
+            if request['error'] is not None:
+                self.counters['errors'] += 1
+        if request['error'] is not None:
+            raise request['error']
+        return request['result']
+
+    def run(self):
+        stop = False
+        while not stop:
+            request = self.queue.get()
+            if request is None:
+                break
+
+            batch = [request]
+            num_documents = len(request['documents'])
+            deadline = time.time() + self.max_delay
+            while num_documents < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                batch.append(request)
+                num_documents += len(request['documents'])
+
+            self.run_batch(batch)
+
+    def run_batch(self, batch):
+        try:
+            vectors, classes = self.score(sum((x['documents'] for x in batch), []))
+            start = 0
+            for request in batch:
+                end = start + len(request['documents'])
+                request['result'] = (vectors[start:end], None if classes is None else classes[start:end])
+                start = end
+        except Exception as e:
+            for request in batch:
+                request['error'] = e
+        finally:
+            with self.lock:
+                self.counters['batches'] += 1
+            for request in batch:
+                request['done'].set()
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            ret = dict(self.counters)
+        elapsed = time.time() - self.start_time
+        ret.update(
+            uptime = elapsed,
+            throughput = ret['documents'] / elapsed if elapsed > 0 else 0.0,
+            mean_batch_size = float(ret['documents']) / ret['batches'] if ret['batches'] > 0 else 0.0,
+            p50_ms = float(np.percentile(latencies, 50)) * 1000 if len(latencies) > 0 else None,
+            p99_ms = float(np.percentile(latencies, 99)) * 1000 if len(latencies) > 0 else None
+        )
+        return ret
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+class ScoringHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    "POST /score with {\"documents\": [...]}, GET /stats"
+    def send_json(self, code, value):
+        body = json.dumps(value)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/stats":
+            return self.send_json(404, dict(error="Not found: {}".format(self.path)))
+        self.send_json(200, self.server.service.stats())
+
+    def do_POST(self):
+        if self.path != "/score":
+            return self.send_json(404, dict(error="Not found: {}".format(self.path)))
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            documents = request['documents']
+            if not isinstance(documents, list) or not all(isinstance(x, basestring) for x in documents):
+                raise ValueError("documents must be a list of strings")
+        except (ValueError, KeyError, TypeError) as e:
+            return self.send_json(400, dict(error=str(e)))
+
+        try:
+            self.send_json(200, self.server.service.score(documents))
+        except Exception as e:
+            self.server.service.log.exception("Scoring failed")
+            self.send_json(500, dict(error=str(e)))
+
+    def log_message(self, format, *args):
+        #Unix socket clients have no address for the default format
+        self.server.service.log.debug(format % args)
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class ScoringServiceArgs(ABCArgumentGroup):
+    def __call__(self, group):
+        group.add_argument("--model-name", type=unicode, action="store", metavar="NAME", default=None, help="Model set of the dimension reduction model (required)")
+        group.add_argument("--classifier-model-name", type=unicode, action="store", metavar="NAME", default=None, help="Model set of a classifier over the reduced vectors")
+        group.add_argument("--host", type=str, action="store", metavar="HOST", default=None, help="Address to listen on")
+        group.add_argument("--port", type=int, action="store", metavar="INT", default=None, help="Port to listen on")
+        group.add_argument("--socket", type=str, action="store", metavar="PATH", default=None, help="Listen on a unix socket instead, relative to the datadir")
+        group.add_argument("--max-batch-size", type=int, action="store", metavar="INT", default=None, help="Most documents scored together")
+        group.add_argument("--max-delay", type=float, action="store", metavar="MS", default=None, help="Longest wait for a batch to fill, in milliseconds")
+
+@export
+class ScoringService(App):
+    """Scores documents against the latest trained models over HTTP
+
+    The latest model of model_name, and optionally of
+    classifier_model_name, are loaded once at startup.  Documents are
+    tokenized with the analyzer and hash_buckets recorded on the model's
+    input feature set by BagOfWords, and concurrent requests are scored as
+    one matrix.  Setting either in this app's config only checks it against
+    the recorded value.  Inputs weighted by TermWeighting are weighted with
+    its current feature_statistics before they're projected.
+    """
+    @staticmethod
+    def build_parser_groups():
+        return [ScoringServiceArgs()] + App.build_parser_groups()
+
+    def __init__(self, datadir, model_name=None, classifier_model_name=None, host=None, port=None, socket=None, max_batch_size=None, max_delay=None, **kwargs):
+        super(ScoringService, self).__init__(datadir, **kwargs)
+        self.config['model_name'] = model_name or self.config['model_name']
+        self.config['classifier_model_name'] = classifier_model_name or self.config.get('classifier_model_name')
+        self.config['host'] = host or self.config.get('host', "127.0.0.1")
+        self.config['port'] = (port, self.config.get('port', 8080))[port is None]
+        self.config['socket'] = socket or self.config.get('socket')
+        self.config['max_batch_size'] = max_batch_size or self.config.get('max_batch_size', 256)
+        self.config['max_delay'] = (max_delay, self.config.get('max_delay', 5.0))[max_delay is None]
+
+        self.tokenizer = None
+        self.local_weights = None
+        self.column_weights = None
+        self.batcher = None
+        self.server = None
+
+    def tokenizer_kwargs(self, session, model, input_names):
+        "The analyzer and hash_buckets a model's input features were built with"
+        recorded = {}
+        for fs in input_feature_sets(session, model):
+            kwargs = json.loads(fs.kwargs) if fs.kwargs is not None else {}
+            if "analyzer" in kwargs:
+                recorded[fs.name] = dict((x, kwargs.get(x)) for x in ("analyzer", "hash_buckets"))
+        if len(set(json.dumps(x, sort_keys=True) for x in recorded.itervalues())) > 1:
+            raise ValueError("Model {} has inputs built with different settings: {}".format(model.uuid, recorded))
+
+        if len(recorded) > 0:
+            ret = recorded.values()[0]
+            for key in ("analyzer", "hash_buckets"):
+                if key in self.config and self.config[key] != ret.get(key):
+                    raise ValueError("Config sets {} to {!r}, but model {} was trained on features built with {!r}".format(key, self.config[key], model.uuid, ret.get(key)))
+            return ret.get('analyzer'), ret.get('hash_buckets')
+
+        #Feature sets built before their settings were recorded fall back to
+        #this app's config and then the BagOfWords config, checked as far as
+        #the feature names allow
+        self.log.warning("Model {} has no recorded tokenizer settings, using the configs".format(model.uuid))
+        bow_path = os.path.join(self.confdir, "BagOfWords.json")
+        bow_config = {}
+        if os.path.exists(bow_path):
+            with open(bow_path, "rb") as fin:
+                bow_config = json.loads(fin.read())
+        analyzer = self.config['analyzer'] if 'analyzer' in self.config else bow_config.get('analyzer')
+        hash_buckets = self.config['hash_buckets'] if 'hash_buckets' in self.config else bow_config.get('hash_buckets')
+        hashed = all(x.isdigit() for x in input_names)
+        if hash_buckets is not None and not (hashed and all(int(x) < hash_buckets for x in input_names)):
+            raise ValueError("hash_buckets is {}, but model {} wasn't trained on hashed features".format(hash_buckets, model.uuid))
+        if hash_buckets is None and hashed and len(input_names) > 0:
+            raise ValueError("Model {} was trained on hashed features, but hash_buckets isn't set".format(model.uuid))
+        return analyzer, hash_buckets
+
+    def input_weights(self, session, model, input_names):
+        """The local transform and column weights of a model's input features
+
+        Returns (None, None) unless the inputs were weighted by TermWeighting,
+        whose statistics are kept by input feature under the same names.
+        """
+        from ..features.TermWeighting import weightings
+        from ..schema import feature as t_f
+        from ..schema import feature_statistics as t_fst
+        from ..schema import feature_set_watermark as t_fsw
+
+        feature_sets = input_feature_sets(session, model)
+        weighted = [x for x in feature_sets if x.kwargs is not None and "weighting" in json.loads(x.kwargs)]
+        if len(weighted) == 0:
+            return None, None
+        if len(feature_sets) > 1:
+            raise ValueError("Model {} has inputs from weighted and other feature sets: {}".format(model.uuid, sorted(x.name for x in feature_sets)))
+
+        fs = weighted[0]
+        weighting = json.loads(fs.kwargs)['weighting']
+        if weighting not in weightings:
+            raise KeyError("Invalid weighting: '{}'".format(weighting))
+        global_weights, local_weights = weightings[weighting]
+
+        columns = dict((name, it) for it, name in enumerate(input_names))
+        statistics = np.zeros((3, len(input_names)))
+        q = session.query(t_f.name, t_fst.document_count, t_fst.total_count, t_fst.entropy_sum) \
+            .join(t_f, t_f.idfeature == t_fst.idfeature) \
+            .filter(t_fst.idfeature_set == fs.idfeature_set)
+        for name, document_count, total_count, entropy_sum in q:
+            if name in columns:
+                statistics[:, columns[name]] = (document_count, total_count, entropy_sum)
+        num_documents = session.query(sqlalchemy.func.sum(t_fsw.widget_count)) \
+            .filter(t_fsw.idfeature_set == fs.idfeature_set) \
+            .scalar() or 0
+
+        self.log.info("Weighting inputs by {} over {} documents".format(weighting, num_documents))
+        return local_weights, global_weights(num_documents, *statistics)
+
+    def load(self):
+        "Loads the models, their feature names and the tokenizer their features were built with"
+        with self.session_scope() as session:
+            model = ModelSet(session, self.config['model_name']).latest_model()
+            if model is None:
+                raise KeyError("Model set '{}' has no trained model".format(self.config['model_name']))
+            self.model_uuid = model.uuid
+            self.package = model.package
+            input_names = input_feature_names(session, model)
+            self.output_names = [x for x, in model.query_predicts_features().with_entities(schema.feature.name)]
+            self.log.info("Loaded model {} with {} inputs and {} outputs".format(model.uuid, len(input_names), len(self.output_names)))
+
+            analyzer, hash_buckets = self.tokenizer_kwargs(session, model, input_names)
+            self.tokenizer = BatchTokenizer.from_config(analyzer, hash_buckets=hash_buckets)
+            self.local_weights, self.column_weights = self.input_weights(session, model, input_names)
+            self.columns = dict((name, it) for it, name in enumerate(input_names))
+            self.num_inputs = len(input_names)
+            if hash_buckets is not None:
+                #Hashed feature names are bucket numbers
+                self.bucket_columns = np.array([self.columns.get(unicode(x), -1) for x in xrange(hash_buckets)], dtype=np.int64)
+
+            self.classifier = None
+            if self.config['classifier_model_name'] is not None:
+                classifier = ModelSet(session, self.config['classifier_model_name']).latest_model()
+                if classifier is None:
+                    raise KeyError("Model set '{}' has no trained model".format(self.config['classifier_model_name']))
+                self.classifier = classifier.package
+                #Classifiers are trained on the output feature set, matched by name
+                outputs = dict((name, it) for it, name in enumerate(self.output_names))
+                self.classifier_columns = np.array([outputs[x] for x in input_feature_names(session, classifier)], dtype=np.int64)
+                self.log.info("Loaded classifier {}".format(classifier.uuid))
+
+    def build_matrix(self, documents):
+        chunk = self.tokenizer(documents)
+        if chunk.vocab is None:
+            columns = self.bucket_columns[chunk.word_ids]
+        else:
+            vocab_columns = np.array([self.columns.get(x, -1) for x in chunk.vocab], dtype=np.int64)
+            columns = vocab_columns[chunk.word_ids]
+        rows = np.repeat(np.arange(len(documents), dtype=np.int64), np.diff(chunk.indptr))
+
+        #Words the model wasn't trained on are dropped
+        known = columns >= 0
+        values = chunk.counts[known].astype(np.float64)
+        if self.local_weights is not None:
+            values = self.local_weights(values) * self.column_weights[columns[known]]
+        return sp.sparse.csr_matrix(
+            (values.astype(np.float32), (rows[known], columns[known])),
+            dtype=np.float32, shape=(len(documents), self.num_inputs)
+        )
+
+    def score_documents(self, documents):
+        "Returns the vectors and classes, or None, of a batch of documents"
+        vectors = project(self.package, self.build_matrix(documents), len(self.output_names))
+        classes = None
+        if self.classifier is not None:
+            classes = self.classifier.predict(vectors[:, self.classifier_columns])
+        return vectors, classes
+
+    def score(self, documents):
+        vectors, classes = self.batcher.submit(documents)
+        ret = dict(model=self.model_uuid, features=self.output_names, vectors=vectors.tolist())
+        if classes is not None:
+            ret['classes'] = np.asarray(classes).tolist()
+        return ret
+
+    def stats(self):
+        return self.batcher.stats()
+
+    def start(self):
+        "Loads the models and binds the server without serving yet"
+        self.load()
+        self.batcher = MicroBatcher(self.score_documents, max_batch_size=self.config['max_batch_size'], max_delay=self.config['max_delay'] / 1000.0)
+
+        if self.config['socket'] is not None:
+            path = os.path.join(self.datadir, self.config['socket'])
+            if os.path.exists(path):
+                os.remove(path)
+            self.server = ThreadingUnixHTTPServer(path, ScoringHandler)
+            self.log.info("Listening on {}".format(path))
+        else:
+            self.server = ThreadingHTTPServer((self.config['host'], self.config['port']), ScoringHandler)
+            self.log.info("Listening on {}:{}".format(*self.server.server_address))
+        self.server.service = self
+
+    def close(self):
+        "Releases the socket and the batcher once the server has stopped serving"
+        self.server.server_close()
+        self.batcher.close()
+        if self.config['socket'] is not None:
+            path = os.path.join(self.datadir, self.config['socket'])
+            if os.path.exists(path):
+                os.remove(path)
+
+    def stop(self):
+        "Stops a server running serve_forever on another thread"
+        self.server.shutdown()
+        self.close()
+
+    def main(self):
+        self.start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+if __name__ == "__main__":
+    A = ScoringService.from_args(sys.argv[1:])
+    A.run()
@@ -0,0 +1 @@
+from .Scoring import *
@@ -1,4 +1,4 @@
-from ..Model import ModelSet, Model
+from ..Model import ModelSet, Model, MatrixCache
 
 from . import FeaturePopulatedTestCase, datadir_session
 from .. import export, schema, grouper, get_utcnow, persist, lookup
@@ -10,6 +10,9 @@ import datetime
 import iso8601
 import itertools
 import numpy as np
+import os
+import shutil
+import tempfile
 
 __all__ = []
 
@@ -144,6 +147,166 @@ class TestModel(FeaturePopulatedTestCase):
             self.assertEqual(a[0], b[0])
             np.testing.assert_almost_equal(a[1], b[1])
 
+        #Predictions are written to the copies of the output features the model owns
+        expected = sorted(self.predictions, key=lambda x:x[0])
+        predicts_features = [x.idfeature for x in m.query_predicts_features()]
+        idwidgets, matrix = m.get_predictions_matrix(predicts_features)
+        self.assertEqual(idwidgets.tolist(), [x[0] for x in expected])
+        self.assertEqual(matrix.dtype, np.float32)
+        np.testing.assert_almost_equal(matrix, [x[1] for x in expected], decimal=5)
 
+        t_w = schema.widget
+        some_widgets, some = m.get_predictions_matrix(predicts_features, widgets=self.session.query(t_w.idwidget).filter(t_w.idwidget <= 10))
+        self.assertEqual(some_widgets.tolist(), [x for x in idwidgets.tolist() if x <= 10])
+        np.testing.assert_array_equal(some, matrix[:len(some_widgets)])
+
+        chunks = list(m.iterate_predictions_matrix(predicts_features, batch_size=2))
+        self.assertTrue(all(len(w) <= 2 for w, X in chunks))
+        np.testing.assert_array_equal(np.concatenate([w for w, X in chunks]), idwidgets)
+
+        path = os.path.join(tempfile.mkdtemp(), "predictions.npy")
+        try:
+            mapped_widgets, mapped = m.get_predictions_matrix(predicts_features, path=path, batch_size=2)
+            np.testing.assert_array_equal(mapped_widgets, idwidgets)
+            np.testing.assert_array_equal(np.load(path), matrix)
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+
+
+
+
+@export
+class TestModelTrainingData(TestModel):
+    def runTest(self):
+        t_wf = schema.widget_feature
+
+        model_set = ModelSet(self.session, self.test_model_set_name)
+        m = Model.new_from_model_set(model_set, FakeAlg(**self.fake_hyper), self.input_features, self.output_features)
+
+        columns = dict((f, it) for it, f in enumerate(self.expected_input_features))
+        expected = np.zeros((len(self.expected_training_widgets), len(columns)), dtype=np.float32)
+        rows = dict((w, it) for it, w in enumerate(self.expected_training_widgets))
+        for wf in self.session.query(t_wf).filter(t_wf.idfeature.in_(self.expected_input_features)):
+            if wf.idwidget in rows:
+                expected[rows[wf.idwidget], columns[wf.idfeature]] = wf.value
+        self.assertGreater(np.count_nonzero(expected), 0)
+
+        list(m.get_training_data(self.training_widgets, supervised=False, batch_size=0))
+        for sparse_inputs, stream in itertools.product((False, True), (False, True)):
+            batches = list(m._get_ordered_data(schema.model_trained_on_widget, sparse_inputs=sparse_inputs, get_labels=False, batch_size=3, stream=stream))
+            self.assertEqual([len(w) for w, X in batches], [len(self.expected_training_widgets[it:it + 3]) for it in xrange(0, len(self.expected_training_widgets), 3)])
+            self.assertEqual(sum((w for w, X in batches), []), self.expected_training_widgets)
+            observed = np.vstack([X.toarray() if sparse_inputs else X for w, X in batches])
+            np.testing.assert_array_equal(observed, expected)
+
+@export
+class TestModelMatrixCache(TestModel):
+    def runTest(self):
+        t_wf = schema.widget_feature
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = MatrixCache(cache_dir)
+            model_set = ModelSet(self.session, self.test_model_set_name)
+            m = model_set.new_model(FakeAlg(**self.fake_hyper), self.input_features, matrix_cache=cache)
+
+            trained = list(m.get_training_data(self.training_widgets, sparse_inputs=True, supervised=False, batch_size=3))
+            self.assertEqual(len(os.listdir(cache.model_path(m.idmodel))), len(trained))
+
+            #Prediction over the same widgets reads the saved chunks, so a
+            #changed value only shows once the model's cache is invalidated
+            wf = self.session.query(t_wf) \
+                .filter(t_wf.idwidget == self.expected_training_widgets[0]) \
+                .filter(t_wf.idfeature.in_(self.expected_input_features)) \
+                .first()
+            wf.value = 1000.0
+            self.session.flush()
+
+            predicted = list(m.get_predict_data(self.training_widgets, sparse_inputs=True, supervised=False, batch_size=3))
+            self.assertEqual([w for w, X in predicted], [w for w, X in trained])
+            for (_, a), (_, b) in zip(predicted, trained):
+                self.assertEqual((a != b).nnz, 0)
+
+            cache.invalidate(m.idmodel)
+            changed = list(m._get_ordered_data(schema.model_predicts_widget, sparse_inputs=False, get_labels=False, batch_size=3))
+            self.assertIn(1000.0, np.vstack([X for w, X in changed]))
+        finally:
+            shutil.rmtree(cache_dir)
+
+@export
+class TestModelPackage(TestModel):
+    def runTest(self):
+        from ..ObjectStore import ABCObjectStore
+
+        model_set = ModelSet(self.session, self.test_model_set_name)
+        fake_alg = FakeAlg(**self.fake_hyper)
+        fake_alg.fit(dict(big=np.arange(100000, dtype=np.float32).reshape((1000, 100)), small=np.arange(4)))
+
+        stores = [
+            ABCObjectStore.create(self.session, u"TestModelPackageFile", "file://" + os.path.join(self.result_dir, "package_file"), marshal="raw"),
+            ABCObjectStore.create(self.session, u"TestModelPackageSegment", "segment://" + os.path.join(self.result_dir, "package_segment"), marshal="raw")
+        ]
+        for store, mapped in zip(stores, (True, False)):
+            m = model_set.new_model(fake_alg, self.input_features)
+            m.set_trained(fake_alg, object_store=store)
+            self.assertEqual(len(m._dbinst.package_hash), 64)
+            self.assertIsNone(m._dbinst.trained_package)
+
+            package = m.package
+            self.assertEqual(package.params, fake_alg.params)
+            self.assertEqual(isinstance(package.weights['big'], np.memmap), mapped)
+            np.testing.assert_array_equal(package.weights['big'], fake_alg.weights['big'])
+            np.testing.assert_array_equal(package.weights['small'], fake_alg.weights['small'])
+
+        #The same contents give the same hash, so artifacts are shared
+        hashes = []
+        for it in xrange(2):
+            m = model_set.new_model(fake_alg, self.input_features)
+            m.set_trained(fake_alg, object_store=stores[0])
+            hashes.append(m._dbinst.package_hash)
+        self.assertEqual(hashes[0], hashes[1])
+
+        json_store = ABCObjectStore.create(self.session, u"TestModelPackageJson", "file://" + os.path.join(self.result_dir, "package_json"))
+        with self.assertRaises(ValueError):
+            m.set_trained(fake_alg, object_store=json_store)
+
+@export
+class TestModelCache(TestModel):
+    def runTest(self):
+        from ..Model import ModelCache, model_cache
+
+        model_set = ModelSet(self.session, self.test_model_set_name)
+        fake_alg = FakeAlg(**self.fake_hyper)
+        fake_alg.fit(np.arange(1000, dtype=np.float64))
+        m = model_set.new_model(fake_alg, self.input_features)
+        m.set_trained(fake_alg)
+
+        before = model_cache.stats()
+        first = m.package
+        self.assertIs(m.package, first)
+        after = model_cache.stats()
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+        self.assertGreater(after['load_time'], before['load_time'])
+
+        #Retraining changes trained_time and with it the key
+        time.sleep(0.01)
+        m.set_trained(FakeAlg(**self.fake_hyper))
+        self.assertIsNot(m.package, first)
+        self.assertIsNone(m.package.weights)
 
+        self.assertIs(model_set.latest_model(), model_set.latest_model())
+        time.sleep(0.01)
+        m2 = model_set.new_model(fake_alg, self.input_features)
+        m2.set_trained(fake_alg)
+        self.assertEqual(model_set.latest_model().idmodel, m2.idmodel)
 
+        cache = ModelCache(max_bytes=10000)
+        cache.get(m, "package", lambda: np.zeros(1000))
+        cache.get(m2, "package", lambda: np.zeros(1000))
+        stats = cache.stats()
+        self.assertEqual((stats['entries'], stats['evictions']), (1, 1))
+        self.assertLessEqual(stats['bytes'], 10000)
+        cache.invalidate(m2.uuid)
+        self.assertEqual(cache.stats()['entries'], 0)
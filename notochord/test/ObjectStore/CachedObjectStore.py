@@ -0,0 +1,63 @@
+from .. import InitializedTestCase
+from ...ObjectStore.CachedObjectStore import *
+from ...ObjectStore import ABCObjectStore
+from ... import export
+import os
+import uuid
+
+__all__ = []
+
+@export
+class TestCachedObjectStoreReadThrough(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        fsdir = "file://" + os.path.join(self.result_dir, "file_store")
+        cs = ABCObjectStore.create(session, u"TestCachedStore", fsdir, compression='gzip', cache={"max_bytes":1024*1024})
+        self.assertIsInstance(cs, CachedObjectStore)
+        u = str(uuid.uuid4())
+        cs.put(u, {"title":"Hello World!", "body":"Lorem Ipsum"})
+        self.assertEqual(cs.get(u, feature="title"), "Hello World!")
+        self.assertEqual(cs.get(u, feature="title"), "Hello World!")
+        self.assertEqual(cs.stats()['misses'], 1)
+        self.assertEqual(cs.stats()['hits'], 1)
+
+        cs.post(u, "Goodbye World!", feature="title")
+        self.assertEqual(cs.get(u, feature="title"), "Goodbye World!")
+        self.assertEqual(dict(cs.get_many([u], feature="title")), {u:"Goodbye World!"})
+        self.assertEqual(cs.stats()['misses'], 2)
+
+        cs.delete(u)
+        self.assertEqual(cs.exists(u), False)
+        self.assertRaises(IOError, cs.get, u)
+
+        reopened = ABCObjectStore.open(session, u"TestCachedStore")
+        self.assertIsInstance(reopened, CachedObjectStore)
+        self.assertEqual(reopened.prefix_path, cs.prefix_path)
+
+@export
+class TestCachedObjectStoreEviction(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        fsdir = "file://" + os.path.join(self.result_dir, "file_store")
+        cs = ABCObjectStore.create(session, u"TestCachedStore", fsdir, cache={"max_bytes":4096, "mmap_bytes":8192})
+        expected = dict((str(uuid.uuid4()), "DEADBEEF" * 32) for it in xrange(64))
+        for u, val in expected.iteritems():
+            cs.put(u, val)
+
+        order = expected.keys()
+        self.assertEqual(dict(cs.get_many(order)), expected)
+        stats = cs.stats()
+        self.assertEqual(stats['misses'], 64)
+        self.assertLessEqual(stats['bytes'], 4096)
+        self.assertGreater(stats['evictions'], 0)
+        self.assertGreater(stats['mmap_evictions'], 0)
+
+        #Recently evicted values come back from the mmap tier
+        self.assertEqual(dict((u, cs.get(u)) for u in reversed(order)), expected)
+        self.assertGreater(cs.stats()['hits'], 0)
+        self.assertGreater(cs.stats()['mmap_hits'], 0)
+
+        u = order[-1]
+        cs.put(u, "Replaced")
+        self.assertEqual(cs.get(u), "Replaced")
+        cs.close()
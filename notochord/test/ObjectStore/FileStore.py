@@ -1,5 +1,6 @@
 from .. import InitializedTestCase, test_data_dir
 from ...ObjectStore.FileStore import *
+from ...ObjectStore import WriteBatchError
 from ... import export
 import os
 import unittest
@@ -210,3 +211,221 @@ class TestFileStoreNewBzippedCompress(InitializedTestCase):
         self.assertEqual(fs.exists(u), True)
         self.assertEqual(fs.get(u), val)
         self.assertLess(os.path.getsize(fs.uuid2path(u)), len(val))
+
+@export
+class TestFileStoreNewGzippedGetMany(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        fsdir = "file://" + os.path.join(self.result_dir, "file_store")
+        fs = FileStore.create(session, u"TestFileStore", fsdir, compression='gzip', directory_layout=[2,2], num_readers=4)
+        expected = [(str(uuid.uuid4()), {"text":"Hello World #{}".format(it)}) for it in xrange(100)]
+        for u, val in expected:
+            fs.put(u, val)
+
+        self.assertEqual(list(fs.get_many(u for u, val in expected)), expected)
+        self.assertEqual(list(fs.get_many((u for u, val in expected), feature="text")), [(u, val["text"]) for u, val in expected])
+
+@export
+class TestFileStoreNewGzippedGetManyProcess(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        fsdir = "file://" + os.path.join(self.result_dir, "file_store")
+        fs = FileStore.create(session, u"TestFileStore", fsdir, compression='gzip', directory_layout=[2,2], num_readers=2, reader_pool="process")
+        expected = [(str(uuid.uuid4()), {"text":"Hello World #{}".format(it)}) for it in xrange(100)]
+        for u, val in expected:
+            fs.put(u, val)
+
+        self.assertEqual(list(fs.get_many((u for u, val in expected), feature="text")), [(u, val["text"]) for u, val in expected])
+
+@export
+class TestFileStoreNewGzippedSplitFeatures(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        fsdir = "file://" + os.path.join(self.result_dir, "file_store")
+        fs = FileStore.create(session, u"TestFileStore", fsdir, compression='gzip', directory_layout=[2,2], split_features=True)
+        u = str(uuid.uuid4())
+        val = {u"title":u"Hello World!", u"text":u"DEADBEEF" * 100, u"id":5, u".hidden/feature":[1,2]}
+        self.assertEqual(fs.exists(u), False)
+        fs.put(u, val)
+        self.assertEqual(fs.exists(u), True)
+        self.assertEqual(sorted(os.listdir(fs.uuid2path(u))), ["%2Ehidden%2Ffeature", "id", "text", "title"])
+        self.assertEqual(fs.get(u), val)
+        self.assertEqual(fs.get(u, feature="title"), val["title"])
+        self.assertRaises(KeyError, fs.get, u, feature="missing")
+
+        fs.post(u, u"Goodbye World!", feature="title")
+        self.assertEqual(fs.get(u, feature="title"), u"Goodbye World!")
+        self.assertEqual(fs.get(u, feature="text"), val["text"])
+
+        fs.put(u, {u"title":u"Replaced"})
+        self.assertEqual(fs.get(u), {u"title":u"Replaced"})
+
+        fs.delete(u)
+        self.assertEqual(os.listdir(fs.prefix_path), [])
+        self.assertEqual(fs.exists(u), False)
+
+@export
+class TestFileStoreNewSplitFeaturesGetManyProcess(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        fsdir = "file://" + os.path.join(self.result_dir, "file_store")
+        fs = FileStore.create(session, u"TestFileStore", fsdir, directory_layout=[2,2], split_features=True, num_readers=2, reader_pool="process")
+        expected = [(str(uuid.uuid4()), {u"text":u"Hello World #{}".format(it), u"id":it}) for it in xrange(20)]
+        for u, val in expected:
+            fs.put(u, val)
+
+        self.assertEqual(list(fs.get_many((u for u, val in expected), feature="text")), [(u, val["text"]) for u, val in expected])
+
+@export
+class TestFileStoreIterate(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        fsdir = "file://" + os.path.join(self.result_dir, "file_store")
+        fs = FileStore.create(session, u"TestFileStore", fsdir, compression='gzip')
+        expected = dict((uuid.uuid4().hex, {"title":"Title {}".format(it), "body":"Body {}".format(it)}) for it in xrange(50))
+        for u, val in expected.iteritems():
+            fs.put(u, val)
+        os.mkdir(os.path.join(fs.prefix_path, ".dictionaries"))
+
+        self.assertEqual(dict(fs.iterate()), expected)
+        self.assertEqual(list(fs.iterate(feature="title", order="uuid")), sorted((u, val["title"]) for u, val in expected.iteritems()))
+
+@export
+class TestFileStoreSplitFeaturesIterate(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        fsdir = "file://" + os.path.join(self.result_dir, "file_store")
+        fs = FileStore.create(session, u"TestFileStore", fsdir, split_features=True, reader_pool="process")
+        expected = dict((uuid.uuid4().hex, {"title":"Title {}".format(it)}) for it in xrange(20))
+        for u, val in expected.iteritems():
+            fs.put(u, val)
+        self.assertEqual(dict(fs.iterate()), expected)
+
+@export
+class TestFileStoreBloomFilter(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        fsdir = "file://" + os.path.join(self.result_dir, "file_store")
+        fs = FileStore.create(session, u"TestFileStore", fsdir, compression='gzip')
+        existing = [uuid.uuid4().hex for it in xrange(20)]
+        for u in existing:
+            fs.put(u, "Existing")
+
+        #The filter of an existing store is built from a scan
+        fs = FileStore.create(session, u"TestFileStoreBloom", fsdir, compression='gzip', bloom_capacity=100)
+        self.assertEqual(all(fs.exists(u) for u in existing), True)
+        missing = [uuid.uuid4().hex for it in xrange(100)]
+        self.assertEqual(any(fs.exists(u) for u in missing), False)
+
+        u = missing[0]
+        self.assertEqual(fs.put_if_absent(u, "First"), True)
+        self.assertEqual(fs.put_if_absent(u, "Second"), False)
+        self.assertEqual(fs.get(u), "First")
+        fs.close()
+
+        reopened = FileStore.create(session, u"TestFileStoreBloom", fsdir, compression='gzip', bloom_capacity=100)
+        self.assertEqual(reopened.exists(u), True)
+        fs.delete(existing[0])
+        self.assertEqual(reopened.exists(existing[0]), False)
+
+        #Growing past capacity rebuilds a larger filter on flush
+        for u in missing[1:]:
+            reopened.put(u, "Grown")
+        reopened.flush()
+        self.assertGreater(reopened.bloom.load().capacity, 100)
+        self.assertEqual(all(reopened.exists(u) for u in missing), True)
+
+@export
+class TestFileStorePutMany(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        fsdir = "file://" + os.path.join(self.result_dir, "file_store")
+        fs = FileStore.create(session, u"TestFileStore", fsdir, compression='gzip', bloom_capacity=1000)
+        expected = dict((uuid.uuid4().hex, {"title":"Title {}".format(it)}) for it in xrange(200))
+        fs.put_many(expected.iteritems(), fsync=True)
+        self.assertEqual(dict(fs.get_many(expected.keys())), expected)
+        self.assertEqual(all(fs.exists(u) for u in expected), True)
+
+        u = expected.keys()[0]
+        with fs.write_batch() as batch:
+            batch.put(u, {"title":"Replaced"})
+            batch.flush()
+            self.assertEqual(fs.get(u), {"title":"Replaced"})
+            fs.delete(u)
+            batch.put(u, {"title":"Recreated"})
+        self.assertEqual(fs.get(u), {"title":"Recreated"})
+
+@export
+class TestFileStorePutIfChanged(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        fsdir = "file://" + os.path.join(self.result_dir, "file_store")
+        for it, content_digests in enumerate((False, True)):
+            fs = FileStore.create(session, u"TestFileStore{}".format(it), fsdir + str(it), compression='gzip', bloom_capacity=100, content_digests=content_digests)
+            u = uuid.uuid4().hex
+            self.assertEqual(fs.put_if_changed(u, {"title":"First"}), True)
+            self.assertEqual(fs.put_if_changed(u, {"title":"First"}), False)
+            self.assertEqual(fs.put_if_changed(u, {"title":"Edited"}), True)
+            self.assertEqual(fs.get(u), {"title":"Edited"})
+            self.assertEqual(fs.stored_digest(u), fs.content_digest({"title":"Edited"}))
+
+            #Posts leave no stale digest behind
+            fs.post(u, "Posted", feature="title")
+            self.assertEqual(fs.put_if_changed(u, {"title":"Edited"}), True)
+            self.assertEqual(fs.get(u), {"title":"Edited"})
+
+            fs.delete(u)
+            self.assertEqual(fs.stored_digest(u), None)
+            self.assertEqual([x for x, _ in fs.iterate()], [])
+
+@export
+class TestFileStoreWriteBatchFailures(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        fsdir = "file://" + os.path.join(self.result_dir, "file_store")
+        for num_writers in (1, 4):
+            fs = FileStore.create(session, u"TestFileStore{}".format(num_writers), fsdir + str(num_writers), num_writers=num_writers)
+            expected = dict((uuid.uuid4().hex, {"title":"Title {}".format(it)}) for it in xrange(50))
+            bad = uuid.uuid4().hex
+
+            #The failure surfaces at the flush, attributed to its own uuid
+            batch = fs.write_batch(fsync=True)
+            for it, (u, val) in enumerate(expected.iteritems()):
+                if it == 10:
+                    batch.put(bad, {"title":object()})
+                batch.put(u, val)
+            with self.assertRaises(WriteBatchError) as cm:
+                batch.flush()
+            self.assertEqual(cm.exception.failures.keys(), [bad])
+            self.assertEqual(dict(fs.get_many(expected.keys())), expected)
+
+            #Failures are only reported once
+            batch.flush()
+            batch.close()
+
+@export
+class TestFileStoreClosePools(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        fsdir = "file://" + os.path.join(self.result_dir, "file_store")
+        fs = FileStore.create(session, u"TestFileStore", fsdir, reader_pool="process")
+        expected = dict((uuid.uuid4().hex, {"title":"Title {}".format(it)}) for it in xrange(20))
+        fs.put_many(expected.iteritems())
+        self.assertEqual(dict(fs.get_many(expected.keys())), expected)
+
+        #A forked child drops the parent's pools without touching its workers
+        workers = list(fs.get_pool("reader")._pool) + list(fs.get_pool("writer")._pool)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                fs.get_pool("reader")
+                fs.close()
+            finally:
+                os._exit(0)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertTrue(all(x.is_alive() for x in workers if hasattr(x, "pid")))
+        self.assertEqual(dict(fs.get_many(expected.keys())), expected)
+
+        fs.close()
+        self.assertEqual(fs._pools, {})
+        self.assertFalse(any(x.is_alive() for x in workers))
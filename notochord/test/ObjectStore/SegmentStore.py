@@ -0,0 +1,112 @@
+from .. import InitializedTestCase
+from ...ObjectStore.SegmentStore import *
+from ...ObjectStore.Compact import CompactObjectStore
+from ...ObjectStore import ABCObjectStore
+from ... import export
+import os
+import unittest
+import uuid
+
+__all__ = []
+
+@export
+class TestSegmentStorePutGetDelete(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        ssdir = "segment://" + os.path.join(self.result_dir, "segment_store")
+        ss = SegmentStore.create(session, u"TestSegmentStore", ssdir, compression='gzip')
+        u = str(uuid.uuid4())
+        self.assertEqual(ss.exists(u), False)
+        ss.put(u, {"title":"Hello World!"})
+        self.assertEqual(ss.exists(u), True)
+        self.assertEqual(ss.get(u), {"title":"Hello World!"})
+        ss.post(u, "Goodbye World!", feature="title")
+        self.assertEqual(ss.get(u, feature="title"), "Goodbye World!")
+        ss.delete(u)
+        self.assertEqual(ss.exists(u), False)
+        self.assertRaises(IOError, ss.get, u)
+
+@export
+class TestSegmentStoreReopen(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        ssdir = "segment://" + os.path.join(self.result_dir, "segment_store")
+        ss = SegmentStore.create(session, u"TestSegmentStore", ssdir, max_segment_bytes=1024)
+        expected = dict((str(uuid.uuid4()), "DEADBEEF" * it) for it in xrange(50))
+        for u, val in expected.iteritems():
+            ss.put(u, val)
+        deleted = expected.keys()[:10]
+        for u in deleted:
+            ss.delete(u)
+            del expected[u]
+        self.assertGreater(len([x for x in os.listdir(ss.prefix_path) if x.startswith("segment-")]), 1)
+
+        #Without an index snapshot
+        reopened = ABCObjectStore.open(session, u"TestSegmentStore")
+        self.assertEqual(dict((u, reopened.get(u)) for u in expected), expected)
+        self.assertEqual(any(reopened.exists(u) for u in deleted), False)
+
+        #With an index snapshot and an unindexed tail
+        ss.flush()
+        extra = str(uuid.uuid4())
+        ss.put(extra, "Tail")
+        reopened = ABCObjectStore.open(session, u"TestSegmentStore")
+        self.assertEqual(dict((u, reopened.get(u)) for u in expected), expected)
+        self.assertEqual(reopened.get(extra), "Tail")
+
+@export
+class TestSegmentStoreCompact(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        ssdir = "segment://" + os.path.join(self.result_dir, "segment_store")
+        ss = SegmentStore.create(session, u"TestSegmentStore", ssdir, max_segment_bytes=4096)
+        session.commit()
+        keys = [str(uuid.uuid4()) for it in xrange(20)]
+        for it in xrange(5):
+            for u in keys:
+                ss.put(u, "DEADBEEF" * (it + 1))
+        for u in keys[:10]:
+            ss.delete(u)
+        ss.close()
+
+        app = CompactObjectStore(self.result_dir, object_store=u"TestSegmentStore", log=self.log)
+        app.run()
+
+        reopened = ABCObjectStore.open(session, u"TestSegmentStore")
+        self.assertEqual([reopened.exists(u) for u in keys], [False] * 10 + [True] * 10)
+        self.assertEqual([reopened.get(u) for u in keys[10:]], ["DEADBEEF" * 5] * 10)
+        size = sum(os.path.getsize(os.path.join(ss.prefix_path, x)) for x in os.listdir(ss.prefix_path) if x.startswith("segment-"))
+        self.assertLess(size, 10 * (len("DEADBEEF" * 5) + 64))
+
+@export
+class TestSegmentStoreIterate(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        ssdir = "segment://" + os.path.join(self.result_dir, "segment_store")
+        ss = SegmentStore.create(session, u"TestSegmentStore", ssdir, max_segment_bytes=1024)
+        keys = [uuid.uuid4().hex for it in xrange(30)]
+        for it, u in enumerate(keys):
+            ss.put(u, {"title":"Title {}".format(it)})
+        ss.delete(keys[0])
+        ss.put(keys[1], {"title":"Replaced"})
+
+        self.assertEqual([u for u, _ in ss.iterate()], keys[2:] + [keys[1]])
+        self.assertEqual(list(ss.iterate(feature="title", order="uuid")), sorted(
+            [(u, "Title {}".format(it)) for it, u in enumerate(keys) if it > 1] + [(keys[1], "Replaced")]
+        ))
+
+@export
+class TestSegmentStorePutMany(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        ssdir = "segment://" + os.path.join(self.result_dir, "segment_store")
+        ss = SegmentStore.create(session, u"TestSegmentStore", ssdir)
+        expected = dict((uuid.uuid4().hex, "DEADBEEF" * it) for it in xrange(50))
+        with ss.write_batch() as batch:
+            for u, val in expected.iteritems():
+                batch.put(u, val)
+            #Uncommitted records are still readable by the writer
+            self.assertEqual(dict((u, ss.get(u)) for u in expected), expected)
+
+        reopened = ABCObjectStore.open(session, u"TestSegmentStore")
+        self.assertEqual(dict((u, reopened.get(u)) for u in expected), expected)
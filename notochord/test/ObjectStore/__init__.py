@@ -1 +1,4 @@
 from .FileStore import *
+from .SegmentStore import *
+from .compression import *
+from .CachedObjectStore import *
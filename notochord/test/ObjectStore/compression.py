@@ -0,0 +1,95 @@
+from .. import InitializedTestCase, PopulatedTestCase
+from ...ObjectStore.FileStore import *
+from ...ObjectStore.compression import *
+from ...ObjectStore.Benchmark import BenchmarkCompression
+from ...ObjectStore.TrainDictionary import TrainCompressionDictionary
+from ...ObjectStore import ABCObjectStore
+from ... import export
+import json
+import os
+import unittest
+import uuid
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+__all__ = []
+
+@export
+@unittest.skipUnless(zstandard is not None, "zstandard is not installed")
+class TestFileStoreZstdPutGet(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        fsdir = "file://" + os.path.join(self.result_dir, "file_store")
+        fs = FileStore.create(session, u"TestFileStore", fsdir, compression='zstd', compression_level=1)
+        u = str(uuid.uuid4())
+        fs.put(u, {"title":"Hello World!"})
+        with open(fs.uuid2path(u), 'rb') as fin:
+            self.assertEqual(detect_codec(fin.read()), 'zstd')
+        self.assertEqual(fs.get(u), {"title":"Hello World!"})
+
+@export
+@unittest.skipUnless(lz4 is not None, "lz4 is not installed")
+class TestFileStoreLz4PutGet(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        fsdir = "file://" + os.path.join(self.result_dir, "file_store")
+        fs = FileStore.create(session, u"TestFileStore", fsdir, compression='lz4')
+        u = str(uuid.uuid4())
+        fs.put(u, {"title":"Hello World!"})
+        with open(fs.uuid2path(u), 'rb') as fin:
+            self.assertEqual(detect_codec(fin.read()), 'lz4')
+        self.assertEqual(fs.get(u), {"title":"Hello World!"})
+
+@export
+@unittest.skipUnless(zstandard is not None, "zstandard is not installed")
+class TestFileStoreChangeCompression(InitializedTestCase):
+    def runTest(self):
+        session = self.Session()
+        fsdir = "file://" + os.path.join(self.result_dir, "file_store")
+        fs = FileStore.create(session, u"TestFileStore", fsdir, compression='gzip')
+        old = str(uuid.uuid4())
+        fs.put(old, {"title":"Old"})
+
+        fs = FileStore.create(session, u"TestFileStore2", fsdir, compression='zstd')
+        new = str(uuid.uuid4())
+        fs.put(new, {"title":"New"})
+        self.assertEqual(fs.get(old), {"title":"Old"})
+        self.assertEqual(fs.get(new), {"title":"New"})
+
+@export
+@unittest.skipUnless(zstandard is not None, "zstandard is not installed")
+class TestTrainCompressionDictionary(PopulatedTestCase):
+    def runTest(self):
+        session = self.Session()
+        object_store = ABCObjectStore.open(session, u"file_store")
+        uuids = [u for u, in session.execute("SELECT uuid FROM widget LIMIT 10")]
+        expected = dict((u, object_store.get(u)) for u in uuids)
+
+        app = TrainCompressionDictionary(self.result_dir, object_store=u"file_store", dictionary_size=4096, log=self.log)
+        app.run()
+
+        session = self.Session()
+        reopened = ABCObjectStore.open(session, u"file_store")
+        self.assertEqual(reopened.compression, "zstd")
+        self.assertIsNotNone(reopened.compression_dictionary)
+
+        #Objects written before training remain readable
+        self.assertEqual(dict((u, reopened.get(u)) for u in uuids), expected)
+
+        u = str(uuid.uuid4())
+        reopened.put(u, expected[uuids[0]])
+        with open(reopened.uuid2path(u), 'rb') as fin:
+            data = fin.read()
+        self.assertEqual(zstandard.get_frame_parameters(data).dict_id, reopened.compression_dictionary)
+        self.assertEqual(ABCObjectStore.open(session, u"file_store").get(u), expected[uuids[0]])
+
+        app = BenchmarkCompression(self.result_dir, object_store=u"file_store", sample_size=50, dictionary_size=4096, log=self.log)
+        app.run()
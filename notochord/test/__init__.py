@@ -1,9 +1,12 @@
 from .util import *
 from .TestApp import *
+from .ObjectStore import *
 from .features import *
+from .tokenize import *
 from .ingest import *
 from .dim_reduce import *
 from .classifier import *
+from .serve import *
 from .initialize import *
 from .Model import *
 from .create_temporary import *
@@ -1,7 +1,7 @@
 from ..Model import ModelSet, Model
 
 from . import PopulatedTestCase, datadir_session
-from .. import export, schema, grouper, get_utcnow, temporary_table_like, temptable_scope
+from .. import export, schema, grouper, get_utcnow, temporary_table_like, temptable_scope, bulk_load, bulk_load_arrays, lookup_or_persist, FeatureCache
 import unittest
 import time
 import random
@@ -10,6 +10,7 @@ import datetime
 import iso8601
 import itertools
 import numpy as np
+import struct
 
 __all__ = []
 
@@ -47,3 +48,98 @@ class TestModel(PopulatedTestCase):
 
             
 
+
+@export
+class TestBulkLoad(PopulatedTestCase):
+    def runTest(self):
+        t_w = schema.widget
+        t_wf = schema.widget_feature
+        t_fs = schema.feature_set
+
+        session = datadir_session(self.result_dir)
+        try:
+            fs = lookup_or_persist(session, t_fs, name=u"bulk_load_test")
+            features = FeatureCache(16)(session, fs.idfeature_set, [u"a", u"b"])
+            widgets = [x.idwidget for x in session.query(t_w.idwidget).order_by(t_w.idwidget).limit(3)]
+            self.assertEqual(len(widgets), 3)
+
+            def observed():
+                return sorted(
+                    (x.idwidget, x.idfeature, x.value)
+                    for x in session.query(t_wf).filter(t_wf.idfeature.in_(features))
+                )
+
+            rows = [(w, f, 1.0) for w in widgets for f in features]
+            self.assertEqual(bulk_load(session, t_wf, ["idwidget", "idfeature", "value"], iter(rows)), len(rows))
+            self.assertEqual(observed(), sorted(rows))
+
+            bulk_load(session, t_wf, ["idwidget", "idfeature", "value"], [(widgets[0], features[0], 2.0)], on_conflict="ignore")
+            self.assertEqual(observed(), sorted(rows))
+
+            bulk_load(session, t_wf, ["idwidget", "idfeature", "value"], [(widgets[0], features[0], 2.0)], on_conflict="replace")
+            self.assertEqual(observed(), sorted([(widgets[0], features[0], 2.0)] + rows[1:]))
+
+            with self.assertRaises(ValueError):
+                bulk_load(session, t_wf, ["idwidget", "idfeature", "value"], [], on_conflict="merge")
+
+            arrays = [np.repeat(widgets, len(features)), np.tile(features, len(widgets)), np.arange(len(rows), dtype=np.float64)]
+            self.assertEqual(bulk_load_arrays(session, t_wf, ["idwidget", "idfeature", "value"], arrays, on_conflict="replace", batch_size=4), len(rows))
+            self.assertEqual(observed(), sorted(zip(*[x.tolist() for x in arrays])))
+
+            with self.assertRaises(ValueError):
+                bulk_load_arrays(session, t_wf, ["idwidget", "idfeature", "value"], [arrays[0], arrays[1][:1], arrays[2]])
+        finally:
+            session.rollback()
+            session.bind.dispose()
+
+@export
+class TestBulkLoadStaged(PopulatedTestCase):
+    def runTest(self):
+        from ..util import bulk_load_staged
+        t_w = schema.widget
+        t_wf = schema.widget_feature
+        t_fs = schema.feature_set
+
+        #The fallback for dialects without a fast path, run on sqlite
+        session = datadir_session(self.result_dir)
+        try:
+            fs = lookup_or_persist(session, t_fs, name=u"bulk_load_test")
+            features = FeatureCache(16)(session, fs.idfeature_set, [u"a", u"b"])
+            widgets = [x.idwidget for x in session.query(t_w.idwidget).order_by(t_w.idwidget).limit(3)]
+            columns = ["idwidget", "idfeature", "value"]
+
+            def observed():
+                return sorted(
+                    (x.idwidget, x.idfeature, x.value)
+                    for x in session.query(t_wf).filter(t_wf.idfeature.in_(features))
+                )
+
+            rows = [(w, f, 1.0) for w in widgets[:2] for f in features]
+            bulk_load(session, t_wf, columns, rows)
+
+            changed = [(widgets[0], features[0], 2.0), (widgets[2], features[0], 2.0)]
+            self.assertEqual(bulk_load_staged(session, t_wf.__table__, columns, iter(changed), "ignore", batch_size=1), 2)
+            self.assertEqual(observed(), sorted(rows + changed[1:]))
+
+            changed = [(widgets[0], features[0], 3.0), (widgets[2], features[1], 3.0)]
+            self.assertEqual(bulk_load_staged(session, t_wf.__table__, columns, iter(changed), "replace"), 2)
+            self.assertEqual(observed(), sorted([(widgets[0], features[0], 3.0)] + rows[1:] + [(widgets[2], features[0], 2.0), changed[1]]))
+        finally:
+            session.rollback()
+            session.bind.dispose()
+
+@export
+class TestCopyBinaryRows(unittest.TestCase):
+    def runTest(self):
+        from ..util import copy_binary_rows, copy_binary_header, copy_binary_trailer
+        t_wf = schema.widget_feature.__table__
+
+        data = copy_binary_rows(t_wf, ["idwidget", "idfeature", "value"], [np.array([1, 2]), np.array([3, 4]), np.array([0.5, -1.0])])
+        self.assertTrue(data.startswith(copy_binary_header))
+        self.assertTrue(data.endswith(copy_binary_trailer))
+
+        row = struct.Struct(">hiiiiid")
+        body = data[len(copy_binary_header):-len(copy_binary_trailer)]
+        self.assertEqual(len(body), 2 * row.size)
+        self.assertEqual(row.unpack_from(body, 0), (3, 4, 1, 4, 3, 8, 0.5))
+        self.assertEqual(row.unpack_from(body, row.size), (3, 4, 2, 4, 4, 8, -1.0))
@@ -34,3 +34,38 @@ class TestLSITrain_Run(FeaturePopulatedTestCase):
     def runTest(self):
         app = LSITrain(self.result_dir, log=self.log)
         app.main()
+
+@export
+class TestLSITrain_RunPruned(FeaturePopulatedTestCase):
+    def runTest(self):
+        app = LSITrain.from_args([
+            "--datadir={}".format(self.result_dir),
+            "--min-df=2",
+            "--max-df=0.9",
+            "--max-features=20"
+        ])
+        app.main()
+
+        session = app.get_session()
+        features = [x for x, in session.execute("SELECT idfeature FROM model_trained_on_input_feature")]
+        self.assertGreater(len(features), 0)
+        self.assertLessEqual(len(features), 20)
+
+        num_widgets = session.execute("SELECT COUNT(*) FROM widget").scalar()
+        for idfeature in features:
+            df = session.execute("SELECT COUNT(*) FROM widget_feature WHERE idfeature = {}".format(idfeature)).scalar()
+            self.assertGreaterEqual(df, 2)
+            self.assertLessEqual(df, 0.9 * num_widgets)
+
+@export
+class TestDocumentFrequency(unittest.TestCase):
+    def runTest(self):
+        import argparse
+        from ... import document_frequency
+        self.assertEqual(document_frequency("1"), 1)
+        self.assertIsInstance(document_frequency("1"), int)
+        self.assertEqual(document_frequency("1.0"), 1.0)
+        self.assertEqual(document_frequency("1e-3"), 0.001)
+        self.assertEqual(document_frequency("0.5"), 0.5)
+        for value in ("0.0", "1.5", "-0.5", "many"):
+            self.assertRaises(argparse.ArgumentTypeError, document_frequency, value)
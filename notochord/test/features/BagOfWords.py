@@ -1,6 +1,7 @@
 from ...features.BagOfWords import BagOfWords
-from .. import PopulatedTestCase
-from ... import export
+from .. import PopulatedTestCase, default_test_config
+from ... import export, PersistentFeatureCache
+import os
 import unittest
 
 __all__ = []
@@ -23,3 +24,131 @@ class TestBagOfWords_Run(PopulatedTestCase):
         app = BagOfWords(self.result_dir)
         app.run()
         session = app.get_session()
+
+@export
+class TestBagOfWords_RunWorkers(PopulatedTestCase):
+    def runTest(self):
+        app = BagOfWords(self.result_dir, chunk_size=4)
+        app.run()
+        session = app.get_session()
+        serial = sorted(session.execute("SELECT wf.idwidget, f.name, wf.value FROM widget_feature wf JOIN feature f USING (idfeature) JOIN feature_set fs USING (idfeature_set) WHERE fs.name = 'title_bag_of_words'").fetchall())
+        session.execute("DELETE FROM widget_feature WHERE idfeature IN (SELECT idfeature FROM feature f JOIN feature_set fs USING (idfeature_set) WHERE fs.name = 'title_bag_of_words')")
+        session.commit()
+        session.close()
+
+        app = BagOfWords(self.result_dir, chunk_size=4, workers=2)
+        app.run()
+        session = app.get_session()
+        parallel = sorted(session.execute("SELECT wf.idwidget, f.name, wf.value FROM widget_feature wf JOIN feature f USING (idfeature) JOIN feature_set fs USING (idfeature_set) WHERE fs.name = 'title_bag_of_words'").fetchall())
+        self.assertGreater(len(serial), 0)
+        self.assertEqual(parallel, serial)
+
+@export
+class TestBagOfWords_RunHashed(PopulatedTestCase):
+    def runTest(self):
+        app = BagOfWords(self.result_dir, output_feature_set=u"title_hashed", hash_buckets=64, workers=2)
+        app.run()
+        session = app.get_session()
+        names = [name for name, in session.execute("SELECT f.name FROM feature f JOIN feature_set fs USING (idfeature_set) WHERE fs.name = 'title_hashed'")]
+        self.assertEqual(sorted(names, key=int), [unicode(x) for x in xrange(64)])
+        num_values = session.execute("SELECT COUNT(*) FROM widget_feature wf JOIN feature f USING (idfeature) JOIN feature_set fs USING (idfeature_set) WHERE fs.name = 'title_hashed'").fetchone()[0]
+        self.assertGreater(num_values, 0)
+        session.close()
+
+        #A feature set keeps the settings it was first built with
+        app = BagOfWords(self.result_dir, output_feature_set=u"title_hashed", hash_buckets=32)
+        self.assertRaises(ValueError, app.run)
+
+@export
+class TestBagOfWords_RunIncremental(PopulatedTestCase):
+    def runTest(self):
+        query = "SELECT wf.idwidget, f.name, wf.value FROM widget_feature wf JOIN feature f USING (idfeature) JOIN feature_set fs USING (idfeature_set) WHERE fs.name = '{}'"
+
+        app = BagOfWords(self.result_dir, output_feature_set=u"title_full")
+        app.run()
+
+        app = BagOfWords(self.result_dir, incremental=True, max_idwidget=10)
+        app.run()
+        session = app.get_session()
+        partial = session.execute(query.format("title_bag_of_words")).fetchall()
+        self.assertGreater(len(partial), 0)
+        self.assertEqual(max(idwidget for idwidget, _, _ in partial), 9)
+        self.assertEqual([x for x, in session.execute("SELECT idwidget FROM feature_set_watermark JOIN feature_set USING (idfeature_set) WHERE name = 'title_bag_of_words'")], [9])
+        session.close()
+
+        for it in xrange(2):
+            app = BagOfWords(self.result_dir, incremental=True)
+            app.run()
+            session = app.get_session()
+            self.assertEqual(
+                sorted(session.execute(query.format("title_bag_of_words")).fetchall()),
+                sorted(session.execute(query.format("title_full")).fetchall())
+            )
+            session.close()
+
+@export
+class TestBagOfWords_RunFeatureCache(PopulatedTestCase):
+    def runTest(self):
+        query = "SELECT wf.idwidget, f.name, wf.value FROM widget_feature wf JOIN feature f USING (idfeature) JOIN feature_set fs USING (idfeature_set) WHERE fs.name = '{}'"
+
+        app = BagOfWords(self.result_dir, output_feature_set=u"title_full")
+        app.run()
+
+        #The first run preloads an empty cache, the second resolves
+        #everything from the file the first one saved
+        for it in xrange(2):
+            app = BagOfWords(self.result_dir, output_feature_set=u"title_cached", feature_cache="feature_cache")
+            app.run()
+            session = app.get_session()
+            self.assertEqual(
+                sorted(session.execute(query.format("title_cached")).fetchall()),
+                sorted(session.execute(query.format("title_full")).fetchall())
+            )
+
+            idfeature_set, = session.execute("SELECT idfeature_set FROM feature_set WHERE name = 'title_cached'").fetchone()
+            expected = dict(session.execute("SELECT name, idfeature FROM feature WHERE idfeature_set = {}".format(idfeature_set)).fetchall())
+            FC = PersistentFeatureCache(os.path.join(self.result_dir, "feature_cache"))
+            names = sorted(expected)
+            self.assertEqual(FC(session, idfeature_set, names), [expected[x] for x in names])
+            self.assertEqual(FC.pending[idfeature_set], {})
+            FC.close()
+            session.close()
+
+@export
+class TestBagOfWords_RunBigrams(PopulatedTestCase):
+    def runTest(self):
+        config = dict(default_test_config['BagOfWords'], output_feature_set=u"title_bigrams", analyzer={"ngram_range": [1, 2], "min_length": 2})
+        app = BagOfWords(self.result_dir, config=config, workers=2)
+        app.run()
+        session = app.get_session()
+        names = [name for name, in session.execute("SELECT f.name FROM feature f JOIN feature_set fs USING (idfeature_set) WHERE fs.name = 'title_bigrams'")]
+        self.assertTrue(any(u" " in x for x in names))
+        self.assertTrue(all(len(x) >= 2 for x in names))
+
+@export
+class TestBagOfWords_RunFeatureCacheRollback(PopulatedTestCase):
+    def runTest(self):
+        from ...features import BagOfWords as module
+        def failing_persist(*args, **kwargs):
+            raise RuntimeError("Watermark update failed")
+
+        #Fails after every chunk is uploaded, just before the commit
+        persist = module.persist
+        module.persist = failing_persist
+        try:
+            app = BagOfWords(self.result_dir, output_feature_set=u"title_cached", feature_cache="feature_cache", incremental=True)
+            self.assertRaises(RuntimeError, app.run)
+        finally:
+            module.persist = persist
+
+        #The features resolved before the failure were rolled back, so the
+        #cache file must not have kept their ids
+        session = app.get_session()
+        idfeature_set = session.execute("SELECT idfeature_set FROM feature_set WHERE name = 'title_cached'").fetchone()
+        self.assertIsNone(idfeature_set)
+        for name in os.listdir(os.path.join(self.result_dir, "feature_cache")):
+            if name.endswith(".features"):
+                FC = PersistentFeatureCache(os.path.join(self.result_dir, "feature_cache"))
+                self.assertEqual(list(FC.table(session, int(name.split(".")[0])).items()), [])
+                FC.close()
+        session.close()
@@ -0,0 +1,94 @@
+from ...features.BagOfWords import BagOfWords
+from ...features.TermWeighting import TermWeighting
+from .. import PopulatedTestCase
+from ... import export
+import collections
+import json
+import math
+import unittest
+
+__all__ = []
+
+query = "SELECT wf.idwidget, f.name, wf.value FROM widget_feature wf JOIN feature f USING (idfeature) JOIN feature_set fs USING (idfeature_set) WHERE fs.name = '{}'"
+
+@export
+class TestTermWeighting_Run(PopulatedTestCase):
+    def runTest(self):
+        BagOfWords(self.result_dir).run()
+        app = TermWeighting(self.result_dir)
+        app.run()
+
+        session = app.get_session()
+        counts = session.execute(query.format("title_bag_of_words")).fetchall()
+        num_documents = len(set(idwidget for idwidget, _, _ in counts))
+        document_count = collections.Counter(name for _, name, _ in counts)
+        expected = sorted(
+            (idwidget, name, value * (math.log((1.0 + num_documents) / (1.0 + document_count[name])) + 1.0))
+            for idwidget, name, value in counts
+        )
+        observed = sorted(session.execute(query.format("tfidf(title_bag_of_words)")).fetchall())
+        self.assertEqual([x[:2] for x in observed], [x[:2] for x in expected])
+        for (_, _, a), (_, _, b) in zip(observed, expected):
+            self.assertAlmostEqual(a, b)
+
+@export
+class TestTermWeighting_RunIncremental(PopulatedTestCase):
+    def runTest(self):
+        statistics = "SELECT f.name, s.document_count, s.total_count, s.entropy_sum FROM feature_statistics s JOIN feature f USING (idfeature) JOIN feature_set fs ON fs.idfeature_set = s.idfeature_set WHERE fs.name = '{}'"
+
+        BagOfWords(self.result_dir, max_idwidget=10).run()
+        TermWeighting(self.result_dir, output_feature_set=u"partial", weighting="logentropy").run()
+        BagOfWords(self.result_dir).run()
+        TermWeighting(self.result_dir, output_feature_set=u"partial", weighting="logentropy").run()
+        app = TermWeighting(self.result_dir, output_feature_set=u"full", weighting="logentropy")
+        app.run()
+
+        session = app.get_session()
+        partial = sorted(session.execute(statistics.format("partial")).fetchall())
+        full = sorted(session.execute(statistics.format("full")).fetchall())
+        self.assertGreater(len(full), 0)
+        self.assertEqual([x[:2] for x in partial], [x[:2] for x in full])
+        for a, b in zip(partial, full):
+            self.assertAlmostEqual(a[2], b[2])
+            self.assertAlmostEqual(a[3], b[3])
+
+        counts = "SELECT SUM(widget_count) FROM feature_set_watermark JOIN feature_set USING (idfeature_set) WHERE name = '{}'"
+        self.assertEqual(session.execute(counts.format("partial")).scalar(), session.execute(counts.format("full")).scalar())
+        self.assertEqual(
+            sorted(x[:2] for x in session.execute(query.format("partial"))),
+            sorted(x[:2] for x in session.execute(query.format("full")))
+        )
+
+        #The weighting is recorded, and a different one can't extend the set
+        recorded = session.execute("SELECT kwargs FROM feature_set WHERE name = 'full'").scalar()
+        self.assertEqual(json.loads(recorded), dict(input_feature_set=u"title_bag_of_words", weighting=u"logentropy", analyzer=None, hash_buckets=None))
+        self.assertRaises(ValueError, TermWeighting(self.result_dir, output_feature_set=u"full", weighting="tfidf").main)
+
+@export
+class TestTermWeighting_RunOutOfOrder(PopulatedTestCase):
+    def runTest(self):
+        statistics = "SELECT f.name, s.document_count FROM feature_statistics s JOIN feature f USING (idfeature) JOIN feature_set fs ON fs.idfeature_set = s.idfeature_set WHERE fs.name = '{}'"
+
+        #Work orders finishing out of order leave a gap above the watermark
+        BagOfWords(self.result_dir, max_idwidget=10).run()
+        BagOfWords(self.result_dir, min_idwidget=20).run()
+        app = TermWeighting(self.result_dir, output_feature_set=u"partial")
+        app.run()
+        session = app.get_session()
+        self.assertEqual(session.execute(query.format("partial") + " AND wf.idwidget >= 10").fetchall(), [])
+        session.close()
+
+        BagOfWords(self.result_dir, min_idwidget=10, max_idwidget=20).run()
+        BagOfWords(self.result_dir, incremental=True).run()
+        TermWeighting(self.result_dir, output_feature_set=u"partial").run()
+        app = TermWeighting(self.result_dir, output_feature_set=u"full")
+        app.run()
+
+        session = app.get_session()
+        full = sorted(session.execute(statistics.format("full")).fetchall())
+        self.assertGreater(len(full), 0)
+        self.assertEqual(sorted(session.execute(statistics.format("partial")).fetchall()), full)
+        self.assertEqual(
+            sorted(x[:2] for x in session.execute(query.format("partial"))),
+            sorted(x[:2] for x in session.execute(query.format("full")))
+        )
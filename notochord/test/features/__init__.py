@@ -1,2 +1,3 @@
 from .BagOfWords import *
 from .Datasource import *
+from .TermWeighting import *
@@ -0,0 +1,157 @@
+from ...serve.Scoring import *
+from ...serve.Scoring import input_feature_names
+from .. import LSIPopulatedTestCase, FeaturePopulatedTestCase, default_test_config
+from ... import export, schema, ModelSet
+from ...features.TermWeighting import TermWeighting
+from ...dim_reduce.LSI import LSITrain
+import json
+import threading
+import unittest
+import urllib2
+
+import numpy as np
+import scipy as sp
+import scipy.sparse
+
+__all__ = []
+
+def widget_documents(session, num_widgets):
+    "Rebuilds documents with the same bag of words as some scored widgets"
+    query = "SELECT wf.idwidget, f.name, wf.value FROM widget_feature wf JOIN feature f USING (idfeature) JOIN feature_set fs USING (idfeature_set) WHERE fs.name = 'title_bag_of_words' ORDER BY wf.idwidget"
+    words = {}
+    for idwidget, name, value in session.execute(query):
+        words.setdefault(idwidget, []).extend([name] * int(value))
+    idwidgets = sorted(words)[:num_widgets]
+    return idwidgets, [u" ".join(words[x]) for x in idwidgets]
+
+@export
+class TestScoringService_Score(LSIPopulatedTestCase):
+    def runTest(self):
+        app = ScoringService(self.result_dir, log=self.log)
+        app.load()
+
+        session = app.get_session()
+        idwidgets, documents = widget_documents(session, 5)
+        self.assertEqual(len(documents), 5)
+
+        #The words stored for each widget, in the model's column order
+        columns = dict((name, it) for it, name in enumerate(input_feature_names(session, ModelSet(session, app.config["model_name"]).latest_model())))
+        expected = np.zeros((len(idwidgets), len(columns)), dtype=np.float32)
+        for it, document in enumerate(documents):
+            for word in document.split():
+                if word in columns:
+                    expected[it, columns[word]] += 1
+        session.close()
+        np.testing.assert_array_equal(app.build_matrix(documents).toarray(), expected)
+
+        vectors, classes = app.score_documents(documents + [u"", u"zzzunknownzzz"])
+        self.assertIsNone(classes)
+        self.assertEqual(vectors.shape, (len(documents) + 2, len(app.output_names)))
+        np.testing.assert_allclose(vectors[:len(documents)], app.package.transform(sp.sparse.csr_matrix(expected)), rtol=1e-5, atol=1e-5)
+        np.testing.assert_array_equal(vectors[len(documents):], 0)
+
+@export
+class TestScoringService_Serve(LSIPopulatedTestCase):
+    def runTest(self):
+        app = ScoringService(self.result_dir, log=self.log)
+        app.start()
+        thread = threading.Thread(target=app.server.serve_forever)
+        thread.start()
+        try:
+            url = "http://{}:{}".format(*app.server.server_address)
+            session = app.get_session()
+            _, documents = widget_documents(session, 8)
+            session.close()
+            expected, _ = app.score_documents(documents)
+
+            #Concurrent requests are scored in shared batches
+            results = [None] * len(documents)
+            def post(it):
+                request = urllib2.Request(url + "/score", json.dumps(dict(documents=[documents[it]])), {"Content-Type": "application/json"})
+                results[it] = json.loads(urllib2.urlopen(request).read())
+            threads = [threading.Thread(target=post, args=(it,)) for it in xrange(len(documents))]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            for it, result in enumerate(results):
+                self.assertEqual(result['model'], app.model_uuid)
+                np.testing.assert_allclose(result['vectors'], expected[it:it + 1], rtol=1e-5, atol=1e-5)
+
+            stats = json.loads(urllib2.urlopen(url + "/stats").read())
+            self.assertEqual((stats['requests'], stats['documents'], stats['errors']), (len(documents), len(documents), 0))
+            self.assertLessEqual(stats['batches'], len(documents))
+            self.assertAlmostEqual(stats['mean_batch_size'], float(stats['documents']) / stats['batches'])
+            self.assertGreater(stats['throughput'], 0)
+            self.assertLessEqual(stats['p50_ms'], stats['p99_ms'])
+
+            with self.assertRaises(urllib2.HTTPError) as e:
+                urllib2.urlopen(urllib2.Request(url + "/score", json.dumps(dict(documents=[1]))))
+            self.assertEqual(e.exception.code, 400)
+        finally:
+            app.stop()
+            thread.join()
+
+@export
+class TestScoringService_MainSocket(LSIPopulatedTestCase):
+    def runTest(self):
+        import os
+        import time
+        app = ScoringService(self.result_dir, log=self.log, socket="scoring.sock")
+        path = os.path.join(self.result_dir, "scoring.sock")
+        thread = threading.Thread(target=app.main)
+        thread.start()
+        try:
+            for it in xrange(500):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.01)
+            self.assertTrue(os.path.exists(path))
+        finally:
+            if app.server is not None:
+                app.server.shutdown()
+            thread.join()
+        #main cleans up like stop does
+        self.assertFalse(os.path.exists(path))
+
+@export
+class TestScoringService_TokenizerMismatch(LSIPopulatedTestCase):
+    def runTest(self):
+        #The model's features were built without hashing
+        app = ScoringService(self.result_dir, log=self.log, config=dict(default_test_config['ScoringService'], hash_buckets=64))
+        self.assertRaises(ValueError, app.load)
+
+        #Without recorded settings, hashing is checked against the feature names
+        session = app.get_session()
+        session.execute("UPDATE feature_set SET kwargs = NULL")
+        session.commit()
+        session.close()
+        self.assertRaises(ValueError, app.load)
+
+        app = ScoringService(self.result_dir, log=self.log)
+        app.load()
+        self.assertIsNone(app.tokenizer.hash_buckets)
+
+@export
+class TestScoringService_Weighted(FeaturePopulatedTestCase):
+    def runTest(self):
+        for weighting in ("tfidf", "logentropy"):
+            TermWeighting(self.result_dir, log=self.log, weighting=weighting).run()
+            model_name = u"LSI{}UnitTest".format(weighting)
+            LSITrain(self.result_dir, log=self.log, model_name=model_name,
+                input_feature_set=u"{}(title_bag_of_words)".format(weighting),
+                output_feature_set=u"LSI({}(title_bag_of_words))".format(weighting)).run()
+
+            app = ScoringService(self.result_dir, log=self.log, model_name=model_name)
+            app.load()
+            self.assertIsNotNone(app.local_weights)
+
+            #The service weights documents like the widgets the model was trained on
+            session = app.get_session()
+            idwidgets, documents = widget_documents(session, 5)
+            model = ModelSet(session, model_name).latest_model()
+            predictions = dict(model.get_predictions([x for x, in model.query_predicts_features()]))
+            session.close()
+            vectors, _ = app.score_documents(documents)
+            np.testing.assert_allclose(vectors, [predictions[x] for x in idwidgets], rtol=1e-4, atol=1e-4)
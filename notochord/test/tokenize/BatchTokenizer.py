@@ -0,0 +1,103 @@
+from ...tokenize.BatchTokenizer import *
+from ... import export
+import collections
+import unittest
+
+__all__ = []
+
+def counter_triples(documents, hash_buckets=None):
+    ret = collections.Counter()
+    for it, content in enumerate(documents):
+        if content is None:
+            continue
+        for x in re_word.finditer(content):
+            word = x.group(0).lower()
+            ret[it, word if hash_buckets is None else hash_word(word, hash_buckets)] += 1
+    return sorted((it, word, count) for (it, word), count in ret.iteritems())
+
+def chunk_triples(chunk):
+    ret = []
+    for it in xrange(len(chunk.indptr) - 1):
+        for pos in xrange(chunk.indptr[it], chunk.indptr[it + 1]):
+            word = chunk.word_ids[pos] if chunk.vocab is None else chunk.vocab[chunk.word_ids[pos]]
+            ret.append((it, word, chunk.counts[pos]))
+    return sorted(ret)
+
+documents = [
+    u"The quick brown fox -- the QUICK brown dog.",
+    None,
+    u"",
+    u"Kelvin \u212aelvin and \u0130stanbul stay split: caf\xe9 na\xefve",
+    "plain str document, with str words",
+    u"123 456 !!!",
+    u"fox fox fox"
+]
+
+@export
+class TestBatchTokenizerMatchesCounter(unittest.TestCase):
+    def runTest(self):
+        chunk = BatchTokenizer()(documents)
+        self.assertEqual(len(chunk.indptr), len(documents) + 1)
+        self.assertEqual(chunk_triples(chunk), counter_triples(documents))
+        self.assertEqual(len(set(chunk.vocab)), len(chunk.vocab))
+
+@export
+class TestBatchTokenizerHashed(unittest.TestCase):
+    def runTest(self):
+        chunk = BatchTokenizer(hash_buckets=7)(documents)
+        self.assertIsNone(chunk.vocab)
+        self.assertEqual(chunk_triples(chunk), counter_triples(documents, hash_buckets=7))
+
+@export
+class TestBatchTokenizerEmpty(unittest.TestCase):
+    def runTest(self):
+        chunk = BatchTokenizer()([None, u"..."])
+        self.assertEqual(chunk.indptr.tolist(), [0, 0, 0])
+        self.assertEqual(chunk_triples(chunk), [])
+
+def analyzer_triples(documents, ngram_range, stop_words=(), min_length=1, pattern=re_word):
+    ret = collections.Counter()
+    for it, content in enumerate(documents):
+        if content is None:
+            continue
+        words = [x.lower() for x in pattern.findall(content)]
+        words = [x for x in words if len(x) >= min_length and x not in stop_words]
+        for n in xrange(ngram_range[0], ngram_range[1] + 1):
+            for pos in xrange(len(words) - n + 1):
+                ret[it, u" ".join(words[pos:pos + n])] += 1
+    return sorted((it, word, count) for (it, word), count in ret.iteritems())
+
+@export
+class TestBatchTokenizerNgrams(unittest.TestCase):
+    def runTest(self):
+        for ngram_range in [(1, 2), (2, 3), (3, 3)]:
+            chunk = BatchTokenizer(ngram_range=ngram_range)(documents)
+            self.assertEqual(chunk_triples(chunk), analyzer_triples(documents, ngram_range))
+            self.assertEqual(len(set(chunk.vocab)), len(chunk.vocab))
+
+        chunk = BatchTokenizer(ngram_range=(2, 2), hash_buckets=11)(documents)
+        expected = collections.Counter()
+        for it, word, count in analyzer_triples(documents, (2, 2)):
+            expected[it, hash_word(word, 11)] += count
+        self.assertEqual(chunk_triples(chunk), sorted((it, word, count) for (it, word), count in expected.iteritems()))
+
+        chunk = BatchTokenizer(ngram_range=(4, 4))([u"too short", None])
+        self.assertEqual(chunk.indptr.tolist(), [0, 0, 0])
+
+@export
+class TestBatchTokenizerAnalyzer(unittest.TestCase):
+    def runTest(self):
+        tokenizer = BatchTokenizer.from_config({"ngram_range": [1, 2], "stop_words": ["the", "and"], "min_length": 3, "unicode": True})
+        self.assertEqual(
+            chunk_triples(tokenizer(documents)),
+            analyzer_triples(documents, (1, 2), stop_words=("the", "and"), min_length=3, pattern=re_unicode_word)
+        )
+        self.assertIn(u"caf\xe9 na\xefve", tokenizer(documents).vocab)
+
+        tokenizer = BatchTokenizer.from_config({"stop_words": "english"})
+        self.assertNotIn(u"the", tokenizer(documents).vocab)
+
+        with self.assertRaises(KeyError):
+            BatchTokenizer.from_config({"stop_words": "klingon"})
+        with self.assertRaises(ValueError):
+            BatchTokenizer(ngram_range=(2, 1))
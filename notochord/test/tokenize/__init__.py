@@ -0,0 +1 @@
+from .BatchTokenizer import *
@@ -72,6 +72,11 @@ default_test_config = json.loads(json.dumps({
         "datasources": [u"test_data"],
         "chunk_size": 16384
     },
+    "TermWeighting": {
+        "input_feature_set":u"title_bag_of_words",
+        "weighting":"tfidf",
+        "datasources": [u"test_data"]
+    },
     "LSITrain": {
         "model_name":u"LSIUnitTest",
         "input_feature_set":u"title_bag_of_words",
@@ -86,6 +91,12 @@ default_test_config = json.loads(json.dumps({
         "hyperparameters":{
             "n_estimators":100
         }
+    },
+    "ScoringService": {
+        "model_name":u"LSIUnitTest",
+        "host":"127.0.0.1",
+        "port":0,
+        "max_delay":20.0
     }
 }))
 
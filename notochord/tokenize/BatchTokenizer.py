@@ -0,0 +1,160 @@
+from .. import export
+import collections
+import itertools
+import numpy as np
+import re
+import zlib
+
+re_word = re.compile(r'[a-zA-Z]+')
+
+__all__ = ["re_word", "re_unicode_word"]
+
+TokenizedChunk = collections.namedtuple("TokenizedChunk", ["indptr", "word_ids", "counts", "vocab"])
+
+@export
+def hash_word(word, hash_buckets):
+    "Stable across processes and runs, unlike hash()"
+    return (zlib.crc32(word.encode('utf-8')) & 0xffffffff) % hash_buckets
+
+#Letters in any script, for analyzers configured with "unicode"
+re_unicode_word = re.compile(r'[^\W\d_]+', re.UNICODE)
+
+@export
+def build_stop_words(stop_words):
+    if stop_words is None:
+        return frozenset()
+    elif stop_words == "english":
+        from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+        return frozenset(ENGLISH_STOP_WORDS)
+    elif isinstance(stop_words, basestring):
+        raise KeyError("Invalid stop word list: '{}'".format(stop_words))
+    else:
+        return frozenset(x.lower() for x in stop_words)
+
+@export
+class BatchTokenizer(object):
+    """Counts the words of a chunk of documents at once
+
+    Returns CSR style arrays: the words of document i are
+    word_ids[indptr[i]:indptr[i+1]] with matching counts, sorted by word id.
+    Word ids index the chunk-local vocab, or are bucket numbers when
+    hash_buckets is set (vocab is then None).  Words are matched on the
+    original text and lowercased afterwards, exactly like
+    x.group(0).lower() for x in re_word.finditer(content).  Documents that
+    are None produce empty rows.
+
+    Words shorter than min_length or in stop_words are dropped before
+    n-grams are formed, and n-grams are named by their words joined with
+    spaces.  N-grams are counted as rows of word ids, so only the distinct
+    n-grams of a chunk are ever built as strings.
+    """
+    def __init__(self, pattern=re_word, hash_buckets=None, ngram_range=(1, 1), stop_words=None, min_length=1):
+        self.pattern = pattern
+        self.hash_buckets = hash_buckets
+        self.ngram_range = tuple(ngram_range)
+        self.stop_words = build_stop_words(stop_words)
+        self.min_length = min_length
+
+        if not 1 <= self.ngram_range[0] <= self.ngram_range[1]:
+            raise ValueError("Invalid ngram_range: {}".format(ngram_range))
+
+    @classmethod
+    def from_config(klass, analyzer=None, hash_buckets=None):
+        "Builds a tokenizer from the analyzer section of an app's config"
+        analyzer = analyzer or {}
+        flags = re.UNICODE if analyzer.get('unicode') else 0
+        if analyzer.get('token_pattern') is not None:
+            pattern = re.compile(analyzer['token_pattern'], flags)
+        else:
+            pattern = re_unicode_word if flags else re_word
+        return klass(
+            pattern = pattern,
+            hash_buckets = hash_buckets,
+            ngram_range = analyzer.get('ngram_range', (1, 1)),
+            stop_words = analyzer.get('stop_words'),
+            min_length = analyzer.get('min_length', 1)
+        )
+
+    def find_words(self, content):
+        #For re_word, lowercasing the whole document first is equivalent
+        #unless it holds one of the two characters whose lowercase is ASCII
+        if self.pattern is re_word and not (isinstance(content, unicode) and (u"\u0130" in content or u"\u212a" in content)):
+            words = self.pattern.findall(content.lower())
+        else:
+            words = [x.lower() for x in self.pattern.findall(content)]
+        if self.min_length > 1 or self.stop_words:
+            stop_words, min_length = self.stop_words, self.min_length
+            words = [x for x in words if len(x) >= min_length and x not in stop_words]
+        return words
+
+    def ngrams(self, docs, token_ids, words):
+        "Ids, documents and names of the n-grams in ngram_range"
+        ret_ids, ret_docs, names = [], [], []
+        for n in xrange(self.ngram_range[0], self.ngram_range[1] + 1):
+            if n == 1:
+                ret_ids.append(token_ids)
+                ret_docs.append(docs)
+                names.extend(words)
+                continue
+
+            num_grams = len(token_ids) - n + 1
+            if num_grams <= 0:
+                continue
+            #An n-gram can't span two documents
+            valid = docs[:num_grams] == docs[n - 1:]
+            rows = np.stack([token_ids[k:k + num_grams][valid] for k in xrange(n)], axis=1)
+            if len(rows) == 0:
+                continue
+            distinct, inverse = np.unique(rows, axis=0, return_inverse=True)
+            ret_ids.append(inverse.astype(np.int64) + len(names))
+            ret_docs.append(docs[:num_grams][valid])
+            names.extend(u" ".join(words[x] for x in row) for row in distinct.tolist())
+
+        if len(ret_ids) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, names
+        return np.concatenate(ret_ids), np.concatenate(ret_docs), names
+
+    def __call__(self, documents):
+        find_words = self.find_words
+        lengths = []
+        tokens = []
+        for content in documents:
+            if content is None:
+                lengths.append(0)
+                continue
+            words = find_words(content)
+            lengths.append(len(words))
+            tokens.extend(words)
+
+        num_docs = len(lengths)
+        indptr = np.zeros(num_docs + 1, dtype=np.int64)
+        empty = np.zeros(0, dtype=np.int64)
+        if len(tokens) == 0:
+            return TokenizedChunk(indptr, empty, empty, None if self.hash_buckets is not None else [])
+
+        #Ids are first-occurrence positions, assigned without a Python loop,
+        #then renumbered densely
+        first_seen = {}
+        positions = np.fromiter(itertools.imap(first_seen.setdefault, tokens, itertools.count()), dtype=np.int64, count=len(tokens))
+        first, token_ids = np.unique(positions, return_inverse=True)
+        words = [tokens[x] for x in first.tolist()]
+        docs = np.repeat(np.arange(num_docs, dtype=np.int64), lengths)
+        if self.ngram_range != (1, 1):
+            token_ids, docs, words = self.ngrams(docs, token_ids, words)
+            if len(token_ids) == 0:
+                return TokenizedChunk(indptr, empty, empty, None if self.hash_buckets is not None else [])
+
+        if self.hash_buckets is not None:
+            #Hash each distinct word once, then fold colliding words together
+            buckets = np.fromiter((hash_word(x, self.hash_buckets) for x in words), dtype=np.int64, count=len(words))
+            token_ids = buckets[token_ids]
+            num_ids = self.hash_buckets
+            words = None
+        else:
+            num_ids = len(words)
+
+        keys, counts = np.unique(docs * num_ids + token_ids, return_counts=True)
+        np.cumsum(np.bincount(keys // num_ids, minlength=num_docs), out=indptr[1:])
+
+        return TokenizedChunk(indptr, keys % num_ids, counts.astype(np.int64), words)
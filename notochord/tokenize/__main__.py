@@ -1,5 +1,85 @@
 #!/usr/bin/env python
 
+from __future__ import print_function
 import sys
-import sqlalchemy
 import argparse
+import bisect
+import collections
+import random
+import time
+from .BatchTokenizer import BatchTokenizer, re_word
+
+def counter_loop(documents):
+    "The per-document loop BagOfWords used before BatchTokenizer"
+    words = []
+    values = []
+    widgets = []
+    for idwidget, content in enumerate(documents):
+        if content is None:
+            continue
+        cnt = collections.Counter(x.group(0).lower() for x in re_word.finditer(content))
+        words.extend(cnt.iterkeys())
+        values.extend(cnt.itervalues())
+        widgets.extend(idwidget for _ in xrange(len(cnt)))
+    return widgets, words, values
+
+def synthetic_documents(num_docs, words_per_doc, vocab_size, seed):
+    rng = random.Random(seed)
+    letters = u"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    vocab = [u"".join(rng.choice(letters) for _ in xrange(rng.randint(1, 12))) for _ in xrange(vocab_size)]
+    #Zipf-like word frequencies, separated by punctuation and digits
+    cumulative = []
+    total = 0.0
+    for it in xrange(vocab_size):
+        total += 1.0 / (it + 1)
+        cumulative.append(total)
+    pick = lambda: vocab[min(bisect.bisect(cumulative, rng.random() * total), vocab_size - 1)]
+    return [
+        u"".join(pick() + rng.choice(u" ,.;-0123456789") for _ in xrange(words_per_doc))
+        for _ in xrange(num_docs)
+    ]
+
+def as_triples(widgets, words, values):
+    return sorted(zip(widgets, words, values))
+
+def chunk_triples(chunk):
+    ret = []
+    for idwidget in xrange(len(chunk.indptr) - 1):
+        for it in xrange(chunk.indptr[idwidget], chunk.indptr[idwidget + 1]):
+            ret.append((idwidget, chunk.vocab[chunk.word_ids[it]], int(chunk.counts[it])))
+    return sorted(ret)
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m notochord.tokenize", description="Compare BatchTokenizer with the Counter loop")
+    parser.add_argument("--num-docs", type=int, action="store", metavar="INT", default=512, help="Documents per chunk")
+    parser.add_argument("--words-per-doc", type=int, action="store", metavar="INT", default=2000, help="Words per document")
+    parser.add_argument("--vocab-size", type=int, action="store", metavar="INT", default=50000, help="Distinct words")
+    parser.add_argument("--repeat", type=int, action="store", metavar="INT", default=5, help="Timed repetitions")
+    parser.add_argument("--seed", type=int, action="store", metavar="INT", default=0, help="Random seed")
+    parser.add_argument("files", type=unicode, action="store", metavar="PATH", nargs='*', help="Text files to use as documents instead of synthetic ones")
+    args = parser.parse_args(argv)
+
+    if args.files:
+        documents = []
+        for path in args.files:
+            with open(path, 'rb') as fin:
+                documents.append(fin.read().decode('utf-8'))
+    else:
+        documents = synthetic_documents(args.num_docs, args.words_per_doc, args.vocab_size, args.seed)
+
+    tokenizer = BatchTokenizer()
+    if as_triples(*counter_loop(documents)) != chunk_triples(tokenizer(documents)):
+        raise AssertionError("BatchTokenizer output differs from the Counter loop")
+
+    num_bytes = sum(len(x) for x in documents)
+    for name, func in (("counter_loop", counter_loop), ("BatchTokenizer", tokenizer)):
+        times = []
+        for _ in xrange(args.repeat):
+            start_time = time.time()
+            func(documents)
+            times.append(time.time() - start_time)
+        best = min(times)
+        print("{:<16} best={:8.4f}s docs/s={:10.1f} MB/s={:8.2f}".format(name, best, len(documents) / best, num_bytes / 1e6 / best))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
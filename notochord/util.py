@@ -1,5 +1,12 @@
 import logging
 import collections
+import fcntl
+import hashlib
+import math
+import mmap
+import numpy as np
+import os
+import struct
 import lru
 import itertools
 import inspect
@@ -66,8 +73,6 @@ class FeatureCache(object):
         self.log = log or null_log
 
     def __call__(self, session, idfeature_set, names):
-        from .schema import feature as t_f
-
         self.log.info("Replacing feature names with idfeature and identifying missing features")
         missing = collections.defaultdict(lambda: [])
         ret = []
@@ -77,6 +82,16 @@ class FeatureCache(object):
             if key is None:
                 missing[name].append(it)
 
+        self.resolve(session, idfeature_set, missing, ret, self.cache)
+        return ret
+
+    def resolve(self, session, idfeature_set, missing, ret, cache):
+        "Inserts and looks up the missing names, filling ret and cache"
+        from .schema import feature as t_f
+
+        if len(missing) == 0:
+            return
+
         dialect = session.bind.dialect.name
 
         if dialect == 'sqlite':
@@ -92,7 +107,7 @@ class FeatureCache(object):
                 for f in q_f:
                     name = f.name
                     key = f.idfeature
-                    self.cache[name] = key
+                    cache[name] = key
                     for it in missing[name]:
                         ret[it] = key
         else:
@@ -109,13 +124,229 @@ class FeatureCache(object):
             for f in q_f:
                 name = f.name
                 key = f.idfeature
-                self.cache[name] = key
+                cache[name] = key
                 for it in missing[name]:
                     ret[it] = key
             self.log.info("Done")
 
+feature_table_magic = "NCFEATS1"
+feature_table_header = struct.Struct("<8sQQ")
+
+def feature_hash(data):
+    "64-bit hash of a utf-8 encoded feature name"
+    return struct.unpack("<Q", hashlib.md5(data).digest()[:8])[0]
+
+class FeatureTable(object):
+    """Memory-mapped table of feature names and their idfeature
+
+    The file holds the 64-bit hashes of the names in sorted order, then the
+    matching idfeatures, offsets into a blob of utf-8 names, and the blob.
+    Lookups binary search the hashes and check the name, so every process
+    reading the file shares the same pages.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        self.stat = None
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.offsets = np.zeros(1, dtype=np.uint64)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def changed(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return self.stat != (st.st_ino, st.st_size, st.st_mtime)
+
+    def open(self):
+        self.close()
+        with open(self.path, 'rb') as fin:
+            st = os.fstat(fin.fileno())
+            data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, count, _ = feature_table_header.unpack_from(data, 0)
+        if magic != feature_table_magic:
+            data.close()
+            raise ValueError("Not a feature table: '{}'".format(self.path))
+
+        pos = feature_table_header.size
+        self.hashes = np.frombuffer(data, dtype=np.uint64, count=count, offset=pos)
+        pos += 8 * count
+        self.ids = np.frombuffer(data, dtype=np.int64, count=count, offset=pos)
+        pos += 8 * count
+        self.offsets = np.frombuffer(data, dtype=np.uint64, count=count + 1, offset=pos)
+        self.blob_offset = pos + 8 * (count + 1)
+        self.data = data
+        self.stat = (st.st_ino, st.st_size, st.st_mtime)
+
+    def close(self):
+        #The map is released along with the last array viewing it
+        self.__init__(self.path)
+
+    def name(self, it):
+        start = self.blob_offset + int(self.offsets[it])
+        end = self.blob_offset + int(self.offsets[it + 1])
+        return self.data[start:end]
+
+    def items(self):
+        for it in xrange(len(self.ids)):
+            yield self.name(it).decode('utf-8'), int(self.ids[it])
+
+    def lookup(self, names):
+        ret = [None] * len(names)
+        if len(self.hashes) == 0 or len(names) == 0:
+            return ret
+
+        encoded = [x.encode('utf-8') for x in names]
+        hashes = np.array([feature_hash(x) for x in encoded], dtype=np.uint64)
+        locs = np.searchsorted(self.hashes, hashes)
+        found = np.flatnonzero(self.hashes[np.minimum(locs, len(self.hashes) - 1)] == hashes)
+        for it in found.tolist():
+            loc = int(locs[it])
+            #Equal hashes are adjacent, so collisions are resolved by name
+            while loc < len(self.hashes) and self.hashes[loc] == hashes[it]:
+                if self.name(loc) == encoded[it]:
+                    ret[it] = int(self.ids[loc])
+                    break
+                loc += 1
         return ret
 
+    @staticmethod
+    def write(path, items):
+        names, ids = [], []
+        for name, idfeature in items:
+            names.append(name.encode('utf-8'))
+            ids.append(idfeature)
+
+        hashes = np.array([feature_hash(x) for x in names], dtype=np.uint64)
+        order = np.argsort(hashes, kind="mergesort")
+        names = [names[x] for x in order.tolist()]
+        offsets = np.zeros(len(names) + 1, dtype=np.uint64)
+        np.cumsum([len(x) for x in names], out=offsets[1:])
+
+        tmp_path = "{}.tmp.{}".format(path, os.getpid())
+        with open(tmp_path, 'wb') as fout:
+            fout.write(feature_table_header.pack(feature_table_magic, len(names), int(offsets[-1])))
+            fout.write(hashes[order].tobytes())
+            fout.write(np.array(ids, dtype=np.int64)[order].tobytes())
+            fout.write(offsets.tobytes())
+            for name in names:
+                fout.write(name)
+        os.rename(tmp_path, path)
+
+@export
+class PersistentFeatureCache(FeatureCache):
+    """FeatureCache backed by one memory-mapped file per feature set
+
+    A feature set's file is built from a single streaming query the first
+    time it's used.  Names missing from the file are resolved through the
+    database as usual and kept in memory until save() merges them into the
+    file, so concurrent runs share each other's features once saved.  Only
+    call save() after the features' transaction commits, since ids handed out
+    by a rolled back transaction may be reused.
+    Features are assumed never to be renumbered; remove the directory after
+    recreating the database.
+    """
+    def __init__(self, directory, count=65536, log=None):
+        super(PersistentFeatureCache, self).__init__(count=count, log=log)
+        self.directory = directory
+        self.tables = {}
+        self.pending = {}
+
+    def table_path(self, idfeature_set):
+        return os.path.join(self.directory, "{}.features".format(int(idfeature_set)))
+
+    @contextmanager
+    def locked(self, idfeature_set):
+        fd = os.open(self.table_path(idfeature_set) + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def table(self, session, idfeature_set):
+        table = self.tables.get(idfeature_set)
+        if table is not None:
+            return table
+
+        from .schema import feature as t_f
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+
+        table = FeatureTable(self.table_path(idfeature_set))
+        with self.locked(idfeature_set):
+            if not table.exists():
+                self.log.info("Preloading features of feature set {}".format(idfeature_set))
+                q_f = session.query(t_f.name, t_f.idfeature) \
+                    .filter(t_f.idfeature_set == idfeature_set) \
+                    .yield_per(65536)
+                FeatureTable.write(table.path, q_f)
+            table.open()
+        self.tables[idfeature_set] = table
+        return table
+
+    def __call__(self, session, idfeature_set, names):
+        names = list(names)
+        table = self.table(session, idfeature_set)
+        pending = self.pending.setdefault(idfeature_set, {})
+
+        ret = table.lookup(names)
+        missing = self.find_missing(names, ret, pending)
+        if len(missing) > 0 and table.changed():
+            #Another process saved features since the file was opened
+            table.open()
+            missing_names = missing.keys()
+            for name, key in itertools.izip(missing_names, table.lookup(missing_names)):
+                if key is not None:
+                    for it in missing.pop(name):
+                        ret[it] = key
+
+        if len(missing) > 0:
+            self.log.info("Resolving {} features missing from the cache".format(len(missing)))
+        self.resolve(session, idfeature_set, missing, ret, pending)
+        return ret
+
+    @staticmethod
+    def find_missing(names, ret, pending):
+        missing = collections.defaultdict(lambda: [])
+        for it, key in enumerate(ret):
+            if key is None:
+                key = ret[it] = pending.get(names[it])
+                if key is None:
+                    missing[names[it]].append(it)
+        return missing
+
+    def save(self):
+        "Merges resolved features into the files"
+        for idfeature_set, pending in self.pending.iteritems():
+            if len(pending) == 0:
+                continue
+            table = self.tables[idfeature_set]
+            with self.locked(idfeature_set):
+                if table.changed():
+                    table.open()
+                items = dict(table.items())
+                items.update(pending)
+                table.close()
+                FeatureTable.write(table.path, items.iteritems())
+                table.open()
+            pending.clear()
+
+    def close(self):
+        for table in self.tables.itervalues():
+            table.close()
+        self.tables.clear()
+
 @export
 def get_utcnow():
     return datetime.datetime.now(tz=iso8601.UTC)
@@ -138,6 +369,18 @@ def lookup_or_persist(session, table, **kwargs):
 def pk(t):
     return getattr(t, "id{}".format(t.__tablename__))
 
+@export
+def pipelined_map(pool, func, iterable, depth):
+    "Ordered pool map that keeps at most `depth` tasks outstanding"
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= depth:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
 @export
 def batcher(iterable, n=1):
     l = len(iterable)
@@ -154,6 +397,236 @@ def populate(session, t, values, batch_size=100):
             [x for x in group if x is not None]
         )
 
+def copy_text_field(value):
+    "Encodes a value for PostgreSQL's COPY text format"
+    if value is None:
+        return "\\N"
+    elif isinstance(value, float):
+        return repr(value)
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+class CopyStream(object):
+    "File-like view of rows in COPY text format, generated as they're read"
+    def __init__(self, rows):
+        self.lines = ("\t".join(copy_text_field(x) for x in row) + "\n" for row in rows)
+        self.buf = ""
+
+    def read(self, size=-1):
+        parts = [self.buf]
+        length = len(self.buf)
+        for line in self.lines:
+            parts.append(line)
+            length += len(line)
+            if size >= 0 and length >= size:
+                break
+        data = "".join(parts)
+        if size < 0:
+            size = len(data)
+        self.buf = data[size:]
+        return data[:size]
+
+    readline = read
+
+copy_binary_header = "PGCOPY\n\xff\r\n\0" + struct.pack(">ii", 0, 0)
+copy_binary_trailer = struct.pack(">h", -1)
+
+def copy_binary_dtype(column_type):
+    "Big-endian numpy type matching a column's binary COPY encoding, or None"
+    if isinstance(column_type, sqlalchemy.types.BigInteger):
+        return ">i8"
+    elif isinstance(column_type, sqlalchemy.types.SmallInteger):
+        return ">i2"
+    elif isinstance(column_type, sqlalchemy.types.Integer):
+        return ">i4"
+    elif isinstance(column_type, sqlalchemy.types.Float) and column_type.precision is None:
+        return ">f8"
+    return None
+
+def copy_binary_rows(table, columns, arrays):
+    "Packs columns of fixed width types into PostgreSQL's binary COPY format"
+    fields = [("num_fields", ">i2")]
+    for name in columns:
+        fields += [(name + "_length", ">i4"), (name, copy_binary_dtype(table.c[name].type))]
+    data = np.empty(len(arrays[0]), dtype=fields)
+    data["num_fields"] = len(columns)
+    for name, arr in zip(columns, arrays):
+        data[name + "_length"] = data.dtype[name].itemsize
+        data[name] = arr
+    return copy_binary_header + data.tobytes() + copy_binary_trailer
+
+def bulk_load_postgresql(session, table, columns, source, on_conflict, binary=False):
+    from sqlalchemy import Table, Column
+    from sqlalchemy.dialects.postgresql import insert
+    import zlib
+
+    cursor = session.connection().connection.cursor()
+    column_list = ", ".join('"{}"'.format(x) for x in columns)
+    copy_format = " WITH (FORMAT binary)" if binary else ""
+    if on_conflict is None:
+        cursor.copy_expert('COPY "{}" ({}) FROM STDIN{}'.format(table.name, column_list, copy_format), source)
+        return cursor.rowcount
+
+    #COPY can't skip conflicting rows, so they are staged first.  The
+    #staging table lives as long as the connection and is emptied after use.
+    staging = Table(
+        "tmp_bulk_load_{}_{:08x}".format(table.name, zlib.crc32(",".join(columns)) & 0xffffffff), sqlalchemy.MetaData(),
+        *[Column(x, table.c[x].type) for x in columns],
+        prefixes=["TEMPORARY"]
+    )
+    staging.create(bind=session.connection(), checkfirst=True)
+    cursor.copy_expert('COPY "{}" ({}) FROM STDIN{}'.format(staging.name, column_list, copy_format), source)
+    num_rows = cursor.rowcount
+    stmt = insert(table).from_select(columns, staging.select())
+    keys = [x.name for x in table.primary_key]
+    if on_conflict == "ignore":
+        stmt = stmt.on_conflict_do_nothing(index_elements=keys)
+    else:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=keys,
+            set_=dict((x, stmt.excluded[x]) for x in columns if x not in keys)
+        )
+    session.execute(stmt)
+    session.execute(sqlalchemy.text('TRUNCATE "{}"'.format(staging.name)))
+    return num_rows
+
+def bulk_load_sqlite(session, table, columns, rows, on_conflict):
+    #One prepared statement run by executemany inside the session's
+    #transaction, skipping SQLAlchemy's per-row parameter processing
+    verb = {None: "INSERT", "ignore": "INSERT OR IGNORE", "replace": "INSERT OR REPLACE"}[on_conflict]
+    cursor = session.connection().connection.cursor()
+    cursor.executemany(
+        '{} INTO "{}" ({}) VALUES ({})'.format(verb, table.name, ", ".join('"{}"'.format(x) for x in columns), ", ".join("?" * len(columns))),
+        rows
+    )
+    return cursor.rowcount
+
+def bulk_load_mysql(session, table, columns, rows, on_conflict):
+    import csv
+    import os
+    import stat
+    import tempfile
+
+    verb = {None: "", "ignore": "IGNORE", "replace": "REPLACE"}[on_conflict]
+    insert_fout, insert_file = tempfile.mkstemp()
+    try:
+        os.chmod(insert_file, stat.S_IREAD | stat.S_IWRITE | stat.S_IROTH)
+        num_rows = 0
+        with os.fdopen(insert_fout, 'w') as fout:
+            csvout = csv.writer(fout, delimiter=',', escapechar='\\')
+            for row in rows:
+                csvout.writerow(["\\N" if x is None else (x.encode('utf-8') if isinstance(x, unicode) else x) for x in row])
+                num_rows += 1
+
+        session.execute(sqlalchemy.text(r"""
+            LOAD DATA CONCURRENT LOCAL INFILE '{insert_file}'
+            {verb}
+            INTO TABLE {table}
+            CHARACTER SET utf8
+            FIELDS TERMINATED BY ','
+                OPTIONALLY ENCLOSED BY '"'
+                ESCAPED BY '\\'
+            LINES TERMINATED BY '\n'
+            ({columns})
+        """.format(insert_file=insert_file, verb=verb, table=table.name, columns=", ".join(columns))))
+    finally:
+        os.remove(insert_file)
+    return num_rows
+
+def bulk_load_staged(session, table, columns, rows, on_conflict, batch_size=1000):
+    #Portable conflict handling for dialects without a fast path: rows are
+    #staged in a temporary table and merged on the primary key in plain SQL
+    from sqlalchemy import Table, Column
+
+    staging = Table(
+        "tmp_bulk_load_{}".format(table.name), sqlalchemy.MetaData(),
+        *[Column(x, table.c[x].type) for x in columns],
+        prefixes=["TEMPORARY"]
+    )
+    staging.create(bind=session.connection(), checkfirst=True)
+    try:
+        num_rows = 0
+        for group in grouper(rows, batch_size):
+            batch = [dict(zip(columns, x)) for x in group if x is not None]
+            session.execute(staging.insert(), batch)
+            num_rows += len(batch)
+
+        same_key = sqlalchemy.and_(*[table.c[x.name] == staging.c[x.name] for x in table.primary_key])
+        conflicts = sqlalchemy.exists().where(same_key)
+        if on_conflict == "replace":
+            session.execute(table.delete().where(conflicts))
+            session.execute(table.insert().from_select(columns, staging.select()))
+        else:
+            session.execute(table.insert().from_select(columns, staging.select().where(~conflicts)))
+    finally:
+        staging.drop(bind=session.connection())
+    return num_rows
+
+@export
+def bulk_load(session, t, columns, rows, on_conflict=None, batch_size=1000):
+    """Loads an iterable of row tuples with the fastest path the dialect has
+
+    on_conflict is None to fail on duplicate keys, "ignore" to keep existing
+    rows or "replace" to overwrite them.  Returns the number of rows loaded.
+    """
+    if not isinstance(t, sqlalchemy.schema.Table): t = t.__table__
+    if on_conflict not in (None, "ignore", "replace"):
+        raise ValueError("Unknown conflict resolution: '{}'".format(on_conflict))
+
+    #Raw cursors bypass the unit of work, so pending objects go first
+    session.flush()
+
+    dialect = session.bind.dialect.name
+    if dialect == "postgresql" and session.bind.dialect.driver == "psycopg2":
+        return bulk_load_postgresql(session, t, columns, CopyStream(rows), on_conflict)
+    elif dialect == "sqlite":
+        return bulk_load_sqlite(session, t, columns, rows, on_conflict)
+    elif dialect == "mysql":
+        return bulk_load_mysql(session, t, columns, rows, on_conflict)
+
+    if on_conflict is not None:
+        return bulk_load_staged(session, t, columns, rows, on_conflict, batch_size=batch_size)
+    num_rows = 0
+    for group in grouper(rows, batch_size):
+        batch = [dict(zip(columns, x)) for x in group if x is not None]
+        session.execute(t.insert(), batch)
+        num_rows += len(batch)
+    return num_rows
+
+@export
+def bulk_load_arrays(session, t, columns, arrays, on_conflict=None, batch_size=65536):
+    """Loads rows given as one numpy array per column
+
+    Behaves like bulk_load without building Python objects per row where it
+    can: PostgreSQL gets binary COPY packed by numpy, and other dialects are
+    fed whole batches converted with tolist.
+    """
+    if not isinstance(t, sqlalchemy.schema.Table): t = t.__table__
+    if on_conflict not in (None, "ignore", "replace"):
+        raise ValueError("Unknown conflict resolution: '{}'".format(on_conflict))
+    arrays = [np.asarray(x) for x in arrays]
+    num_rows = len(arrays[0]) if len(arrays) > 0 else 0
+    if any(len(x) != num_rows for x in arrays):
+        raise ValueError("Columns have different lengths: {}".format([len(x) for x in arrays]))
+
+    binary = session.bind.dialect.name == "postgresql" and session.bind.dialect.driver == "psycopg2" \
+        and all(copy_binary_dtype(t.c[x].type) is not None for x in columns) \
+        and not any(x.dtype.kind == "O" for x in arrays)
+
+    session.flush()
+    ret = 0
+    for start in xrange(0, num_rows, batch_size):
+        batch = [x[start:start + batch_size] for x in arrays]
+        if binary:
+            import io
+            ret += bulk_load_postgresql(session, t, columns, io.BytesIO(copy_binary_rows(t, columns, batch)), on_conflict, binary=True)
+        else:
+            ret += bulk_load(session, t, columns, itertools.izip(*[x.tolist() for x in batch]), on_conflict=on_conflict, batch_size=batch_size)
+    return ret
+
 @export
 def temporary_table_like(name, t):
     from sqlalchemy import Column, Table
@@ -219,60 +692,134 @@ def filter_widgets(wq, min_idwidget=None, max_idwidget=None, datasources=[]):
 
     return wq
 
+@export
+def iterate_batches(session, query, num_columns, batch_size=65536, stream=False):
+    """Runs a query and yields its rows as 2-d float64 arrays of up to batch_size
+
+    Rows are fetched straight from the DBAPI cursor, skipping SQLAlchemy's
+    per-row processing, so columns must come back from the driver as plain
+    numbers.  NULLs become nan.  With stream set, the rows stay on the
+    server until fetched, through a server-side cursor where the driver has
+    one.
+    """
+    statement = getattr(query, "statement", query)
+    if stream:
+        statement = statement.execution_options(stream_results=True)
+    result = session.execute(statement)
+    try:
+        cursor = result.cursor
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            yield np.array(rows, dtype=np.float64).reshape((len(rows), num_columns))
+    finally:
+        result.close()
+
+@export
+def fetch_arrays(session, query, dtypes, batch_size=65536):
+    "Runs a query and returns each of its columns as a numpy array"
+    batches = list(iterate_batches(session, query, len(dtypes), batch_size=batch_size))
+    data = np.concatenate(batches) if len(batches) > 0 else np.zeros((0, len(dtypes)))
+    return [data[:, it].astype(dtype) for it, dtype in enumerate(dtypes)]
+
+@export
+def document_frequency(value):
+    "Parses a document frequency bound, an integer count or a fraction in (0, 1] such as 0.5 or 1e-3"
+    import argparse
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        ret = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid document frequency: '{}'".format(value))
+    if not 0.0 < ret <= 1.0:
+        raise argparse.ArgumentTypeError("document frequency fractions must be in (0, 1]: '{}'".format(value))
+    return ret
+
+@export
+def prune_features(session, features, widgets, min_df=None, max_df=None, max_features=None, log=None):
+    """Narrows a query of idfeature by the document frequency of each feature
+
+    min_df and max_df are numbers of widgets when ints and fractions of the
+    widgets when floats.  max_features keeps only that many of the most
+    frequent features left.  Only the selection changes; the widget
+    features themselves are kept.
+    """
+    from .schema import widget_feature as t_wf
+    from sqlalchemy.sql.expression import func
+
+    log = log or null_log
+    if min_df is None and max_df is None and max_features is None:
+        return features
+
+    for value in (min_df, max_df):
+        if isinstance(value, float) and not 0.0 < value <= 1.0:
+            raise ValueError("Document frequency fractions must be in (0, 1]: {}".format(value))
+
+    if isinstance(min_df, float) or isinstance(max_df, float):
+        num_widgets = widgets.count()
+        if isinstance(min_df, float):
+            min_df = int(math.ceil(min_df * num_widgets))
+        if isinstance(max_df, float):
+            max_df = int(math.floor(max_df * num_widgets))
+    log.info("Pruning features to document frequencies in [{}, {}] and at most {} features".format(min_df, max_df, max_features))
+
+    sq_f = features.subquery()
+    sq_w = widgets.subquery()
+    df = func.count(t_wf.idwidget)
+    q = session.query(t_wf.idfeature.label("idfeature")) \
+        .filter(t_wf.idfeature.in_(session.query(sq_f.c.idfeature))) \
+        .filter(t_wf.idwidget.in_(session.query(sq_w.c.idwidget))) \
+        .group_by(t_wf.idfeature)
+
+    if min_df is not None:
+        q = q.having(df >= min_df)
+    if max_df is not None:
+        q = q.having(df <= max_df)
+    if max_features is not None:
+        q = q.order_by(df.desc(), t_wf.idfeature.asc()).limit(max_features)
+    else:
+        q = q.order_by(t_wf.idfeature.asc())
+
+    return q
+
 @export
 def upload_widget_features(session, widget_features):
+    """Records widgets by uuid along with the features they have
+
+    Widgets are inserted unless they exist and their ids looked up in
+    batches, so each widget_feature row is bulk loaded once.
+    """
     from .schema import widget_feature as t_wf
     from .schema import widget as t_w
-    from .schema import datasource as t_ds
-    from .schema import feature as t_f
-    from .schema import feature_set as t_fs
 
-    from . import schema
+    dialect = session.bind.dialect.name
+    if dialect.startswith("mysql"):
+        session.execute("SET @@foreign_key_checks=0;")
 
-    from sqlalchemy.sql.expression import func, literal
-    from sqlalchemy import Column, tuple_
+    widget_features = list(widget_features)
+    uuids = collections.defaultdict(set)
+    for x in widget_features:
+        uuids[x['iddatasource']].add(x['widget'])
 
-    if session.bind.dialect.name.startswith("mysql"):
-        session.execute("SET @@foreign_key_checks=0;")
+    idwidgets = {}
+    for iddatasource, widgets in uuids.iteritems():
+        for batch in batcher(sorted(widgets), 445):
+            session.execute(insert_ignore(t_w, dialect).values(
+                [dict(uuid=x, iddatasource=iddatasource) for x in batch]
+            ))
+            q_w = session.query(t_w.uuid, t_w.idwidget) \
+                .filter(t_w.iddatasource == iddatasource) \
+                .filter(t_w.uuid.in_(batch))
+            for uuid, idwidget in q_w:
+                idwidgets[(iddatasource, uuid)] = idwidget
 
-    class tmp_upload(schema.TableBase):
-        idtmp_upload = Column(t_f.idfeature.type, nullable=False, primary_key=True)
-        widget = Column(t_w.uuid.type, nullable=False)
-        idfeature = Column(t_f.idfeature.type, nullable=False)
-        idfeature_set = Column(t_fs.idfeature_set.type, nullable=False)
-        iddatasource = Column(t_w.iddatasource.type, nullable=False)
-        __table_args__ = ({'prefixes':["TEMPORARY"], 'keep_existing':True},)
-        __tablename__ = "tmp_upload"
+    bulk_load(session, t_wf, ["idwidget", "idfeature"], (
+        (idwidgets[(x['iddatasource'], x['widget'])], x['idfeature']) for x in widget_features
+    ), on_conflict="ignore")
 
-    dialect = session.bind.dialect.name
-    
-    with temptable_scope(session, tmp_upload):
-        session.bulk_insert_mappings(tmp_upload, widget_features)
-
-#        session.execute(
-#            t_wf.__table__.delete().where(
-#                tuple_(t_wf.idwidget, t_wf.idfeature).in_(
-#                    session.query(t_wf.idwidget, t_wf.idfeature) \
-#                        .select_from(tmp_upload) \
-#                        .join(t_w, t_w.uuid == tmp_upload.widget) \
-#                        .join(t_wf, t_wf.idwidget == t_w.idwidget) \
-#                        .join(t_f, t_f.idfeature == t_wf.idfeature) \
-#                        .filter(t_f.idfeature_set == tmp_upload.idfeature_set) \
-#                        .filter(t_w.iddatasource == tmp_upload.iddatasource)
-#        )))
-        session.execute(
-            insert_ignore(t_w, dialect).from_select(
-                [t_w.uuid, t_w.iddatasource],
-                session.query(tmp_upload.widget, tmp_upload.iddatasource)
-        ))
-        session.execute(
-            insert_ignore(t_wf, dialect).from_select(
-                [t_wf.idwidget, t_wf.idfeature],
-                session.query(t_w.idwidget, tmp_upload.idfeature) \
-                    .select_from(tmp_upload) \
-                    .join(t_w, t_w.uuid == tmp_upload.widget) \
-                    .filter(t_w.iddatasource == tmp_upload.iddatasource)
-        ))
-    tmp_upload.metadata.remove(tmp_upload.__table__)
-    if session.bind.dialect.name.startswith("mysql"):
+    if dialect.startswith("mysql"):
         session.execute("SET @@foreign_key_checks=1;")